@@ -1 +1,2 @@
 from template_preprocessor.core.preprocessable_template_tags import preprocess_tag
+from template_preprocessor.core.preprocess_variables import register_preprocess_variable
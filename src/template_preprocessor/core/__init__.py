@@ -4,8 +4,15 @@
 Django template preprocessor.
 Author: Jonathan Slenders, City Live
 """
-from template_preprocessor.core.django_processor import parse
+from template_preprocessor.core.django_processor import parse, specialize, NotLanguageNeutral
 from template_preprocessor.core.context import Context
+from template_preprocessor.core.lexer import CompileException
+from template_preprocessor.core.run_cache import clear_run_caches
+
+from django.template import TemplateDoesNotExist
+
+from copy import deepcopy
+import codecs
 
 
 def output_tree(tree):
@@ -16,13 +23,15 @@ def _default_loader(path):
     return open(path).read()
 
 
-def compile(code, path='', loader=None, options=None, context_class=None):
+def compile(code, path='', loader=None, options=None, context_class=None, lean=False):
     """
     Compile the template, do everything, and return a single document
     as a string. The loader should look like: (lambda path: return code)
     and is called for the includes/extends.
+    When `lean` is True, the context doesn't remember gettext entries,
+    warnings and dependencies. (Use this when only the output is needed.)
     """
-    tree, context = compile_to_parse_tree(code, path, loader, options, context_class)
+    tree, context = compile_to_parse_tree(code, path, loader, options, context_class, lean=lean)
 
     #print tree._print()
     #print output_tree(tree)
@@ -30,13 +39,160 @@ def compile(code, path='', loader=None, options=None, context_class=None):
     return output_tree(tree), context
 
 
-def compile_to_parse_tree(code, path='', loader=None, options=None, context_class=None):
+def compile_to_parse_tree(code, path='', loader=None, options=None, context_class=None, language_neutral=False, lean=False):
     # Make the loader also parse the templates
     def new_loader(include_path):
         return parse( (loader or _default_loader)(include_path), include_path, context)
 
     # Create preprocess context
-    context = (context_class or Context)(path, new_loader, options)
+    # (Only pass the keyword arguments which are used, custom context
+    # classes don't have to know them.)
+    kwargs = { }
+    if language_neutral:
+        kwargs['language_neutral'] = True
+    if lean:
+        kwargs['lean'] = True
+
+    context = (context_class or Context)(path, new_loader, options, **kwargs)
 
     # Parse template, and return output
-    return parse(code, path, context, main_template=True), context
+    try:
+        return parse(code, path, context, main_template=True), context
+    except CompileException, e:
+        # Give the caller access to the context of the failed compilation.
+        if not hasattr(e, 'context'):
+            e.context = context
+        raise
+
+
+def compile_language_neutral(code, path='', loader=None, options=None, context_class=None, lean=False):
+    """
+    Do the heavy part of the compilation once for all languages. Returns the
+    parse tree and context, to be passed to `specialize_for_language` for
+    every language. Raises NotLanguageNeutral when this template has to be
+    compiled for each language separately.
+    """
+    return compile_to_parse_tree(code, path, loader, options, context_class, language_neutral=True, lean=lean)
+
+
+def specialize_for_language(tree, context):
+    """
+    Return the output of a language neutral tree for the active language.
+    (The tree itself is not modified.)
+    """
+    tree = deepcopy(tree)
+    specialize(tree, context)
+    return output_tree(tree)
+
+
+def compile_many(paths, languages=None, options=None, loader=None, context_class=None, lean=False, workers=None):
+    """
+    Compile many templates at once, and yield (path, language, output, context)
+    tuples as they are ready. The templates share the sources of the templates
+    they include or extend, the options of the apps and the preprocess
+    variables. (The run caches are cleared once, at the start.)
+
+    - paths: paths of the template files.
+    - languages: compile every template in each of these languages. By
+      default, only in the active language (`language` is None then.)
+      The language neutral part of the compilation is done once for every
+      template, and specialized for each language. Templates which are not
+      language neutral are compiled for each language separately.
+    - options: list of options, or a function which returns the options for
+      a path. By default, the options of the app containing the template.
+    - loader: returns the source of included and extended templates.
+    - workers: number of threads. The results are yielded in order of
+      completion then.
+
+    When a template can't be read or compiled, the CompileException (or
+    TemplateDoesNotExist) is yielded instead of the output, and the context
+    of the failed compilation (if any) as context.
+    """
+    from template_preprocessor.utils import language, load_template_source, get_options_for_path
+
+    clear_run_caches()
+
+    loader = loader or load_template_source
+    options = get_options_for_path if options is None else options
+    sources = { }
+
+    def cached_loader(include_path):
+        if include_path not in sources:
+            sources[include_path] = loader(include_path)
+        return sources[include_path]
+
+    def read(path):
+        key = ('file', path)
+        if key not in sources:
+            try:
+                sources[key] = codecs.open(path, 'r', 'utf-8').read()
+            except (UnicodeDecodeError, IOError), e:
+                raise CompileException(0, 0, path, str(e))
+        return sources[key]
+
+    def compile_one(code, path, lang, path_options):
+        try:
+            if lang is None:
+                output, context = compile(code, path=path, loader=cached_loader, options=path_options,
+                                    context_class=context_class, lean=lean)
+            else:
+                with language(lang):
+                    output, context = compile(code, path=path, loader=cached_loader, options=path_options,
+                                    context_class=context_class, lean=lean)
+
+            return path, lang, output, context
+
+        except (CompileException, TemplateDoesNotExist), e:
+            return path, lang, e, getattr(e, 'context', None)
+
+    def compile_path(path):
+        # Return the results of this template for every language.
+        try:
+            code = read(path)
+            path_options = options(path) if callable(options) else options
+        except CompileException, e:
+            return [ (path, lang, e, getattr(e, 'context', None)) for lang in (languages or [ None ]) ]
+
+        # Language neutral phase
+        tree = None
+        if languages and len(languages) > 1:
+            try:
+                with language(languages[0]):
+                    tree, context = compile_language_neutral(code, path=path, loader=cached_loader,
+                                    options=path_options, context_class=context_class, lean=lean)
+            except (NotLanguageNeutral, CompileException, TemplateDoesNotExist), e:
+                # Errors are reported by the compilation for each language.
+                tree = None
+
+        # Specialize for each language
+        results = [ ]
+        for lang in (languages or [ None ]):
+            output = None
+
+            if tree is not None:
+                with language(lang):
+                    try:
+                        output = specialize_for_language(tree, context)
+                    except (NotLanguageNeutral, CompileException), e:
+                        pass
+
+            if output is None:
+                results.append(compile_one(code, path, lang, path_options))
+            else:
+                results.append((path, lang, output, context))
+
+        return results
+
+    if workers and workers > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(workers)
+        try:
+            for results in pool.imap_unordered(compile_path, paths):
+                for result in results:
+                    yield result
+        finally:
+            pool.terminate()
+    else:
+        for path in paths:
+            for result in compile_path(path):
+                yield result
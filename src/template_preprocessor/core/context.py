@@ -4,6 +4,8 @@
 Django template preprocessor.
 Author: Jonathan Slenders, City Live
 """
+from django.conf import settings
+
 from template_preprocessor.core.lexer import CompileException
 import os
 
@@ -27,9 +29,25 @@ class Context(object):
     Preprocess context. Contains the compile settings, error logging,
     remembers dependencies, etc...
     """
-    def __init__(self, path, loader=None, extra_options=None, insert_debug_symbols=False):
+    def __init__(self, path, loader=None, extra_options=None, insert_debug_symbols=False, language_neutral=False, lean=False):
         self.loader = loader
-        self.insert_debug_symbols = insert_debug_symbols
+
+        # A lean context only produces the output. It doesn't remember gettext
+        # entries, warnings or dependencies, and doesn't insert debug symbols.
+        # (For compiling at runtime.)
+        self.lean = lean
+        self.insert_debug_symbols = insert_debug_symbols and not lean
+
+        # When language_neutral, the language dependent parts of the template
+        # are left in the tree, for `specialize` to be processed per language.
+        self.language_neutral = language_neutral
+
+        # When keep_output_before_html is set, the output of the template
+        # before the HTML compiler runs is kept in output_before_html. (This
+        # is the output with the 'no-html' option, to be used when the HTML
+        # compiler fails.)
+        self.keep_output_before_html = False
+        self.output_before_html = None
 
         # Remember stuff
         self.warnings = []
@@ -44,6 +62,10 @@ class Context(object):
         self.include_dependencies = []
         self.extends_dependencies = []
 
+        # How many times the template which is being parsed is inlined in
+        # the main template. (For the include budget.)
+        self.include_occurrences = 1
+
         # Process options
         self.options = Options()
         for o in extra_options or []:
@@ -69,30 +91,39 @@ class Context(object):
         for the current template will go on. But it's possible to retreive a
         list of all the warnings at the end.
         """
-        self.warnings.append(PreprocessWarning(node, message))
+        if not self.lean:
+            self.warnings.append(PreprocessWarning(node, message))
 
     def load(self, template):
         if self.loader:
-            self.template_dependencies.append(template)
+            if not self.lean:
+                self.template_dependencies.append(template)
             return self.loader(template)
         else:
             raise Exception('Preprocess context does not support template loading')
 
     def remember_gettext(self, node, text):
-        self.gettext_entries.append(GettextEntry(node.path, node.line, node.column, text))
+        if not self.lean:
+            self.gettext_entries.append(GettextEntry(node.path, node.line, node.column, text))
 
     def remember_include(self, template):
-        self.include_dependencies.append(template)
+        if not self.lean:
+            self.include_dependencies.append(template)
 
     def remember_extends(self, template):
-        self.extends_dependencies.append(template)
+        if not self.lean:
+            self.extends_dependencies.append(template)
 
     # What to do with media files
 
     def compile_js_files(self, compress_tag, media_files):
+        if not self.lean:
+            self.media_dependencies.extend(media_files)
         return compile_external_javascript_files(media_files, self, compress_tag)
 
     def compile_css_files(self, compress_tag, media_files):
+        if not self.lean:
+            self.media_dependencies.extend(media_files)
         return compile_external_css_files(media_files, self, compress_tag)
 
 
@@ -112,11 +143,15 @@ class Options(object):
         # Default settings
         self.execute_preprocessable_tags = True
         self.merge_all_load_tags = True
-        self.preprocess_ifdebug = True # Should probably always be True
+        self.preprocess_conditions = True
+        # Django doesn't put DEBUG in the template context, so {% if DEBUG %}
+        # is only folded to settings.DEBUG for templates which ask for it.
+        self.preprocess_ifdebug = False
         self.preprocess_macros = True
         self.preprocess_translations = True
         self.preprocess_urls = True
         self.preprocess_variables = True
+        self.prune_load_tags = True
         self.remove_block_tags = True # Should propably not be disabled
         self.remove_some_tags = True # As we lack a better settings name
         self.whitespace_compression = True
@@ -136,6 +171,11 @@ class Options(object):
         self.validate_html = True
         self.disallow_orphan_blocks = False # An error will be raised when a block has been defined, which is not present in the parent.
 
+        # Maximum size (in characters) of the inlined output of one included
+        # template (size x number of includes). Includes over this budget stay
+        # {% include %} tags. None means no limit.
+        self.include_inline_budget = getattr(settings, 'TEMPLATE_PREPROCESSOR_INCLUDE_INLINE_BUDGET', None)
+
     def change(self, value, node=None):
         """
         Change an option. Called when the template contains a {% ! ... %} option tag.
@@ -146,11 +186,15 @@ class Options(object):
             'disallow-orphan-blocks': ('disallow_orphan_blocks', True),
             'html': ('is_html', True), # Enable HTML extensions
             'html-remove-empty-class-attributes': ('remove_empty_class_attributes', True),
+            'ifdebug-preprocessing': ('preprocess_ifdebug', True),
             'merge-internal-css': ('merge_internal_css', True),
             'merge-internal-javascript': ('merge_internal_javascript', True),
+            'no-condition-preprocessing': ('preprocess_conditions', False),
             'no-disallow-orphan-blocks': ('disallow_orphan_blocks', False),
             'no-html': ('is_html', False), # Disable all HTML specific options
             'no-i18n-preprocessing': ('preprocess_translations', False),
+            'no-ifdebug-preprocessing': ('preprocess_ifdebug', False),
+            'no-load-tag-pruning': ('prune_load_tags', False),
             'no-macro-preprocessing': ('preprocess_macros', False),
             'no-pack-external-css': ('pack_external_css', False),
             'no-pack-external-javascript': ('pack_external_javascript', False),
@@ -162,8 +206,23 @@ class Options(object):
             'whitespace-compression': ('whitespace_compression', True),
         }
 
+        # Options with a value: {% ! name=value %}
+        value_actions = {
+            'include-inline-budget': ('include_inline_budget', lambda v: None if v == 'none' else int(v)),
+        }
+
         if value in actions:
             setattr(self, actions[value][0], actions[value][1])
+
+        elif '=' in value and value.split('=', 1)[0] in value_actions:
+            name, v = value.split('=', 1)
+            try:
+                setattr(self, value_actions[name][0], value_actions[name][1](v))
+            except ValueError, e:
+                if node:
+                    raise CompileException(node, 'Invalid value for template preprocessor option: %s' % value)
+                else:
+                    raise CompileException('Invalid value for template preprocessor option: %s (in settings.py)' % value)
         else:
             if node:
                 raise CompileException(node, 'No such template preprocessor option: %s' % value)
@@ -14,12 +14,17 @@ This parser will call the html/css/js parser if required.
 
 from django.conf import settings
 from django.template import TemplateDoesNotExist
-from django.utils.translation import ugettext as _, ungettext
+from django.utils import translation
+from django.utils.importlib import import_module
 
 from template_preprocessor.core.lexer import Token, State, StartToken, Shift, StopToken, Push, Pop, Error, Record, CompileException
 from template_preprocessor.core.preprocessable_template_tags import get_preprocessable_tags, NotPreprocessable
+from template_preprocessor.core.preprocess_variables import get_preprocess_variables
 from template_preprocessor.core.lexer_engine import nest_block_level_elements, tokenize
+from template_preprocessor.core.run_cache import RunCache
+from template_preprocessor.core.i18n import ungettext, translate_many
 import re
+from collections import OrderedDict
 from copy import deepcopy
 
 
@@ -300,6 +305,13 @@ class DjangoDecorateTag(DjangoContainer):
         handler(u'{%enddecorate%}')
 
 
+class NotLanguageNeutral(Exception):
+    """
+    Raised when a template can't be compiled once for all languages.
+    """
+    pass
+
+
 class NoLiteraleException(Exception):
     def __init__(self):
         Exception.__init__(self, 'Not a variable')
@@ -315,6 +327,128 @@ def _variable_to_literal(variable):
         raise NoLiteraleException()
 
 
+class NotConstant(Exception):
+    """
+    Raised when the value of an expression is not known at compile time.
+    """
+    pass
+
+
+_NUMBER_LITERAL = re.compile(r'^-?\d+(\.\d+)?$')
+_STRING_LITERAL = re.compile(r'^("[^"\\]*"|\'[^\'\\]*\')$')
+
+def _constant_value(expression, constants):
+    """
+    Value of a literal, or of a name in `constants`, like Django would resolve it.
+    (Literals with escape characters, filters, etc... are never constant.)
+    """
+    if _STRING_LITERAL.match(expression):
+        return expression[1:-1]
+    elif _NUMBER_LITERAL.match(expression):
+        return float(expression) if '.' in expression else int(expression)
+    elif expression in constants:
+        return constants[expression]
+    else:
+        raise NotConstant()
+
+
+_CONDITION_OPERATORS = {
+    '==': lambda x, y: x == y,
+    '!=': lambda x, y: x != y,
+    '<': lambda x, y: x < y,
+    '>': lambda x, y: x > y,
+    '<=': lambda x, y: x <= y,
+    '>=': lambda x, y: x >= y,
+    'in': lambda x, y: x in y,
+    'not in': lambda x, y: x not in y,
+}
+
+def _evaluate_condition(tokens, constants):
+    """
+    Evaluate the condition of an {% if %} tag the way Django's smart if does.
+    Raise NotConstant when the outcome is not known at compile time, or when
+    the condition is not a simple one. (Django will complain at runtime about
+    invalid conditions.)
+    """
+    # 'not' 'in' is one operator
+    tokens = list(tokens)
+    for i in range(len(tokens) - 1, 0, -1):
+        if tokens[i-1] == 'not' and tokens[i] == 'in':
+            tokens[i-1:i+1] = [ 'not in' ]
+
+    keywords = set(_CONDITION_OPERATORS.keys() + [ 'and', 'or', 'not' ])
+    position = [0]
+
+    def peek():
+        if position[0] < len(tokens):
+            return tokens[position[0]]
+
+    def pop():
+        token = peek()
+        position[0] += 1
+        return token
+
+    # Parse: or > and > not > comparison
+    def parse_or():
+        left = parse_and()
+        while peek() == 'or':
+            pop()
+            left = ('or', left, parse_and())
+        return left
+
+    def parse_and():
+        left = parse_not()
+        while peek() == 'and':
+            pop()
+            left = ('and', left, parse_not())
+        return left
+
+    def parse_not():
+        if peek() == 'not':
+            pop()
+            return ('not', parse_not())
+        else:
+            return parse_comparison()
+
+    def parse_comparison():
+        left = parse_value()
+        if peek() in _CONDITION_OPERATORS:
+            return (pop(), left, parse_value())
+        else:
+            return left
+
+    def parse_value():
+        token = pop()
+        if token is None or token in keywords:
+            raise NotConstant()
+        return ('value', token)
+
+    expression = parse_or()
+    if peek() is not None:
+        raise NotConstant()
+
+    # Evaluate. ('and' and 'or' don't evaluate the right hand side when the
+    # left hand side decides the outcome, so only that side has to be known.)
+    def evaluate(e):
+        if e[0] == 'value':
+            return _constant_value(e[1], constants)
+        elif e[0] == 'or':
+            return evaluate(e[1]) or evaluate(e[2])
+        elif e[0] == 'and':
+            return evaluate(e[1]) and evaluate(e[2])
+        elif e[0] == 'not':
+            return not evaluate(e[1])
+        else:
+            left, right = evaluate(e[1]), evaluate(e[2])
+            try:
+                return _CONDITION_OPERATORS[e[0]](left, right)
+            except Exception, ex:
+                # Django renders the else-branch for invalid comparisons
+                return False
+
+    return bool(evaluate(expression))
+
+
 class DjangoUrlTag(DjangoTag):
     """
     {% url name param1 param2 param3=value %}
@@ -550,6 +684,13 @@ class DjangoIfTag(DjangoContainer):
 
         handler(u'{%endif%}')
 
+    def evaluate(self, constants):
+        """
+        Outcome of the condition, when it's known at compile time.
+        Raise NotConstant otherwise.
+        """
+        return _evaluate_condition([ p.output_as_string() for p in self._params[1:] ], constants)
+
 
 class DjangoIfEqualTag(DjangoContainer):
     """
@@ -576,6 +717,14 @@ class DjangoIfEqualTag(DjangoContainer):
 
         handler(u'{%endifequal%}')
 
+    def evaluate(self, constants):
+        """
+        Outcome of the comparison, when it's known at compile time.
+        Raise NotConstant otherwise.
+        """
+        return (_constant_value(self._params[1].output_as_string(), constants) ==
+                    _constant_value(self._params[2].output_as_string(), constants))
+
 
 class DjangoBlockTag(DjangoContainer):
     """
@@ -737,6 +886,43 @@ def _find_first_level_dependencies(tree, context):
             context.remember_include(node.template_name)
 
 
+def _index_blocks(tree):
+    """
+    Walk once through the tree, and return:
+    - a list of all the {% block %} tags.
+    - a list of the {% block %} tags inside {{ block.super }} copies.
+    - a { name: block } dict of the blocks which are not inside {{ block.super }}
+      copies. (The last one wins.)
+    - a { block: [ variables ] } dict with the {{ block.super }} variables for
+      which this block is the innermost block.
+    """
+    blocks = []
+    copied_blocks = []
+    blocks_by_name = { }
+    block_supers = OrderedDict() # In order of appearance.
+
+    def walk(node, block, in_super):
+        for children in node.children_lists:
+            for c in children:
+                if isinstance(c, DjangoBlockTag):
+                    if in_super:
+                        copied_blocks.append(c)
+                    else:
+                        blocks.append(c)
+                        blocks_by_name[c.block_name] = c
+                    walk(c, c, in_super)
+
+                elif isinstance(c, DjangoVariable) and c.varname == 'block.super':
+                    if block is not None:
+                        block_supers.setdefault(block, []).append(c)
+
+                elif isinstance(c, Token):
+                    walk(c, block, in_super or isinstance(c, DjangoPreprocessedVariable))
+
+    walk(tree, None, False)
+    return blocks, copied_blocks, blocks_by_name, block_supers
+
+
 def _process_extends(tree, context):
     """
     {% extends ... %}
@@ -755,35 +941,39 @@ def _process_extends(tree, context):
                 break
 
         if base_tree:
-            base_tree_blocks = list(base_tree.child_nodes_of_class([ DjangoBlockTag ]))
-            tree_blocks = list(tree.child_nodes_of_class([ DjangoBlockTag ]))
+            base_tree_blocks, copied_blocks, base_tree_blocks_by_name = _index_blocks(base_tree)[:3]
+            tree_blocks_by_name, block_supers = _index_blocks(tree)[2:]
 
             # Retreive list of block tags in the outer scope of the child template.
             # These are the blocks which at least have to exist in the parent.
             outer_tree_blocks = filter(lambda b: isinstance(b, DjangoBlockTag), tree.children)
 
-            # For every {% block %} in the base tree
+            # Replace {{ block.super }} variables by a copy of the parent's
+            # block node's children. (Before these are replaced.)
+            for block, variables in block_supers.items():
+                if block is tree_blocks_by_name.get(block.block_name) and block.block_name in base_tree_blocks_by_name:
+                    for v in variables:
+                        v.__class__ = DjangoPreprocessedVariable
+                        v.init(deepcopy(base_tree_blocks_by_name[block.block_name].children[:]))
+
+                        # Blocks in this copy are overridden as well.
+                        blocks, blocks_in_copies = _index_blocks(v)[:2]
+                        copied_blocks += blocks + blocks_in_copies
+
+            # For every {% block %} in the base tree, replace all nodes with the
+            # nodes of the block with the same name in the current tree.
             for base_block in base_tree_blocks:
-                # Look for a block with the same name in the current tree
-                for block in tree_blocks[:]:
-                    if block.block_name == base_block.block_name:
-                        # Replace {{ block.super }} variable by the parent's
-                        # block node's children.
-                        block_dot_super = base_block.children
-
-                        for v in block.child_nodes_of_class([ DjangoVariable ]):
-                            if v.varname == 'block.super':
-                                # Found a {{ block.super }} declaration, deep copy
-                                # parent nodes in here
-                                v.__class__ = DjangoPreprocessedVariable
-                                v.init(deepcopy(block_dot_super[:]))
-
-                        # Replace all nodes in the base tree block, with this nodes
-                        base_block.children = block.children
-
-                        # Remove block from list
-                        if block in outer_tree_blocks:
-                            outer_tree_blocks.remove(block)
+                block = tree_blocks_by_name.get(base_block.block_name)
+                if block:
+                    base_block.children = block.children
+
+            # (The copies need their own nodes.)
+            for base_block in copied_blocks:
+                block = tree_blocks_by_name.get(base_block.block_name)
+                if block:
+                    base_block.children = deepcopy(block.children)
+
+            outer_tree_blocks = [ b for b in outer_tree_blocks if b.block_name not in base_tree_blocks_by_name ]
 
             # We shouldn't have any blocks left (if so, they don't have a match in the parent)
             if outer_tree_blocks:
@@ -811,25 +1001,104 @@ def _process_extends(tree, context):
 def _preprocess_includes(tree, context):
     """
     Look for all the {% include ... %} tags and replace it by their include.
+    Includes of which the inlined output (size x number of occurrences)
+    exceeds the include budget stay {% include %} tags.
     """
-    include_blocks = list(tree.child_nodes_of_class([ DjangoIncludeTag ]))
+    include_blocks = [ b for b in tree.child_nodes_of_class([ DjangoIncludeTag ]) if not b.template_name_is_variable ]
+    budget = context.options.include_inline_budget
 
+    counts = { }
     for block in include_blocks:
-        if not block.template_name_is_variable:
+        counts[block.template_name] = counts.get(block.template_name, 0) + 1
+
+    over_budget = set()
+
+    for block in include_blocks:
+        if block.template_name in over_budget:
+            continue
+
+        try:
+            # Parse include. (Its own includes are inlined as many times as
+            # this one.)
+            occurrences = context.include_occurrences * counts[block.template_name]
+            context.include_occurrences, parent_occurrences = occurrences, context.include_occurrences
             try:
-                # Parse include
                 include_tree = context.load(block.template_name)
+            finally:
+                context.include_occurrences = parent_occurrences
+
+            if budget is not None and _can_stay_runtime_include(include_tree) and \
+                        len(include_tree.output_as_string()) * occurrences > budget:
+                over_budget.add(block.template_name)
+                continue
+
+            # Move tree from included file into {% include %}
+            block.__class__ = DjangoPreprocessedInclude
+            block.init([ include_tree ], block.with_params)
+
+            block.path = include_tree.path
+            block.line = include_tree.line
+            block.column = include_tree.column
+
+        except TemplateDoesNotExist, e:
+            raise CompileException(block, 'Template in {%% include %%} tag not found (%s)' % block.template_name)
+
+
+def _can_stay_runtime_include(tree):
+    """
+    True when nothing in this included tree changes the template which
+    includes it: no macros, no {% block %} tags (which an extending template
+    or {% decorate %} can override) and no {% ! ... %} options.
+    """
+    return not any(tree.child_nodes_of_class([ DjangoMacroTag, DjangoCallMacroTag,
+                    DjangoBlockTag, DjangoPreprocessorConfigTag ]))
+
+
+def _apply_include_budget(tree, budget):
+    """
+    Turn the inlined {% include %} tags back into runtime includes, for the
+    templates of which the inlined output (size x number of occurrences)
+    exceeds the budget. At runtime, these load the separately compiled
+    template. (The budget is mostly enforced by `_preprocess_includes`, this
+    catches includes in macros, which count once for every call of this
+    macro, and budgets set by {% ! ... %} options in the template. To be
+    called before the macros are expanded.)
+    """
+    macro_calls = { }
+    for call in tree.child_nodes_of_class([ DjangoCallMacroTag ]):
+        macro_calls[call.macro_name] = macro_calls.get(call.macro_name, 0) + 1
+
+    includes = { } # template_name -> [ (node, size x occurrences) ]
+    not_revertible = set()
+
+    def walk(node, occurrences):
+        # Return the size of this subtree
+        size = 0
+
+        for c in node.all_children:
+            if isinstance(c, basestring):
+                size += len(c)
 
-                # Move tree from included file into {% include %}
-                block.__class__ = DjangoPreprocessedInclude
-                block.init([ include_tree ], block.with_params)
+            elif isinstance(c, Token):
+                if isinstance(c, DjangoMacroTag):
+                    size += walk(c, occurrences * macro_calls.get(c.macro_name, 0))
+                else:
+                    size += walk(c, occurrences)
+
+        if isinstance(node, DjangoPreprocessedInclude):
+            includes.setdefault(node.template_name, []).append((node, size * occurrences))
+            if not _can_stay_runtime_include(node):
+                not_revertible.add(node.template_name)
+
+        return size
 
-                block.path = include_tree.path
-                block.line = include_tree.line
-                block.column = include_tree.column
+    walk(tree, 1)
 
-            except TemplateDoesNotExist, e:
-                raise CompileException(block, 'Template in {%% include %%} tag not found (%s)' % block.template_name)
+    for template_name, nodes in includes.items():
+        if template_name not in not_revertible and sum(s for n, s in nodes) > budget:
+            for node, s in nodes:
+                node.__class__ = DjangoIncludeTag
+                node.children = []
 
 
 def _preprocess_decorate_tags(tree, context):
@@ -866,7 +1135,7 @@ def _group_all_loads(tree):
     """
     Look for all {% load %} tags, and group them to one, on top.
     """
-    all_modules = set()
+    all_modules = [] # In order of appearance, for a deterministic output.
     first_load_tag = None
 
     # Collect all {% load %} nodes.
@@ -879,14 +1148,15 @@ def _group_all_loads(tree):
                 first_load_tag = load_tag
 
             for l in load_tag.modules:
-                all_modules.add(l)
+                if l not in all_modules:
+                    all_modules.append(l)
 
     # Remove all {% load %} nodes
     tree.remove_child_nodes_of_class(DjangoLoadTag)
 
     # Place all {% load %} in the first node of the tree
     if first_load_tag:
-        first_load_tag.modules = list(all_modules)
+        first_load_tag.modules = all_modules
         tree.children.insert(0, first_load_tag)
 
         # But {% extends %} really needs to be placed before everything else
@@ -897,15 +1167,156 @@ def _group_all_loads(tree):
         for e in extends_tags:
             tree.children.insert(0, e)
 
-def _preprocess_urls(tree):
+_libraries = RunCache()
+
+def _get_library_contents(module):
+    """
+    Return the set of tag and filter names which this template library
+    provides, or None when the library can't be loaded.
+    """
+    if module not in _libraries:
+        try:
+            from django.template.base import get_library, InvalidTemplateLibrary
+        except ImportError, e:
+            # Django 1.2
+            from django.template import get_library, InvalidTemplateLibrary
+
+        try:
+            library = get_library(module)
+            _libraries[module] = set(library.tags.keys()) | set(library.filters.keys())
+        except InvalidTemplateLibrary, e:
+            _libraries[module] = None
+
+    return _libraries[module]
+
+
+def _get_builtin_tags():
+    """
+    Return the set of tag names which Django provides without {% load %}.
+    """
+    try:
+        from django.template.base import builtins
+    except ImportError, e:
+        # Django 1.2
+        from django.template import builtins
+
+    result = set()
+    for library in builtins:
+        result |= set(library.tags.keys())
+    return result
+
+
+def _prune_load_tags(tree):
+    """
+    Remove the libraries from the {% load %} tags of which no tag or filter
+    is used anymore in the compiled template. Libraries which can't be loaded
+    here are kept.
+    """
+    modules = _get_used_load_modules(tree)
+
+    for load_tag in modules:
+        load_tag.modules = modules[load_tag]
+
+    tree.remove_child_nodes([ t for t in modules if not t.modules ])
+
+
+def _output_with_pruned_load_tags(tree):
+    """
+    Output of the tree after _prune_load_tags, without modifying the tree.
+    """
+    modules = _get_used_load_modules(tree)
+
+    def output_load_tag(load_tag):
+        if load_tag not in modules:
+            return load_tag.output_as_string()
+        elif modules[load_tag]:
+            return u'{%% load %s%%}' % u' '.join(modules[load_tag])
+        else:
+            return u''
+
+    return tree.output_as_string(hook_dict={ DjangoLoadTag: output_load_tag })
+
+
+def _get_used_load_modules(tree):
+    """
+    Return a { load tag: libraries to keep } dict, for the {% load %} tags
+    which can be pruned. (Not {% load ... from ... %}.)
+    """
+    load_tags = [ t for t in tree.child_nodes_of_class([ DjangoLoadTag ])
+                        if not 'from' in t.modules ]
+    if not load_tags:
+        return { }
+
+    # Look at the output, HTML nodes keep template tags in places where
+    # child_nodes_of_class doesn't enter.
+    output = tree.output_as_string(hook_dict={ DjangoLoadTag: lambda t: u'' })
+
+    used = set(re.findall(r'\{%\s*([^\s%]+)', output))
+    for code in re.findall(r'\{\{.*?\}\}|\{%.*?%\}', output, re.DOTALL):
+        used.update(re.findall(r'\|\s*(\w+)', code))
+
+        # {% filter name|name2 %}
+        if re.match(r'\{%\s*filter\s', code):
+            used.update(re.findall(r'\w+', code))
+
+    return dict((load_tag, [ m for m in load_tag.modules
+                    if _get_library_contents(m) is None or _get_library_contents(m) & used ])
+                    for load_tag in load_tags)
+
+
+def _get_url_reverser():
+    """
+    Return the function for reversing URLs, settings.TEMPLATE_PREPROCESSOR_URL_REVERSER
+    (a dotted path) or Django's reverse.
+    """
+    path = getattr(settings, 'TEMPLATE_PREPROCESSOR_URL_REVERSER', None)
+
+    if path:
+        module, attr = path.rsplit('.', 1)
+        return getattr(import_module(module), attr)
+    else:
+        # Do 'reverse' import at this point. To be sure we use the
+        # latest version. Other Django plug-ins like localeurl tend
+        # to monkey patch this code.
+        from django.core.urlresolvers import reverse
+        return reverse
+
+
+# (urlconf, language, script prefix, reverser, name, args, kwargs) -> URL or NoReverseMatch
+_reverse_cache = RunCache()
+
+def _cached_reverse(reverse, name, args, kwargs):
+    """
+    Call reverse, but only once for every URL in a compile run.
+    """
+    from django.core.urlresolvers import NoReverseMatch, get_urlconf, get_script_prefix
+
+    if not getattr(settings, 'TEMPLATE_PREPROCESSOR_CACHE_URLS', True):
+        return reverse(name, args=args, kwargs=kwargs)
+
+    key = (get_urlconf(), translation.get_language(), get_script_prefix(), reverse,
+                    name, tuple(args), tuple(sorted(kwargs.items())))
+
+    result = _reverse_cache.get(key)
+
+    if result is None:
+        try:
+            result = reverse(name, args=args, kwargs=kwargs)
+        except NoReverseMatch, e:
+            result = e
+        _reverse_cache[key] = result
+
+    if isinstance(result, NoReverseMatch):
+        raise result
+    return result
+
+
+def _preprocess_urls(tree, url_tags=None):
     """
     Replace URLs without variables by their resolved value.
     """
-    # Do 'reverse' import at this point. To be sure we use the
-    # latest version. Other Django plug-ins like localeurl tend
-    # to monkey patch this code.
     from django.core.urlresolvers import NoReverseMatch
-    from django.core.urlresolvers import reverse
+    reverse = _get_url_reverser()
 
     def parse_url_params(urltag):
         if not urltag.url_params:
@@ -925,11 +1336,14 @@ def _preprocess_urls(tree):
 
         return name, args, kwargs
 
-    for urltag in tree.child_nodes_of_class([ DjangoUrlTag ]):
+    if url_tags is None:
+        url_tags = tree.child_nodes_of_class([ DjangoUrlTag ])
+
+    for urltag in url_tags:
         try:
             name, args, kwargs = parse_url_params(urltag)
             if not 'as' in args:
-                result = reverse(name, args=args, kwargs=kwargs)
+                result = _cached_reverse(reverse, name, args, kwargs)
                 urltag.preprocess(result)
         except NoReverseMatch, e:
             pass
@@ -954,7 +1368,198 @@ def _preprocess_variables(tree, values_dict):
                 #          and 'resolve' is only be used for variables
                 #          like MEDIA_URL which are safe in HTML.
 
-def _preprocess_trans_tags(tree):
+def _with_bindings(params):
+    """
+    Return a list of (name, value) tuples for the parameters of a {% with %} tag:
+    {% with value as name %} or {% with name=value name2=value2 %}
+    Return None when the parameters can't be parsed.
+    """
+    if len(params) == 3 and params[1] == 'as':
+        return [ (params[2], params[0]) ]
+
+    bindings = []
+    for p in params:
+        m = re.match(r'^(\w+)=(.+)$', p)
+        if not m:
+            return None
+        bindings.append(m.groups())
+
+    return bindings or None
+
+
+def _mentions_name(node, name):
+    """
+    True when this node (or one of its children) is a template tag which uses
+    this name. (e.g. {% for name in ... %} could bind it to another value.)
+    {% if %}, {% ifequal %} and {% with %} tags and variables don't count,
+    these are handled by the folding itself.
+    """
+    if isinstance(node, (DjangoContainer, DjangoContent)):
+        return any(_mentions_name(c, name) for c in node.all_children)
+
+    elif isinstance(node, DjangoVariable) or (
+                isinstance(node, DjangoTag) and node.tagname in ('with', 'endwith')):
+        return False
+
+    elif isinstance(node, Token):
+        return bool(re.search(r'\b%s\b' % re.escape(name), node.output_as_string()))
+
+    else:
+        return False
+
+
+def _fold_constant_conditions(tree, constants):
+    """
+    Replace {% if %} and {% ifequal %} tags of which the outcome is known at
+    compile time by the branch which would be rendered.
+    `constants` is a { name: value } dict of the variables which are known
+    at compile time. {% with %} tags which give a literal a name, add this
+    name to the constants in their scope, and are removed when nothing uses
+    this name anymore.
+    """
+    django_syntax = re.compile(r'\{\{.*?\}\}|\{%.*?%\}', re.DOTALL)
+
+    def bind(constants, bindings, scope):
+        # Constants in the scope of a {% with %} tag.
+        if bindings is None:
+            return { }
+
+        result = dict(constants)
+        for name, value in bindings:
+            result.pop(name, None)
+            try:
+                value = _constant_value(value, constants)
+                if not any(_mentions_name(n, name) for n in scope):
+                    result[name] = value
+            except NotConstant, e:
+                pass
+        return result
+
+    builtin_tags = _get_builtin_tags()
+
+    def sees_context(node):
+        # A runtime {% include %}, a {% callmacro %} (macros are only expanded
+        # after folding) and custom tags can use every name in the context.
+        # Intermediate and end tags of block tags are not in the builtins.
+        if isinstance(node, (DjangoIncludeTag, DjangoCallMacroTag)):
+            return True
+        return (type(node) == DjangoTag and node.tagname not in builtin_tags and
+                    not node.tagname.startswith('end') and
+                    node.tagname not in ('else', 'empty', 'elif', 'plural'))
+
+    def is_used(nodes, names):
+        if any(isinstance(n, Token) and (sees_context(n) or any(sees_context(c) for c in n.child_nodes_of_class([ Token ])))
+                    for n in nodes):
+            return True
+
+        output = u''.join(n.output_as_string() if isinstance(n, Token) else n for n in nodes)
+        return any(re.search(r'\b%s\b' % re.escape(name), ' '.join(django_syntax.findall(output)))
+                                for name in names)
+
+    def find_endwith(nodes, start):
+        depth = 0
+        for i in range(start, len(nodes)):
+            if isinstance(nodes[i], DjangoTag) and nodes[i].tagname == 'with':
+                depth += 1
+            elif isinstance(nodes[i], DjangoTag) and nodes[i].tagname == 'endwith':
+                if depth == 0:
+                    return i
+                depth -= 1
+
+    def fold(node, constants):
+        for children in node.children_lists:
+            children.__init__(fold_list(children, constants))
+
+    def fold_list(nodes, constants):
+        result = []
+        i = 0
+
+        while i < len(nodes):
+            c = nodes[i]
+            i += 1
+
+            if isinstance(c, (DjangoIfTag, DjangoIfEqualTag)):
+                try:
+                    # Don't know how to handle {% elif %}
+                    if any(isinstance(n, DjangoTag) and n.tagname == 'elif' for n in c.children):
+                        raise NotConstant()
+
+                    outcome = c.evaluate(constants)
+                except NotConstant, e:
+                    fold(c, constants)
+                    result.append(c)
+                else:
+                    branches = list(c.children_lists)
+                    rendered = branches[0] if outcome else (branches[1] if len(branches) > 1 else [])
+
+                    # {% load %} is executed at parse time, also in branches
+                    # which are never rendered.
+                    for branch in branches:
+                        if branch is not rendered:
+                            for n in branch:
+                                if isinstance(n, DjangoLoadTag):
+                                    result.append(n)
+                                elif isinstance(n, Token):
+                                    result += n.child_nodes_of_class([ DjangoLoadTag ])
+
+                    result += fold_list(rendered, constants)
+
+            elif isinstance(c, DjangoTag) and c.tagname == 'with':
+                bindings = _with_bindings(c.args)
+                end = find_endwith(nodes, i)
+
+                if end is None:
+                    # Can't see the scope of this {% with %}, forget
+                    # the names it binds from here.
+                    if bindings is None:
+                        constants = { }
+                    else:
+                        constants = dict((k, v) for k, v in constants.items()
+                                            if k not in [ n for n, v2 in bindings ])
+                    result.append(c)
+                else:
+                    scope = nodes[i:end]
+                    inner_constants = bind(constants, bindings, scope)
+                    scope = fold_list(scope, inner_constants)
+
+                    if bindings and all(n in inner_constants for n, v in bindings) and \
+                                not is_used(scope, [ n for n, v in bindings ]):
+                        result += scope
+                    else:
+                        result += [ c ] + scope + [ nodes[end] ]
+                    i = end + 1
+
+            elif isinstance(c, DjangoVariable) and isinstance(constants.get(c.varname), basestring) and \
+                        not '{' in constants[c.varname] and not '}' in constants[c.varname]:
+                # {{ name }} for a string literal. (Django marks these safe.)
+                value = constants[c.varname]
+                c.__class__ = DjangoPreprocessedVariable
+                c.init([ value ])
+                result.append(c)
+
+            elif isinstance(c, DjangoPreprocessedInclude):
+                if c.with_params:
+                    fold(c, bind(constants, _with_bindings([ p.output_as_string() for p in c.with_params ]), c.children))
+                else:
+                    fold(c, constants)
+                result.append(c)
+
+            elif isinstance(c, (DjangoContainer, DjangoContent)):
+                fold(c, constants)
+                result.append(c)
+
+            else:
+                result.append(c)
+
+        return result
+
+    # With a runtime {% extends %}, Django would still look for blocks in
+    # the branches which are not rendered.
+    if not any(tree.child_nodes_of_class([ DjangoExtendsTag ])):
+        fold(tree, constants)
+
+
+def _preprocess_trans_tags(tree, trans_tags=None):
     """
     Replace {% trans %} and {% blocktrans %} if they don't depend on variables.
     """
@@ -976,13 +1581,23 @@ def _preprocess_trans_tags(tree):
             return True
 
 
-    for trans in tree.child_nodes_of_class([ DjangoTransTag, DjangoBlocktransTag ]):
+    if trans_tags is None:
+        trans_tags = tree.child_nodes_of_class([ DjangoTransTag, DjangoBlocktransTag ])
+
+    # Translate all strings of this template at once.
+    # (or ' ', because we don't want to translate the empty string which returns PO meta info.)
+    trans_tags = list(trans_tags)
+    translations = translate_many(
+            [ t.translation_info.string or ' ' for t in trans_tags if isinstance(t, DjangoBlocktransTag) and process_blocktrans(t) ] +
+            [ t.string or ' ' for t in trans_tags if isinstance(t, DjangoTransTag) and not t.is_variable ])
+
+    for trans in trans_tags:
         # Process {% blocktrans %}
         if isinstance(trans, DjangoBlocktransTag) and process_blocktrans(trans):
             translation_info = trans.translation_info
 
             # Translate strings
-            string = _(translation_info.string or ' ') # or ' ', because we don't want to translate the empty string which returns PO meta info.
+            string = translations[translation_info.string or ' ']
             if translation_info.has_plural:
                 plural_string = ungettext(translation_info.string, translation_info.plural_string, 2)
 
@@ -1024,7 +1639,7 @@ def _preprocess_trans_tags(tree):
         # Process {% trans "..." %}
         elif isinstance(trans, DjangoTransTag):
             if not trans.is_variable:
-                output = _(trans.string or ' ')
+                output = translations[trans.string or ' ']
                 translation_info = trans.translation_info
                 trans.__class__ = DjangoTranslated
                 trans.init(output, translation_info)
@@ -1052,17 +1667,24 @@ def _preprocess_macros(tree):
 def _execute_preprocessable_tags(tree):
     preprocessable_tags = get_preprocessable_tags()
 
-    for c in tree.all_children:
-        if isinstance(c, DjangoTag) and c.tagname in preprocessable_tags:
-            params = [ p.output_as_string() for p in c.get_childnodes_with_name('django-tag-element') ]
-            try:
-                c.children = [ preprocessable_tags[c.tagname](*params) ]
-                c.__class__ = DjangoContent
-            except NotPreprocessable:
-                pass
+    def execute(node):
+        for c in node.all_children:
+            if isinstance(c, DjangoTag):
+                tagname = c.tagname
 
-        elif isinstance(c, DjangoContainer):
-            _execute_preprocessable_tags(c)
+                if tagname in preprocessable_tags:
+                    # (The tag name is passed as the first argument.)
+                    params = [ tagname ] + c.args
+                    try:
+                        c.children = [ preprocessable_tags[tagname](*params) ]
+                        c.__class__ = DjangoContent
+                    except NotPreprocessable:
+                        pass
+
+            elif isinstance(c, DjangoContainer):
+                execute(c)
+
+    execute(tree)
 
 
 def remember_gettext_entries(tree, context):
@@ -1085,9 +1707,6 @@ def remember_gettext_entries(tree, context):
 
 
 
-from template_preprocessor.core.html_processor import compile_html
-
-
 def parse(source_code, path, context, main_template=False):
     """
     Parse the code.
@@ -1115,7 +1734,7 @@ def parse(source_code, path, context, main_template=False):
 
     # === Actions ===
 
-    if main_template:
+    if main_template and not context.lean:
         _find_first_level_dependencies(tree, context)
 
     # Extend parent template and process includes
@@ -1131,40 +1750,43 @@ def parse(source_code, path, context, main_template=False):
         _update_preprocess_settings(tree, context)
         options = context.options
 
+        # External media and debug symbols are compiled for each language.
+        if context.language_neutral and (options.pack_external_javascript or
+                    options.pack_external_css or context.insert_debug_symbols):
+            raise NotLanguageNeutral('Packing of external media and debug symbols are language dependent.')
+
         # Remember translations in context (form PO-file generation)
-        remember_gettext_entries(tree, context)
+        if not context.lean:
+            remember_gettext_entries(tree, context)
+
+        # Keep big, often included templates as runtime includes. (Before
+        # the folding, which should see which names these includes can use.)
+        if options.include_inline_budget is not None:
+            _apply_include_budget(tree, options.include_inline_budget)
+
+        # Drop the branches of {% if %} tags which are never rendered
+        if options.preprocess_conditions:
+            constants = { }
+            if options.preprocess_variables:
+                constants.update(get_preprocess_variables())
+            # Only with {% ! ifdebug-preprocessing %}: without it, DEBUG is
+            # an ordinary context variable.
+            if options.preprocess_ifdebug:
+                constants['DEBUG'] = settings.DEBUG
+
+            _fold_constant_conditions(tree, constants)
 
         # Do translations
-        if options.preprocess_translations:
+        if options.preprocess_translations and not context.language_neutral:
             _preprocess_trans_tags(tree)
 
         # Reverse URLS
-        if options.preprocess_urls:
+        if options.preprocess_urls and not context.language_neutral:
             _preprocess_urls(tree)
 
         # Do variable lookups
         if options.preprocess_variables:
-            sites_enabled = 'django.contrib.sites' in settings.INSTALLED_APPS
-
-            _preprocess_variables(tree,
-                        {
-                            'MEDIA_URL': getattr(settings, 'MEDIA_URL', ''),
-                            'STATIC_URL': getattr(settings, 'STATIC_URL', ''),
-                        })
-            if sites_enabled:
-                from django.contrib.sites.models import Site
-                try:
-                    # Don't preprocess anything when we don't have a Site
-                    # instance yet.
-                    site = Site.objects.get_current()
-                    _preprocess_variables(tree,
-                            {
-                                'SITE_DOMAIN': site.domain,
-                                'SITE_NAME': site.name,
-                                'SITE_URL': 'http://%s' % site.domain,
-                            })
-                except Site.DoesNotExist, e:
-                    pass
+            _preprocess_variables(tree, get_preprocess_variables())
 
         # Don't output {% block %} tags in the compiled file.
         if options.remove_block_tags:
@@ -1182,7 +1804,51 @@ def parse(source_code, path, context, main_template=False):
         if options.execute_preprocessable_tags:
             _execute_preprocessable_tags(tree)
 
+        # Remember the language dependent nodes for `specialize`. (The HTML
+        # compiler moves some of them out of the reach of child_nodes_of_class,
+        # e.g. into the attributes of HtmlTagPair.open_tag.)
+        if context.language_neutral:
+            tree.language_dependent_nodes = list(tree.child_nodes_of_class([
+                            DjangoTransTag, DjangoBlocktransTag, DjangoUrlTag ]))
+
         # HTML compiler
+        # (Only imported when required, templates compiled with no-html don't
+        # need the HTML, javascript and CSS grammars.)
         if options.is_html:
+            from template_preprocessor.core.html_processor import compile_html
+
+            # (Pruned like the output of a compilation with no-html.)
+            if context.keep_output_before_html:
+                if options.prune_load_tags:
+                    context.output_before_html = _output_with_pruned_load_tags(tree)
+                else:
+                    context.output_before_html = tree.output_as_string()
+
             compile_html(tree, context)
+
+        # Don't let Django import template libraries which are not used
+        if options.prune_load_tags:
+            _prune_load_tags(tree)
+
     return tree
+
+
+def specialize(tree, context):
+    """
+    Apply the language dependent actions on a tree which was parsed with a
+    language neutral context: translations, URLs (these can be language
+    dependent as well) and gettext in javascript. The tree is modified, so
+    call this on a copy.
+    """
+    options = context.options
+    nodes = tree.language_dependent_nodes
+
+    if options.preprocess_translations:
+        _preprocess_trans_tags(tree, [ n for n in nodes if isinstance(n, (DjangoTransTag, DjangoBlocktransTag)) ])
+
+    if options.preprocess_urls:
+        _preprocess_urls(tree, [ n for n in nodes if isinstance(n, DjangoUrlTag) ])
+
+    if options.is_html:
+        from template_preprocessor.core.html_processor import specialize_html
+        specialize_html(tree, context)
@@ -17,12 +17,14 @@ from template_preprocessor.core.lexer import State, StartToken, Push, Record, Sh
 from template_preprocessor.core.lexer_engine import tokenize, nest_block_level_elements
 from template_preprocessor.core.utils import check_external_file_existance, is_remote_url
 
+from collections import OrderedDict
 from copy import deepcopy
 from django.conf import settings
-from django.utils.translation import ugettext as _, ungettext
+from template_preprocessor.core.i18n import ugettext as _, ungettext
 
 import codecs
 import os
+import re
 import string
 
 
@@ -274,7 +276,7 @@ class HtmlCDATA(HtmlNode):
 class HtmlTag(HtmlNode):
     @property
     def html_attributes(self):
-        attributes = {}
+        attributes = OrderedDict()
 
         for a in self.child_nodes_of_class([ HtmlTagAttribute ]):
             attributes[a.attribute_name] = a.attribute_value
@@ -456,7 +458,8 @@ class HtmlScriptNode(HtmlNode):
     html_tagname = 'script'
     def process_params(self, params):
         # Create dictionary of key/value pairs for this script node
-        self.__attrs = { }
+        # (Ordered, the attributes are written in the original order.)
+        self.__attrs = OrderedDict()
         for p in params:
             if isinstance(p, HtmlTagAttribute):
                 key = list(p.child_nodes_of_class([ HtmlTagAttributeName ]))[0]
@@ -941,13 +944,20 @@ def _check_for_unmatched_closing_html_tags(tree):
 # ==================================[  Advanced script/css manipulations ]================================
 
 
-from django.conf import settings
 from django.core.urlresolvers import reverse
-from template_preprocessor.core.css_processor import compile_css
-from template_preprocessor.core.js_processor import compile_javascript
 
-MEDIA_URL = settings.MEDIA_URL
-STATIC_URL = getattr(settings, 'STATIC_URL', '')
+
+def _is_packable_url(source):
+    """
+    True for URLs starting with the MEDIA_URL or STATIC_URL, and remote URLs.
+    (Settings are read here, not at import time.)
+    """
+    media_url = settings.MEDIA_URL
+    static_url = getattr(settings, 'STATIC_URL', '')
+
+    return ((media_url and source.startswith(media_url)) or
+            (static_url and source.startswith(static_url)) or
+            is_remote_url(source))
 
 
 
@@ -979,9 +989,7 @@ def _pack_external_javascript(tree, context):
         for script in compress_tag.child_nodes_of_class([ HtmlScriptNode ]):
             if script.is_external:
                 source = script.script_source
-                if ((MEDIA_URL and source.startswith(MEDIA_URL)) or
-                        (STATIC_URL and source.startswith(STATIC_URL)) or
-                        is_remote_url(source)):
+                if _is_packable_url(source):
                     # Add to list
                     scripts_in_pack.append(source)
                     check_external_file_existance(script, source)
@@ -1000,9 +1008,7 @@ def _pack_external_javascript(tree, context):
                 #   this is required because we are removing childs from the list here.
                 if script.is_external:
                     source = script.script_source
-                    if ((MEDIA_URL and source.startswith(MEDIA_URL)) or
-                                (STATIC_URL and source.startswith(STATIC_URL)) or
-                                is_remote_url(source)):
+                    if _is_packable_url(source):
                         if first:
                             # Replace source
                             script.script_source = new_script_url
@@ -1033,9 +1039,7 @@ def _pack_external_css(tree, context):
         for tag in compress_tag.child_nodes_of_class([ HtmlTag ]):
             if is_external_css_tag(tag):
                 source = tag.get_html_attribute_value_as_string('href')
-                if ((MEDIA_URL and source.startswith(MEDIA_URL)) or
-                        (STATIC_URL and source.startswith(STATIC_URL)) or
-                        is_remote_url(source)):
+                if _is_packable_url(source):
                     # Add to list
                     css_in_pack.append( { 'tag': tag, 'source': source } )
                     check_external_file_existance(tag, source)
@@ -1114,7 +1118,8 @@ def _insert_debug_symbols(tree, context):
             head_node = tag
 
     # Give every node a debug reference
-    tag_references = { }
+    # (Ordered, for applying them in order of appearance.)
+    tag_references = OrderedDict()
 
     def create_references():
         ref_counter = [0]
@@ -1171,7 +1176,7 @@ def _insert_debug_symbols(tree, context):
             if isinstance(tag, HtmlTag):
                 o = [{ 'type': 'html-tag', 'content': o }]
 
-            apply_source_list.append((tag, json.dumps(o)))
+            apply_source_list.append((tag, json.dumps(o, sort_keys=True)))
 
         for tag, source in apply_source_list:
             if isinstance(tag, HtmlTagPair):
@@ -1263,8 +1268,115 @@ def compile_html(tree, context):
 
     # Parse HTML code in parse tree (Note that we don't enter DjangoRawTag)
     tokenize(tree, __HTML_STATES, [DjangoContent], [DjangoContainer ])
+
+    # (Before the processing, which removes comments, etc...)
+    if context.language_neutral and context.options.preprocess_translations:
+        _locate_translations(tree)
+
     _process_html_tree(tree, context)
 
+    if context.language_neutral and context.options.preprocess_translations:
+        _check_language_neutral(tree)
+
+
+def _check_language_neutral(tree):
+    """
+    Translations inside javascript, CSS or preformatted text need to be
+    compiled together with the surrounding code, which is not possible when
+    they are inserted afterwards.
+    """
+    for node in tree.child_nodes_of_class([ HtmlScriptNode, HtmlStyleNode, HtmlPreNode, HtmlTextareaNode ]):
+        for trans in node.child_nodes_of_class([ DjangoTransTag, DjangoBlocktransTag ]):
+            raise NotLanguageNeutral('Translation inside <%s> (line %s, column %s)' %
+                                    (node.html_tagname, trans.line, trans.column))
+
+
+def _locate_translations(tree):
+    """
+    Remember for every translation where it lands in the HTML (text, quoted
+    attribute value, comment), so that `specialize_html` can check whether
+    the translated text fits in there.
+    """
+    parents = []
+
+    def get_html_context(trans):
+        # (By token name, the HTML nodes don't have their classes yet.)
+        for node in reversed(parents):
+            if node.name == 'html-tag-attribute-value':
+                quote = node.children[0] if node.children else None
+                if quote in ('"', "'"):
+                    return quote
+                else:
+                    raise NotLanguageNeutral('Translation in unquoted attribute value (line %s, column %s)' %
+                                    (trans.line, trans.column))
+
+            elif node.name in ('html-tag', 'html-end-tag', 'html-doctype'):
+                raise NotLanguageNeutral('Translation inside HTML tag (line %s, column %s)' %
+                                    (trans.line, trans.column))
+
+            elif node.name == 'html-comment':
+                return 'comment'
+
+            elif node.name == 'html-cdata':
+                return 'cdata'
+
+        return 'text'
+
+    def handler(node):
+        if isinstance(node, (DjangoTransTag, DjangoBlocktransTag)):
+            node.html_context = get_html_context(node)
+
+        elif isinstance(node, Token):
+            parents.append(node)
+            node.output(handler)
+            parents.pop()
+
+    tree.output(handler)
+
+
+# What a translation can contain, according to where it lands. (What the
+# HTML lexer accepts there.)
+_TRANSLATION_PATTERNS = {
+    'text': re.compile(r'^([^<>&]|&[#a-zA-Z0-9]+;)*$'),
+    '"': re.compile(r'^([^"&]|&[#a-zA-Z0-9]+;)*$'),
+    "'": re.compile(r"^([^'&]|&[#a-zA-Z0-9]+;)*$"),
+    'comment': re.compile(r'^((?!-->).)*$', re.DOTALL),
+    'cdata': re.compile(r'^((?!\]\]>).)*$', re.DOTALL),
+}
+
+
+def specialize_html(tree, context):
+    """
+    Language dependent part of the HTML compiler, for trees which were
+    compiled with a language neutral context.
+    """
+    options = context.options
+
+    for node in tree.language_dependent_nodes:
+        # (Translations which don't appear in the output have no html_context.)
+        html_context = getattr(node, 'html_context', None)
+
+        if isinstance(node, DjangoTranslated) and html_context:
+            text = node.output_as_string()
+
+            # Translations containing HTML, quotes in a quoted attribute, ...
+            # should have been parsed together with the rest of the template.
+            if not _TRANSLATION_PATTERNS[html_context].match(text):
+                raise NotLanguageNeutral("Translation doesn't fit in the HTML (line %s, column %s)" %
+                                    (node.line, node.column))
+
+            if options.whitespace_compression and html_context == 'text':
+                node.children = [ re.sub(r'\s+', ' ', text) ]
+
+    # Translate gettext(...) in javascript. (The entries have been remembered
+    # in the language neutral phase, this is done for every language.)
+    if options.compile_javascript:
+        from template_preprocessor.core.js_processor import _process_gettext
+
+        for js_node in tree.child_nodes_of_class([ HtmlScriptNode ]):
+            if not js_node.is_external:
+                _process_gettext(js_node, context, remember=False)
+
 
 def _process_html_tree(tree, context):
     options = context.options
@@ -1330,7 +1442,10 @@ def _process_html_tree(tree, context):
         _pack_external_css(tree, context)
 
     # Compile javascript
+    # (The javascript and CSS processors are only imported when they're used.)
     if options.compile_javascript:
+        from template_preprocessor.core.js_processor import compile_javascript
+
         for js_node in tree.child_nodes_of_class([ HtmlScriptNode ]):
             if not js_node.is_external:
                 #print 'compiling'
@@ -1339,6 +1454,8 @@ def _process_html_tree(tree, context):
 
     # Compile CSS
     if options.compile_css:
+        from template_preprocessor.core.css_processor import compile_css
+
         # Document-level CSS
         for css_node in tree.child_nodes_of_class([ HtmlStyleNode ]):
             compile_css(css_node, context)
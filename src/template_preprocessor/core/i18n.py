@@ -0,0 +1,78 @@
+"""
+Author: Jonathan Slenders, City Live
+"""
+
+"""
+Translation memo for the preprocessor.
+-----------------------------------------------
+
+The same strings are translated in nearly every template. We remember the
+translations per language, for as long as the active catalog stays the same
+object. (Django creates a new one when the catalogs are reloaded.)
+"""
+
+from django.conf import settings
+from django.utils import translation
+
+from template_preprocessor.core.run_cache import RunCache
+
+
+# language -> (catalog, { msgid: translation }, { (singular, plural, number): translation })
+_memos = RunCache()
+
+
+def _get_memo():
+    language = translation.get_language()
+
+    if settings.USE_I18N:
+        from django.utils.translation import trans_real
+        catalog = trans_real.catalog()
+    else:
+        catalog = None
+
+    memo = _memos.get(language)
+
+    if memo is None or memo[0] is not catalog:
+        memo = _memos[language] = (catalog, { }, { })
+
+    return memo
+
+
+def ugettext(message):
+    """
+    Same as django.utils.translation.ugettext, but memoized.
+    """
+    translations = _get_memo()[1]
+
+    if message not in translations:
+        translations[message] = translation.ugettext(message)
+
+    return translations[message]
+
+
+def ungettext(singular, plural, number):
+    """
+    Same as django.utils.translation.ungettext, but memoized.
+    """
+    translations = _get_memo()[2]
+    key = (singular, plural, number)
+
+    if key not in translations:
+        translations[key] = translation.ungettext(singular, plural, number)
+
+    return translations[key]
+
+
+def translate_many(messages):
+    """
+    Translate all these messages at once, return a { msgid: translation } dict.
+    """
+    translations = _get_memo()[1]
+    result = { }
+
+    for message in set(messages):
+        if message not in translations:
+            translations[message] = translation.ugettext(message)
+        result[message] = translations[message]
+
+    return result
@@ -21,8 +21,9 @@ from template_preprocessor.core.django_processor import DjangoContent, DjangoCon
 from template_preprocessor.core.lexer import State, StartToken, Push, Record, Shift, StopToken, Pop, CompileException, Token, Error
 from template_preprocessor.core.lexer_engine import tokenize
 from template_preprocessor.core.html_processor import HtmlContent
+from collections import OrderedDict
 import string
-from django.utils.translation import ugettext as _
+from template_preprocessor.core.i18n import ugettext as _
 
 __JS_KEYWORDS = 'break|catch|const|continue|debugger|default|delete|do|else|enum|false|finally|for|function|gcase|if|new|null|return|switch|this|throw|true|try|typeof|var|void|while|with'.split('|')
 
@@ -128,7 +129,8 @@ class JavascriptScope(JavascriptNode):
     Something between { curly brackets } in javascript.
     """
     def init_extension(self):
-        self.symbol_table = { }
+        # Ordered by declaration, variables are renamed in this order.
+        self.symbol_table = OrderedDict()
 
     def output(self, handler):
         handler(u'{')
@@ -700,10 +702,12 @@ def _validate_javascript(js_node):
             next()
 
 
-def _process_gettext(js_node, context, validate_only=False):
+def _process_gettext(js_node, context, validate_only=False, remember=True):
     """
     Validate whether gettext(...) function in javascript get a string as
     parameter. (Or concatenation of several strings)
+    When `remember` is False, the gettext entries are not remembered in the
+    context. (They were already, in the language neutral compile phase.)
     """
     for scope in js_node.child_nodes_of_class([JavascriptScope, JavascriptSquareBrackets, JavascriptParentheses]):
         nodes = scope.children
@@ -737,7 +741,8 @@ def _process_gettext(js_node, context, validate_only=False):
                         body = u''.join(body)
 
                         # Remember gettext entry
-                        context.remember_gettext(gettext, body)
+                        if remember:
+                            context.remember_gettext(gettext, body)
 
                         if not validate_only:
                             # Translate content
@@ -798,7 +803,7 @@ def _compile(js_node, context):
     _compress_javascript_whitespace(js_node)
 
     # Preprocess gettext
-    _process_gettext(js_node, context)
+    _process_gettext(js_node, context, validate_only=context.language_neutral)
 
     # Minify variable names
     _minify_variable_names(js_node)
@@ -252,9 +252,16 @@ class State(object):
             this regex has been found.
             """
             self.regex_match = regex_match
-            self.compiled_regex = re.compile(regex_match)
+            self._compiled_regex = None
             self.action_list = action_list
 
+        @property
+        def compiled_regex(self):
+            # Compiled on first use, a process often doesn't need every grammar.
+            if self._compiled_regex is None:
+                self._compiled_regex = re.compile(self.regex_match)
+            return self._compiled_regex
+
     def __init__(self, *transitions):
         self.__transitions = transitions
 
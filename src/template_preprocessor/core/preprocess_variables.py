@@ -0,0 +1,76 @@
+"""
+Author: Jonathan Slenders, City Live
+"""
+
+from django.conf import settings
+
+from template_preprocessor.core.run_cache import RunCache
+
+__doc__ = """
+Variables like {{ MEDIA_URL }} which are replaced by their value at compile
+time. Besides MEDIA_URL, STATIC_URL and the SITE_DOMAIN, SITE_NAME and SITE_URL
+of the current Site, projects can add their own constants:
+
+-- settings.py --
+TEMPLATE_PREPROCESSOR_VARIABLES = {
+        'SUPPORT_EMAIL': 'support@example.com',
+}
+
+-- or in code --
+from template_preprocessor import register_preprocess_variable
+
+register_preprocess_variable('SUPPORT_EMAIL', 'support@example.com')
+register_preprocess_variable('RELEASE', lambda: get_release_name())
+
+The values are computed only once per compile run.
+"""
+
+
+__registered_variables = { }
+
+def register_preprocess_variable(name, value):
+    """
+    Replace {{ name }} by this value in every template. When `value` is
+    callable, it's called once per compile run.
+    """
+    __registered_variables[name] = value
+    _cache.clear()
+
+
+_cache = RunCache()
+
+def get_preprocess_variables():
+    """
+    Return a { name: value } dict of all the variables to be preprocessed.
+    """
+    variables = _cache.get('variables')
+
+    if variables is None:
+        variables = {
+            'MEDIA_URL': getattr(settings, 'MEDIA_URL', ''),
+            'STATIC_URL': getattr(settings, 'STATIC_URL', ''),
+        }
+
+        if 'django.contrib.sites' in settings.INSTALLED_APPS:
+            from django.contrib.sites.models import Site
+            try:
+                # Don't preprocess anything when we don't have a Site
+                # instance yet.
+                site = Site.objects.get_current()
+                variables.update({
+                    'SITE_DOMAIN': site.domain,
+                    'SITE_NAME': site.name,
+                    'SITE_URL': 'http://%s' % site.domain,
+                })
+            except Site.DoesNotExist, e:
+                pass
+
+        for name, value in getattr(settings, 'TEMPLATE_PREPROCESSOR_VARIABLES', { }).items():
+            variables[name] = unicode(value)
+
+        for name, value in __registered_variables.items():
+            variables[name] = unicode(value() if callable(value) else value)
+
+        _cache['variables'] = variables
+
+    return variables
@@ -1,8 +1,13 @@
 
 from django.conf import settings
+from django.utils import translation
 from django.utils.translation import ugettext as _
 
+from template_preprocessor.core.run_cache import RunCache
+
 import re
+import threading
+import time
 
 __doc__ = """
 Extensions to the preprocessor, if certain tags are possible to be preprocessed,
@@ -18,6 +23,13 @@ def now(*args):
     else:
         raise NotPreprocessable()
 
+Tags of which the output only depends on the arguments (and the active
+language) can be declared pure. They are called only once per compile run
+for the same arguments:
+
+@preprocess_tag(pure=True)
+def copyright(*args):
+    return u'&copy; City Live'
 """
 
 
@@ -33,7 +45,60 @@ class NotPreprocessable(Exception):
 
 __preprocessabel_tags = { }
 
-def preprocess_tag(func_or_name):
+# (name, args, language) -> output, or NotPreprocessable
+_results = RunCache()
+_missing = object()
+
+# name -> [ calls, cache hits, seconds ]
+_stats = RunCache()
+_stats_lock = threading.Lock()
+
+
+class PreprocessableTag(object):
+    """
+    A registered preprocessable tag. Calling it executes the tag, but the
+    results of pure tags are remembered for the compile run.
+    """
+    def __init__(self, name, func, pure=False):
+        self.name = name
+        self.func = func
+        self.pure = pure
+
+    def __call__(self, *args):
+        if self.pure:
+            key = (self.name, args, translation.get_language())
+            result = _results.get(key, _missing)
+
+            if result is not _missing:
+                self._record(0, hit=True)
+
+                if result is NotPreprocessable:
+                    raise NotPreprocessable()
+                return result
+
+        start = time.time()
+        try:
+            result = self.func(*args)
+        except NotPreprocessable, e:
+            result = NotPreprocessable
+        self._record(time.time() - start)
+
+        if self.pure:
+            _results[key] = result
+
+        if result is NotPreprocessable:
+            raise NotPreprocessable()
+        return result
+
+    def _record(self, seconds, hit=False):
+        with _stats_lock:
+            stats = _stats.setdefault(self.name, [0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += int(hit)
+            stats[2] += seconds
+
+
+def preprocess_tag(func_or_name=None, pure=False):
     """
     > @preprocess_tag
     > def my_template_tag(*args):
@@ -42,15 +107,30 @@ def preprocess_tag(func_or_name):
     > @preprocess_tag('my_template_tag')
     > def func(*args):
     >     return '<p>.....</p>'
+
+    > @preprocess_tag(pure=True)
+    > def my_template_tag(*args):
+    >     return '<p>.....</p>'
     """
-    if isinstance(func_or_name, basestring):
-        def decorator(func):
-            __preprocessabel_tags[func_or_name] = func
-            return func
-        return decorator
+    def register(name, func):
+        __preprocessabel_tags[name] = PreprocessableTag(name, func, pure)
+        return func
+
+    if func_or_name is None:
+        return lambda func: register(func.__name__, func)
+    elif isinstance(func_or_name, basestring):
+        return lambda func: register(func_or_name, func)
     else:
-        __preprocessabel_tags[func_or_name.__name__] = func_or_name
-        return func_or_name
+        return register(func_or_name.__name__, func_or_name)
+
+
+def get_preprocessable_tag_stats():
+    """
+    Return a list of (name, calls, cache hits, seconds) tuples for the
+    preprocessable tags which were executed during this compile run.
+    """
+    with _stats_lock:
+        return sorted((name, s[0], s[1], s[2]) for name, s in _stats.items())
 
 
 def discover_template_tags():
@@ -63,13 +143,17 @@ def discover_template_tags():
 
 
 _discovered = False
+_discover_lock = threading.Lock()
 
 def get_preprocessable_tags():
     global _discovered
 
     if not _discovered:
-        discover_template_tags()
-        _discovered = True
+        # Templates can be compiled in several threads at once.
+        with _discover_lock:
+            if not _discovered:
+                discover_template_tags()
+                _discovered = True
 
     return __preprocessabel_tags
 
@@ -78,11 +162,13 @@ def get_preprocessable_tags():
 # ==== Build-in preprocessable tags ====
 
 
-@preprocess_tag('google_analytics')
+_whitespace = re.compile(r'\s\s+')
+
+@preprocess_tag('google_analytics', pure=True)
 def _google_analytics(*args):
     if len(args) != 1: raise NotPreprocessable()
 
-    return re.compile('\s\s+').sub(' ',  '''
+    return _whitespace.sub(' ',  '''
     <script type="text/javascript">
         var gaJsHost = (("https:" == document.location.protocol) ? "https://ssl." : "http://www.");
         document.write(unescape("%%3Cscript src='" + gaJsHost + "google-analytics.com/ga.js' type='text/javascript'%%3E%%3C/script%%3E"));
@@ -102,6 +188,7 @@ def _now(*args):
     The output of the following template tag will probably not change between
     reboots of the django server.
     {% now "Y" %}
+    (Not pure: the runtime loaders keep their results for the whole process.)
     """
     if len(args) == 2 and args[1] in (u'"Y"', u"'Y'"):
         import datetime
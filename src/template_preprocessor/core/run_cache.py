@@ -0,0 +1,39 @@
+"""
+Author: Jonathan Slenders, City Live
+"""
+
+"""
+Caches shared between all the templates of a compile run.
+-----------------------------------------------------------
+
+Lookups like URL reversal give the same result for every template which is
+compiled, so they only need to be done once. `compile_templates` clears these
+caches when it starts. The runtime template loaders keep them for the lifetime
+of the process.
+"""
+
+import threading
+
+
+_run_caches = []
+_lock = threading.Lock()
+
+
+class RunCache(dict):
+    """
+    Dictionary which is emptied by `clear_run_caches`.
+    """
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+
+        with _lock:
+            _run_caches.append(self)
+
+
+def clear_run_caches():
+    """
+    Empty all run caches. (Call at the start of every compile run.)
+    """
+    with _lock:
+        for cache in _run_caches:
+            cache.clear()
@@ -1,6 +1,7 @@
 
 import os
 import codecs
+import threading
 import urllib2
 from hashlib import md5
 
@@ -8,23 +9,34 @@ from django.conf import settings
 from django.utils import translation
 from template_preprocessor.core.lexer import CompileException
 
-MEDIA_ROOT = getattr(settings, 'MEDIA_ROOT', '')
-MEDIA_URL = getattr(settings, 'MEDIA_URL', '')
-MEDIA_CACHE_DIR = settings.MEDIA_CACHE_DIR
-MEDIA_CACHE_URL = settings.MEDIA_CACHE_URL
-STATIC_ROOT = getattr(settings, 'STATIC_ROOT', '')
-STATIC_URL = getattr(settings, 'STATIC_URL', None)
+# Settings are read when they're needed, not at import time, so that importing
+# the preprocessor doesn't require configured media settings.
 
+def _media_settings():
+    """
+    Return (MEDIA_ROOT, MEDIA_URL, STATIC_URL)
+    """
+    return (getattr(settings, 'MEDIA_ROOT', ''), getattr(settings, 'MEDIA_URL', ''),
+                getattr(settings, 'STATIC_URL', None))
+
+
+def find(path):
+    """
+    Find static file. (Through the staticfiles finders, imported on first use.)
+    """
+    global find
 
-try:
-    from django.contrib.staticfiles.finders import find
-except ImportError:
-    # fall back to django-staticfiles
     try:
-        from staticfiles.finders import find
+        from django.contrib.staticfiles.finders import find
     except ImportError:
-        def find(url):
-            return os.path.join(STATIC_ROOT, url)
+        # fall back to django-staticfiles
+        try:
+            from staticfiles.finders import find
+        except ImportError:
+            def find(path):
+                return os.path.join(getattr(settings, 'STATIC_ROOT', ''), path)
+
+    return find(path)
 
 
 # =======[ Utilities for media/static files ]======
@@ -37,6 +49,8 @@ def get_media_source_from_url(url):
     """
     For a given media/static URL, return the matching full path in the media/static directory
     """
+    MEDIA_ROOT, MEDIA_URL, STATIC_URL = _media_settings()
+
     # Media
     if MEDIA_URL and url.startswith(MEDIA_URL):
         return os.path.join(MEDIA_ROOT, url[len(MEDIA_URL):].lstrip('/'))
@@ -85,6 +99,8 @@ def simplify_media_url(url):
     For a given media/static URL, replace the settings.MEDIA/STATIC_URL prefix
     by simply /media or /static.
     """
+    MEDIA_ROOT, MEDIA_URL, STATIC_URL = _media_settings()
+
     if MEDIA_URL and url.startswith(MEDIA_URL):
         return '/media/' + url[len(MEDIA_URL):]
     elif STATIC_URL and url.startswith(STATIC_URL):
@@ -94,6 +110,8 @@ def simplify_media_url(url):
 
 
 def real_url(url):
+    MEDIA_ROOT, MEDIA_URL, STATIC_URL = _media_settings()
+
     if url.startswith('/static/'):
         return STATIC_URL + url[len('/static/'):]
 
@@ -118,6 +136,8 @@ def check_external_file_existance(node, url):
         complete_path = get_media_source_from_url(url)
 
         if not complete_path or not os.path.exists(complete_path):
+            MEDIA_ROOT, MEDIA_URL, STATIC_URL = _media_settings()
+
             if MEDIA_URL and url.startswith(MEDIA_URL):
                 raise exception
 
@@ -131,7 +151,12 @@ def _create_directory_if_not_exists(directory):
     """
     if not os.path.exists(directory):
         #os.mkdir(directory)
-        os.makedirs(directory)
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            # Created by another thread in the meantime?
+            if not os.path.isdir(directory):
+                raise
 
 
 def need_to_be_recompiled(source_files, output_file):
@@ -148,11 +173,25 @@ def need_to_be_recompiled(source_files, output_file):
     )
 
 
+_media_output_locks = { }
+_media_output_locks_lock = threading.Lock()
+
+def _media_output_lock(path):
+    """
+    Lock for compiling one media output file. Templates compiled in
+    parallel threads can refer to the same media files.
+    """
+    with _media_output_locks_lock:
+        if path not in _media_output_locks:
+            _media_output_locks[path] = threading.Lock()
+        return _media_output_locks[path]
+
+
 def create_media_output_path(media_files, extension, lang):
     assert extension in ('js', 'css')
 
     name = '%s.%s' % (os.path.join(lang, md5(''.join(media_files)).hexdigest()), extension)
-    return os.path.join(MEDIA_CACHE_DIR, name)
+    return os.path.join(settings.MEDIA_CACHE_DIR, name)
 
 
 # =======[ Compiler for external media/static files ]======
@@ -167,36 +206,37 @@ def compile_external_javascript_files(media_files, context, compress_tag=None):
 
     # Create a hash for this scriptnames
     name = os.path.join(translation.get_language(), md5(''.join(media_files)).hexdigest()) + '.js'
-    compiled_path = os.path.join(MEDIA_CACHE_DIR, name)
+    compiled_path = os.path.join(settings.MEDIA_CACHE_DIR, name)
 
-    if need_to_be_recompiled(media_files, compiled_path):
-        # Trigger callback, used for printing "compiling media..." feedback
-        context.compile_media_callback(compress_tag, map(simplify_media_url, media_files))
-        progress = [0] # by reference
+    with _media_output_lock(compiled_path):
+        if need_to_be_recompiled(media_files, compiled_path):
+            # Trigger callback, used for printing "compiling media..." feedback
+            context.compile_media_callback(compress_tag, map(simplify_media_url, media_files))
+            progress = [0] # by reference
 
-        def compile_part(media_file):
-            progress[0] += 1
-            media_content = read_media(media_file)
+            def compile_part(media_file):
+                progress[0] += 1
+                media_content = read_media(media_file)
 
-            context.compile_media_progress_callback(compress_tag, simplify_media_url(media_file),
-                        progress[0], len(media_files), len(media_content))
+                context.compile_media_progress_callback(compress_tag, simplify_media_url(media_file),
+                            progress[0], len(media_files), len(media_content))
 
-            if not is_remote_url(media_file) or context.options.compile_remote_javascript:
-                return compile_javascript_string(media_content, context, media_file)
-            else:
-                return media_content
+                if not is_remote_url(media_file) or context.options.compile_remote_javascript:
+                    return compile_javascript_string(media_content, context, media_file)
+                else:
+                    return media_content
 
-        # Concatenate and compile all scripts
-        source = u'\n'.join(compile_part(p) for p in media_files)
+            # Concatenate and compile all scripts
+            source = u'\n'.join(compile_part(p) for p in media_files)
 
-        # Store in media dir
-        _create_directory_if_not_exists(os.path.split(compiled_path)[0])
-        codecs.open(compiled_path, 'w', 'utf-8').write(source)
+            # Store in media dir
+            _create_directory_if_not_exists(os.path.split(compiled_path)[0])
+            codecs.open(compiled_path, 'w', 'utf-8').write(source)
 
-        # Store meta information
-        open(compiled_path + '-c-meta', 'w').write('\n'.join(map(simplify_media_url, media_files)))
+            # Store meta information
+            open(compiled_path + '-c-meta', 'w').write('\n'.join(map(simplify_media_url, media_files)))
 
-    return os.path.join(MEDIA_CACHE_URL, name)
+    return os.path.join(settings.MEDIA_CACHE_URL, name)
 
 
 def compile_external_css_files(media_files, context, compress_tag=None):
@@ -208,33 +248,34 @@ def compile_external_css_files(media_files, context, compress_tag=None):
 
     # Create a hash for this scriptnames
     name = os.path.join(translation.get_language(), md5(''.join(media_files)).hexdigest()) + '.css'
-    compiled_path = os.path.join(MEDIA_CACHE_DIR, name)
+    compiled_path = os.path.join(settings.MEDIA_CACHE_DIR, name)
 
-    if need_to_be_recompiled(media_files, compiled_path):
-        # Trigger callback, used for printing "compiling media..." feedback
-        context.compile_media_callback(compress_tag, map(simplify_media_url, media_files))
-        progress = [0] # by reference
+    with _media_output_lock(compiled_path):
+        if need_to_be_recompiled(media_files, compiled_path):
+            # Trigger callback, used for printing "compiling media..." feedback
+            context.compile_media_callback(compress_tag, map(simplify_media_url, media_files))
+            progress = [0] # by reference
 
-        def compile_part(media_file):
-            progress[0] += 1
-            media_content = read_media(media_file)
+            def compile_part(media_file):
+                progress[0] += 1
+                media_content = read_media(media_file)
 
-            context.compile_media_progress_callback(compress_tag, simplify_media_url(media_file),
-                        progress[0], len(media_files), len(media_content))
+                context.compile_media_progress_callback(compress_tag, simplify_media_url(media_file),
+                            progress[0], len(media_files), len(media_content))
 
-            if not is_remote_url(media_file) or context.options.compile_remote_css:
-                return compile_css_string(media_content, context, get_media_source_from_url(media_file), media_file)
-            else:
-                return media_content
+                if not is_remote_url(media_file) or context.options.compile_remote_css:
+                    return compile_css_string(media_content, context, get_media_source_from_url(media_file), media_file)
+                else:
+                    return media_content
 
-        # concatenate and compile all css files
-        source = u'\n'.join(compile_part(p) for p in media_files)
+            # concatenate and compile all css files
+            source = u'\n'.join(compile_part(p) for p in media_files)
 
-        # Store in media dir
-        _create_directory_if_not_exists(os.path.split(compiled_path)[0])
-        codecs.open(compiled_path, 'w', 'utf-8').write(source)
+            # Store in media dir
+            _create_directory_if_not_exists(os.path.split(compiled_path)[0])
+            codecs.open(compiled_path, 'w', 'utf-8').write(source)
 
-        # Store meta information
-        open(compiled_path + '-c-meta', 'w').write('\n'.join(map(simplify_media_url, media_files)))
+            # Store meta information
+            open(compiled_path + '-c-meta', 'w').write('\n'.join(map(simplify_media_url, media_files)))
 
-    return os.path.join(MEDIA_CACHE_URL, name)
+    return os.path.join(settings.MEDIA_CACHE_URL, name)
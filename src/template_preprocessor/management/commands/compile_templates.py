@@ -3,6 +3,7 @@ Author: Jonathan Slenders, City Live
 """
 import os
 import codecs
+import time
 from optparse import make_option
 import termcolor
 
@@ -11,13 +12,19 @@ from django.core.management.base import BaseCommand
 from django.core.urlresolvers import reverse
 from django.template import TemplateDoesNotExist
 
-from template_preprocessor.core import compile
+from template_preprocessor.core import compile, compile_language_neutral, specialize_for_language, NotLanguageNeutral
 from template_preprocessor.core.lexer import CompileException
 
 from template_preprocessor.utils import language, template_iterator, load_template_source, get_template_path
-from template_preprocessor.utils import get_options_for_path, execute_precompile_command
+from template_preprocessor.utils import get_options_for_path, execute_precompile_command, get_template_index
 from template_preprocessor.core.utils import need_to_be_recompiled, create_media_output_path
 from template_preprocessor.core.context import Context
+from template_preprocessor.core.run_cache import clear_run_caches
+from template_preprocessor.core.preprocessable_template_tags import get_preprocessable_tag_stats
+from template_preprocessor.template.precompiled import save_serialized_template, remove_serialized_template, \
+            read_serialized_template
+from template_preprocessor.template.precompiled import get_pack_path, write_template_pack, write_manifest
+from template_preprocessor.template.precompiled import save_compiled_template, remove_unused_objects, is_static_template
 
 
 class Command(BaseCommand):
@@ -29,7 +36,19 @@ class Command(BaseCommand):
         make_option('--noinput', action='store_false', dest='interactive', default=True,
                         help='Tell Django to NOT prompt the user for input of any kind.'),
         make_option('--insert-debug-symbols', action='store_true', dest='insert_debug_symbols', default=False,
-                        help='Insert debug symbols in template output')
+                        help='Insert debug symbols in template output'),
+        make_option('--serialize-templates', action='store_true', dest='serialize_templates', default=False,
+                        help='Also store the parsed Template objects (for the SerializedPreprocessedLoader)'),
+        make_option('--pack', action='store_true', dest='pack', default=False,
+                        help='Store all compiled templates in a single template pack'),
+        make_option('--pack-per-language', action='store_true', dest='pack_per_language', default=False,
+                        help='Store the compiled templates in a template pack for each language'),
+        make_option('--share-compile-phase', action='store_true', dest='share_compile_phase', default=False,
+                        help='Compile every template once, and only translate the result for each language'),
+        make_option('--watch', action='store_true', dest='watch', default=False,
+                        help='Keep running, and compile the templates which change'),
+        make_option('--watch-interval', action='store', type='float', dest='watch_interval', default=1,
+                        help='Seconds between looking for changes in watch mode'),
     )
 
 
@@ -43,6 +62,9 @@ class Command(BaseCommand):
                 kwargs['insert_debug_symbols'] = self.insert_debug_symbols
                 Context.__init__(s, *args, **kwargs)
 
+                # For the "no-html" fallback
+                s.keep_output_before_html = True
+
             def compile_media_callback(s, compress_tag, media_files):
                 """
                 When the compiler notifies us that compiling of this file begins.
@@ -83,6 +105,8 @@ class Command(BaseCommand):
         all_templates = options['all_templates']
         interactive = options['interactive']
         self.insert_debug_symbols = options['insert_debug_symbols']
+        self.serialize_templates = options['serialize_templates']
+        self.share_compile_phase = options['share_compile_phase']
 
         # Default verbosity
         self.verbosity = int(options.get('verbosity', 1))
@@ -125,26 +149,78 @@ class Command(BaseCommand):
                                 print ('Deleting old media file: %s' % path)
                             os.remove(path)
 
+        # The compiled templates, for the packs and the manifest. Read from
+        # the cache directory once, and updated for every compiled template.
+        self._compiled_sources = None # (lang, template) -> source
+        self._serialized_sources = None # (lang, template) -> pickle
+
+        last_refresh = time.time()
+        self._compile(options, all_templates)
+
+        # Keep compiling the templates which change.
+        if options['watch']:
+            print 'Watching for changes...'
+
+            while True:
+                time.sleep(options['watch_interval'])
+
+                # (Only the changed directories are listed again.)
+                changed_since, last_refresh = last_refresh, time.time()
+                get_template_index().refresh()
+                self._compile(options, False, changed_since=changed_since)
+
+
+    def _compile(self, options, all_templates, changed_since=None):
+        """
+        Compile the templates and media, and write the template packs and manifest.
+        """
+        self._errors = []
+
         # Build compile queue
-        queue = self._build_compile_queue(options['languages'], all_templates)
+        queue = self._build_compile_queue(options['languages'], all_templates, changed_since)
+
+        if changed_since is not None and not queue:
+            return
+
+        # Start with empty caches, also for every cycle in watch mode.
+        # (URLs, translations, etc... can have changed.)
+        clear_run_caches()
 
         # Precompile command
         execute_precompile_command()
 
         # Compile queue
-        for i in range(0, len(queue)):
-            lang = queue[i][0]
-            with language(lang):
-                if self.verbosity >= 2:
-                    print self.colored('%i / %i |' % (i+1, len(queue)), 'yellow'),
-                    print self.colored('(%s)' % lang, 'yellow'),
-                    print self.colored(queue[i][1], 'green')
+        if self.share_compile_phase:
+            self._compile_queue_shared(queue)
+        else:
+            for i in range(0, len(queue)):
+                lang = queue[i][0]
+                with language(lang):
+                    if self.verbosity >= 2:
+                        print self.colored('%i / %i |' % (i+1, len(queue)), 'yellow'),
+                        print self.colored('(%s)' % lang, 'yellow'),
+                        print self.colored(queue[i][1], 'green')
 
-                self._compile_template(*queue[i])
+                    self._compile_template(*queue[i])
 
         # Show all errors once again.
         print u'\n*** %i Files processed, %i compile errors ***' % (len(queue), len(self._errors))
 
+        if self.verbosity >= 2:
+            self._print_preprocessable_tag_stats()
+
+        # Template packs and manifest
+        compiled_templates = self._compiled_templates([l[0] for l in settings.LANGUAGES])
+        self._write_template_packs(compiled_templates, options['pack'], options['pack_per_language'])
+
+        # Writing a new manifest notifies the running PreprocessedLoaders
+        # that templates have changed. (So, write it after the packs.)
+        manifest = write_manifest(settings.TEMPLATE_CACHE_DIR, compiled_templates)
+        if self.verbosity >= 1:
+            print 'Template manifest generation %s' % manifest['generation']
+
+        remove_unused_objects(settings.TEMPLATE_CACHE_DIR, set(manifest['templates'].values()))
+
         # Build media compile queue
         media_queue = self._build_compile_media_queue(options['languages'])
 
@@ -166,24 +242,32 @@ class Command(BaseCommand):
         print '\x07'
 
 
-    def _build_compile_queue(self, languages, all_templates=True):
+    def _build_compile_queue(self, languages, all_templates=True, changed_since=None):
         """
         Build a list of all the templates to be compiled.
+        (Or only the templates modified since `changed_since`, in watch mode.)
         """
         # Create compile queue
         queue = set() # Use a set, avoid duplication of records.
 
-        if self.verbosity >= 2:
+        if self.verbosity >= 2 and changed_since is None:
             print 'Building queue'
 
+        index = get_template_index()
+
         for lang in languages:
             # Now compile all templates to the cache directory
             for dir, t in template_iterator():
-                input_path = os.path.normpath(os.path.join(dir, t))
+                input_path, input_mtime, dir = index.get(t)
+                input_path = os.path.normpath(input_path)
                 output_path = self._make_output_path(lang, t)
 
                 # Compile this template if:
-                if (
+                if changed_since is not None:
+                    # (Watch mode: don't retry failed templates until they change.)
+                    needs_compile = input_mtime >= changed_since
+                else:
+                    needs_compile = (
                         # We are compiling *everything*
                         all_templates or
 
@@ -194,8 +278,9 @@ class Command(BaseCommand):
                         os.path.exists(output_path + '-c-recompile') or
 
                         # Compiled file is outdated
-                        os.path.getmtime(output_path) < os.path.getmtime(input_path)):
+                        os.path.getmtime(output_path) < input_mtime)
 
+                if needs_compile:
                     queue.add( (lang, t, input_path, output_path) )
 
                     # When this file has to be compiled, and other files depend
@@ -214,6 +299,73 @@ class Command(BaseCommand):
         return queue
 
 
+    def _print_preprocessable_tag_stats(self):
+        stats = get_preprocessable_tag_stats()
+        if stats:
+            print 'Preprocessable tags:'
+            for name, calls, hits, seconds in stats:
+                print '   %-30s %6i calls %6i cached %8.3fs' % (name, calls, hits, seconds)
+
+    def _write_template_packs(self, compiled_templates, pack, pack_per_language):
+        """
+        Bundle the compiled templates of all languages in template packs, or
+        remove the packs if we don't create them anymore. (Otherwise, the
+        loader would keep using outdated packs.) The serialized Template
+        objects go in the packs as well.
+        """
+        languages = [l[0] for l in settings.LANGUAGES]
+        paths = [ (None, get_pack_path(settings.TEMPLATE_CACHE_DIR)) ] + \
+                [ (lang, get_pack_path(settings.TEMPLATE_CACHE_DIR, lang)) for lang in languages ]
+
+        serialized = { }
+        if self.serialize_templates and (pack or pack_per_language):
+            serialized = self._serialized_templates(compiled_templates)
+
+        for lang, path in paths:
+            if (pack and lang is None) or (pack_per_language and lang):
+                templates = [ t for t in compiled_templates if lang in (None, t[0]) ]
+                write_template_pack(path, templates, serialized)
+
+                if self.verbosity >= 1:
+                    print 'Template pack %s: %i templates' % (path, len(templates))
+
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def _compiled_templates(self, languages):
+        """
+        List the (lang, template, source) of all compiled templates.
+        (The compiled templates are only read the first time, in watch mode,
+        `_save_compiled_template` keeps them up to date.)
+        """
+        templates = sorted(set(t for dir, t in template_iterator()))
+
+        if self._compiled_sources is None:
+            self._compiled_sources = { }
+            for lang in languages:
+                for t in templates:
+                    output_path = self._make_output_path(lang, t)
+                    if os.path.exists(output_path):
+                        self._compiled_sources[(lang, t)] = codecs.open(output_path, 'r', 'utf-8').read()
+
+        return [ (lang, t, self._compiled_sources[(lang, t)])
+                        for lang in languages for t in templates if (lang, t) in self._compiled_sources ]
+
+    def _serialized_templates(self, compiled_templates):
+        """
+        Return the { (lang, template): pickle } dict of the serialized
+        Template objects. (Read only the first time, like the compiled
+        templates.)
+        """
+        if self._serialized_sources is None:
+            self._serialized_sources = { }
+            for lang, t, source in compiled_templates:
+                data = read_serialized_template(self._make_output_path(lang, t))
+                if data:
+                    self._serialized_sources[(lang, t)] = data
+
+        return self._serialized_sources
+
     def _build_compile_media_queue(self, languages):
         from template_preprocessor.core.utils import compile_external_css_files, compile_external_javascript_files
 
@@ -284,18 +436,73 @@ class Command(BaseCommand):
         output_path = self._make_output_path(lang, template) + '-c-extends'
         open(output_path, 'w').write('\n'.join(extends_list) + '\n')
 
+    def _compile_queue_shared(self, queue):
+        """
+        Compile every template in the queue only once, and specialize the
+        result for each language. Templates which can't be compiled language
+        neutral are compiled for each language separately.
+        """
+        # Group queue by template
+        templates = { }
+        for lang, template, input_path, output_path in queue:
+            templates.setdefault((template, input_path), []).append((lang, output_path))
+
+        for i, (template, input_path) in enumerate(sorted(templates)):
+            outputs = templates[(template, input_path)]
+
+            if self.verbosity >= 2:
+                print self.colored('%i / %i |' % (i+1, len(templates)), 'yellow'),
+                print self.colored('(%s)' % ','.join(lang for lang, output_path in outputs), 'yellow'),
+                print self.colored(template, 'green')
+
+            # Language neutral phase
+            try:
+                with language(outputs[0][0]):
+                    tree, context = compile_language_neutral(self._read_template(input_path), path=input_path,
+                                loader=load_template_source, options=get_options_for_path(input_path),
+                                context_class=self.NiceContext)
+            except NotLanguageNeutral, e:
+                if self.verbosity >= 2:
+                    print self.colored('Compiling for each language: %s' % e, 'yellow')
+                tree = None
+            except (CompileException, TemplateDoesNotExist), e:
+                # Errors are reported by the compilation for each language.
+                tree = None
+
+            # Specialize for each language
+            for lang, output_path in outputs:
+                with language(lang):
+                    output = None
+
+                    if tree is not None:
+                        try:
+                            output = specialize_for_language(tree, context)
+                        except NotLanguageNeutral, e:
+                            if self.verbosity >= 2:
+                                print self.colored('Compiling for %s: %s' % (lang, e), 'yellow')
+                        except CompileException, e:
+                            pass
+
+                    if output is None:
+                        self._compile_template(lang, template, input_path, output_path)
+                    else:
+                        self._save_compiled_template(lang, template, output_path, output, context)
+
+    def _read_template(self, input_path):
+        try:
+            return codecs.open(input_path, 'r', 'utf-8').read()
+        except UnicodeDecodeError, e:
+            raise CompileException(0, 0, input_path, str(e))
+        except IOError, e:
+            raise CompileException(0, 0, input_path, str(e))
+
     def _compile_template(self, lang, template, input_path, output_path, no_html=False):
         try:
             # Create output directory
             self._create_dir(os.path.split(output_path)[0])
 
-            try:
-                # Open input file
-                code = codecs.open(input_path, 'r', 'utf-8').read()
-            except UnicodeDecodeError, e:
-                raise CompileException(0, 0, input_path, str(e))
-            except IOError, e:
-                raise CompileException(0, 0, input_path, str(e))
+            # Open input file
+            code = self._read_template(input_path)
 
             # Compile
             if no_html:
@@ -307,18 +514,7 @@ class Command(BaseCommand):
                             options=get_options_for_path(input_path),
                             context_class=self.NiceContext)
 
-            # store dependencies
-            self._save_template_dependencies(lang, template, context.template_dependencies)
-            self._save_first_level_template_dependencies(lang, template, context.include_dependencies,
-                                                                context.extends_dependencies)
-
-            # Open output file
-            codecs.open(output_path, 'w', 'utf-8').write(output)
-
-            # Delete -c-recompile file (mark for recompilation) if one such exist.
-            if os.path.exists(output_path + '-c-recompile'):
-                os.remove(output_path + '-c-recompile')
-
+            self._save_compiled_template(lang, template, output_path, output, context)
             return True
 
         except CompileException, e:
@@ -328,7 +524,15 @@ class Command(BaseCommand):
                 self.print_error(u'ERROR:  %s' % unicode(e))
 
                 print u'Trying again with option "no-html"... ',
-                if self._compile_template(lang, template, input_path, output_path, no_html=True):
+
+                # When the HTML compiler failed, we already have the output
+                # without HTML processing.
+                context = getattr(e, 'context', None)
+                if context is not None and context.output_before_html is not None:
+                    self._save_compiled_template(lang, template, output_path, context.output_before_html, context)
+                    print 'Succeeded'
+
+                elif self._compile_template(lang, template, input_path, output_path, no_html=True):
                     print 'Succeeded'
                 else:
                     print 'Failed again'
@@ -340,6 +544,37 @@ class Command(BaseCommand):
             if self.verbosity >= 2:
                 print u'WARNING: Template does not exist:  %s' % unicode(e)
 
+    def _save_compiled_template(self, lang, template, output_path, output, context):
+        # Create output directory
+        self._create_dir(os.path.split(output_path)[0])
+
+        # store dependencies
+        self._save_template_dependencies(lang, template, context.template_dependencies)
+        self._save_first_level_template_dependencies(lang, template, context.include_dependencies,
+                                                            context.extends_dependencies)
+
+        # Write output file
+        save_compiled_template(settings.TEMPLATE_CACHE_DIR, output_path, output)
+
+        if self._compiled_sources is not None:
+            self._compiled_sources[(lang, template)] = output
+        if self._serialized_sources is not None:
+            self._serialized_sources.pop((lang, template), None)
+
+        # Serialized Template object (The loader doesn't parse static templates.)
+        if self.serialize_templates and not is_static_template(output):
+            if save_serialized_template(output_path, output, template):
+                if self._serialized_sources is not None:
+                    self._serialized_sources[(lang, template)] = read_serialized_template(output_path)
+            elif self.verbosity >= 2:
+                print self.colored('Template %s can not be serialized, it will be parsed at runtime.' % template, 'yellow')
+        else:
+            remove_serialized_template(output_path)
+
+        # Delete -c-recompile file (mark for recompilation) if one such exist.
+        if os.path.exists(output_path + '-c-recompile'):
+            os.remove(output_path + '-c-recompile')
+
     def _create_dir(self, newdir):
         if not os.path.isdir(newdir):
             os.makedirs(newdir)
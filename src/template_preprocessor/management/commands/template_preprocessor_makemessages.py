@@ -12,10 +12,10 @@ from django.core.management.base import BaseCommand
 from django.core.urlresolvers import reverse
 from django.template import TemplateDoesNotExist
 
-from template_preprocessor.core import compile
+from template_preprocessor.core import compile_many
 from template_preprocessor.core.lexer import CompileException
 
-from template_preprocessor.utils import language, template_iterator, load_template_source, get_template_path
+from template_preprocessor.utils import template_iterator
 from template_preprocessor.utils import get_options_for_path
 
 
@@ -43,11 +43,13 @@ class Command(BaseCommand):
         queue.sort()
 
         # Process queue
-        for i in range(0, len(queue)):
+        results = compile_many([ input_path for t, input_path in queue ], options=get_options_for_path)
+
+        for i, (input_path, lang, output, context) in enumerate(results):
             if self.verbosity >= 2:
                 sys.stderr.write(termcolor.colored('%i / %i |' % (i, len(queue)), 'yellow'))
-                sys.stderr.write(termcolor.colored(queue[i][1], 'green'))
-            self.process_template(*queue[i])
+                sys.stderr.write(termcolor.colored(input_path, 'green'))
+            self.process_template(input_path, output, context)
 
         # Output string to stdout
         for s in self.strings:
@@ -58,38 +60,28 @@ class Command(BaseCommand):
             print
 
 
-    def process_template(self, template, input_path):
-        # TODO: when HTML processing fails, the 'context' attribute is not
-        #       retreived and no translations are failed.  so, translate again
-        #       without html. (But we need to process html, in order to find
-        #       gettext() in javascript.)
-
-        try:
-            try:
-                # Open input file
-                code = codecs.open(input_path, 'r', 'utf-8').read()
-            except UnicodeDecodeError, e:
-                raise CompileException(0, 0, input_path, str(e))
-
-            # Compile
-            output, context = compile(code, path=input_path, loader=load_template_source,
-                        options=get_options_for_path(input_path))
+    def process_template(self, input_path, output, context):
+        # NOTE: when HTML processing fails, we still have the translations
+        #       from the Django template tags, but gettext() calls in
+        #       javascript are not found.
+        if isinstance(output, CompileException):
+            sys.stderr.write(termcolor.colored('Warning: failed to process %s: \n%s\n' % (input_path, output),
+                                    'white', 'on_red'))
 
-            for entry in context.gettext_entries:
-                line = '#: %s:%s:%s' % (entry.path, entry.line, entry.column)
+        elif isinstance(output, TemplateDoesNotExist):
+            return
 
-                if not entry.text in self.strings:
-                    self.strings[entry.text] = set()
+        if context is None:
+            return
 
-                self.strings[entry.text].add(line)
+        for entry in context.gettext_entries:
+            line = '#: %s:%s:%s' % (entry.path, entry.line, entry.column)
 
-                if self.verbosity >= 2:
-                    sys.stderr.write(line + '\n')
-                    sys.stderr.write('msgid "%s"\n\n' % entry.text.replace('"', r'\"'))
+            if not entry.text in self.strings:
+                self.strings[entry.text] = set()
 
-        except CompileException, e:
-            sys.stderr.write(termcolor.colored('Warning: failed to process %s: \n%s\n' % (input_path, e),
-                                    'white', 'on_red'))
+            self.strings[entry.text].add(line)
 
-        except TemplateDoesNotExist, e:
-            pass
+            if self.verbosity >= 2:
+                sys.stderr.write(line + '\n')
+                sys.stderr.write('msgid "%s"\n\n' % entry.text.replace('"', r'\"'))
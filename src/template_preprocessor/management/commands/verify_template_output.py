@@ -0,0 +1,129 @@
+"""
+Author: Jonathan Slenders, City Live
+"""
+import os
+import sys
+import difflib
+import json
+import subprocess
+import tempfile
+from optparse import make_option
+import termcolor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from template_preprocessor.core import compile_many
+from template_preprocessor.core.context import Context
+from template_preprocessor.template.precompiled import template_digest
+from template_preprocessor.utils import template_iterator
+
+
+class Command(BaseCommand):
+    help = "Compile all templates twice, in two processes with a different hash seed, and report every difference in the output."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--language', action='append', dest='languages', help='Give the languages'),
+        make_option('--insert-debug-symbols', action='store_true', dest='insert_debug_symbols', default=False,
+                        help='Insert debug symbols in template output'),
+        make_option('--seeds', dest='seeds', default='1,2',
+                        help='PYTHONHASHSEED of both compile runs (default: 1,2)'),
+        make_option('--output', dest='output',
+                        help='Only compile once, and write the output to this file. (Used for the compile runs.)'),
+    )
+
+    def handle(self, *args, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+
+        if options.get('languages') is None:
+            options['languages'] = [l[0] for l in settings.LANGUAGES]
+
+        if options.get('output'):
+            self._compile(options)
+        else:
+            self._verify(options)
+
+    def _compile(self, options):
+        """
+        Compile every template, and write a { "<lang>/<template>": output } dict.
+        """
+        insert_debug_symbols = options['insert_debug_symbols']
+
+        class VerifyContext(Context):
+            def __init__(self, *args, **kwargs):
+                kwargs['insert_debug_symbols'] = insert_debug_symbols
+                Context.__init__(self, *args, **kwargs)
+
+        template_names = dict((os.path.join(dir, t), t) for dir, t in template_iterator())
+        result = { }
+
+        for path, lang, output, context in compile_many(sorted(template_names), options['languages'],
+                            context_class=VerifyContext):
+            # A failed compilation should fail the same way.
+            if isinstance(output, Exception):
+                output = u'%s: %s' % (output.__class__.__name__, unicode(output))
+
+            result[u'%s/%s' % (lang, template_names[path])] = output
+
+        open(options['output'], 'wb').write(json.dumps(result, sort_keys=True))
+
+    def _verify(self, options):
+        seeds = options['seeds'].split(',')
+        if len(seeds) != 2 or seeds[0] == seeds[1]:
+            raise CommandError('--seeds needs two different values, e.g. --seeds=1,2')
+
+        runs = [ self._run(options, seed) for seed in seeds ]
+        differences = 0
+
+        for key in sorted(set(runs[0]) | set(runs[1])):
+            first, second = runs[0].get(key), runs[1].get(key)
+
+            if first == second:
+                if self.verbosity >= 2:
+                    print termcolor.colored(key, 'green'), template_digest(first)
+            else:
+                differences += 1
+                print termcolor.colored(key, 'white', 'on_red')
+
+                if self.verbosity >= 2 and first is not None and second is not None:
+                    for line in difflib.unified_diff(first.splitlines(), second.splitlines(),
+                                    'PYTHONHASHSEED=%s' % seeds[0], 'PYTHONHASHSEED=%s' % seeds[1], lineterm=''):
+                        print line.encode('utf-8')
+
+        print u'%i templates, %i with a different output' % (len(runs[0]), differences)
+
+        if differences:
+            raise CommandError('The template output is not deterministic')
+
+    def _run(self, options, seed):
+        """
+        Compile all templates in a new process, and return the output.
+        """
+        fd, output = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+
+        try:
+            # Don't depend on how this command was started (manage.py,
+            # django-admin.py --settings or call_command.)
+            command = [ sys.executable, '-c',
+                    'from django.core.management import execute_from_command_line; execute_from_command_line()',
+                    'verify_template_output', '--output', output ]
+            for lang in options['languages']:
+                command += [ '--language', lang ]
+            if options['insert_debug_symbols']:
+                command.append('--insert-debug-symbols')
+
+            env = dict(os.environ)
+            env['PYTHONHASHSEED'] = seed
+            env['PYTHONPATH'] = os.pathsep.join(sys.path)
+            env['DJANGO_SETTINGS_MODULE'] = settings.SETTINGS_MODULE
+
+            if self.verbosity >= 1:
+                print 'Compiling templates (PYTHONHASHSEED=%s)' % seed
+
+            if subprocess.call(command, env=env) != 0:
+                raise CommandError('Compiling the templates failed (PYTHONHASHSEED=%s)' % seed)
+
+            return json.loads(open(output, 'rb').read())
+        finally:
+            os.remove(output)
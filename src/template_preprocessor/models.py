@@ -0,0 +1 @@
+# No models. (Django needs this module to find the tests of this application.)
@@ -0,0 +1,249 @@
+# Author: Jonathan Slenders, City Live
+
+"""
+Storage for the render contexts captured by the DebugLoader.
+
+Every page rendered through the DebugLoader stores its context, so that the
+browser extension can ask for a re-render later on. These stores keep a
+bounded number of entries, expire them after a while, and evict the least
+recently used entries when full.
+
+-- settings.py --
+TEMPLATE_PREPROCESSOR_DEBUG_CONTEXT_STORE = 'template_preprocessor.template.context_store.FileContextStore'
+TEMPLATE_PREPROCESSOR_DEBUG_CONTEXT_STORE_OPTIONS = {
+        'max_entries': 100,
+        'ttl': 600, # seconds
+        'directory': '/tmp/template-preprocessor-contexts/', # Only for the FileContextStore
+}
+"""
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+from collections import OrderedDict
+import cPickle as pickle
+import logging
+import os
+import tempfile
+import threading
+import time
+
+
+logger = logging.getLogger('template_preprocessor')
+
+DEFAULT_MAX_ENTRIES = 100
+DEFAULT_TTL = 600
+
+
+def create_key():
+    """
+    Return a new random key of 32 characters.
+    """
+    return os.urandom(16).encode('hex')
+
+
+class MemoryContextStore(object):
+    """
+    Bounded in-memory store with TTL and LRU eviction. A `get` counts as a
+    use: the TTL is counted from the last use, and the least recently used
+    entries are evicted first.
+    """
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        # Number of entries which were removed before they expired.
+        self.evicted = 0
+
+        self._entries = OrderedDict() # key -> (last use, value)
+        self._lock = threading.Lock()
+
+    def _time(self):
+        # (Replaced by the tests.)
+        return time.time()
+
+    def _is_expired(self, last_use):
+        return last_use + self.ttl < self._time()
+
+    def set(self, key, value):
+        with self._lock:
+            self._remove_expired()
+            self._entries.pop(key, None)
+            self._entries[key] = (self._time(), value)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+            if entry is None or self._is_expired(entry[0]):
+                return default
+
+            # Move to the end: most recently used.
+            self._entries[key] = (self._time(), entry[1])
+            return entry[1]
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _remove_expired(self):
+        # Entries are ordered by last use, the expired ones are in front.
+        while self._entries:
+            key, (last_use, value) = next(self._entries.iteritems())
+            if not self._is_expired(last_use):
+                break
+            del self._entries[key]
+
+
+class FileContextStore(object):
+    """
+    Store which pickles the contexts to a local directory. The files are the
+    index: expiry and eviction look at their modification times, so that
+    files left by other (or earlier) processes are cleaned up as well. Like in
+    the MemoryContextStore, a `get` counts as a use: it touches the file, so
+    the TTL is counted from the last use, and the least recently used files
+    are evicted first.
+    Contexts which can't be pickled are not stored, this is logged.
+    """
+    def __init__(self, directory=None, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+        self.directory = directory or os.path.join(tempfile.gettempdir(), 'template-preprocessor-contexts')
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        # Number of entries which were removed before they expired.
+        self.evicted = 0
+
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _files(self):
+        """
+        Return a list of (mtime, path) for all the stored contexts, least
+        recently used first.
+        """
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.tmp'):
+                path = self._path(name)
+                try:
+                    files.append((os.path.getmtime(path), path))
+                except OSError, e:
+                    # Removed by another process in the meantime.
+                    pass
+        files.sort()
+        return files
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError, e:
+            pass
+
+    def _time(self):
+        # (Replaced by the tests.)
+        return time.time()
+
+    def _is_expired(self, mtime):
+        return mtime + self.ttl < self._time()
+
+    def _touch(self, path):
+        now = self._time()
+        os.utime(path, (now, now))
+
+    def set(self, key, value):
+        try:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError), e:
+            logger.warning('Render context %s not stored, it can\'t be pickled: %s' % (key, e))
+            return
+
+        path = self._path(key)
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        open(tmp_path, 'wb').write(data)
+        self._touch(tmp_path)
+        os.rename(tmp_path, path)
+
+        with self._lock:
+            files = self._files()
+
+            for mtime, path in files:
+                if self._is_expired(mtime):
+                    self._remove(path)
+            files = [ (mtime, path) for mtime, path in files if not self._is_expired(mtime) ]
+
+            for mtime, path in files[:max(0, len(files) - self.max_entries)]:
+                self._remove(path)
+                self.evicted += 1
+
+    def get(self, key, default=None):
+        path = self._path(key)
+
+        try:
+            if self._is_expired(os.path.getmtime(path)):
+                self._remove(path)
+                return default
+
+            value = pickle.loads(open(path, 'rb').read())
+        except Exception, e:
+            # Missing, removed in the meantime, or an invalid pickle.
+            # (Unpickling can raise about anything.)
+            return default
+
+        # Mark as most recently used.
+        try:
+            self._touch(path)
+        except OSError, e:
+            pass
+
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len([ f for f in self._files() if not self._is_expired(f[0]) ])
+
+    def clear(self):
+        with self._lock:
+            for mtime, path in self._files():
+                self._remove(path)
+
+
+_store = None
+
+def get_context_store():
+    """
+    Return the context store, as configured in the settings.
+    """
+    global _store
+
+    if _store is None:
+        path = getattr(settings, 'TEMPLATE_PREPROCESSOR_DEBUG_CONTEXT_STORE',
+                    'template_preprocessor.template.context_store.MemoryContextStore')
+        options = getattr(settings, 'TEMPLATE_PREPROCESSOR_DEBUG_CONTEXT_STORE_OPTIONS', { })
+
+        module, attr = path.rsplit('.', 1)
+        try:
+            class_ = getattr(import_module(module), attr)
+        except (ImportError, AttributeError), e:
+            raise ImproperlyConfigured('Error importing debug context store %s: "%s"' % (path, e))
+
+        _store = class_(**options)
+
+    return _store
@@ -13,10 +13,19 @@ from django.template import StringOrigin
 
 from template_preprocessor.core import compile
 from template_preprocessor.core.context import Context
+from template_preprocessor.core.utils import get_media_source_from_url, is_remote_url
+from template_preprocessor.template.context_store import get_context_store, create_key
+from template_preprocessor.template.precompiled import load_serialized_template, get_pack_path, TemplatePack
+from template_preprocessor.template.precompiled import template_digest, get_manifest_path, read_manifest, get_manifest_digest
+from template_preprocessor.template.precompiled import is_static_in_manifest, StaticTemplate
 from template_preprocessor.utils import get_options_for_path, execute_precompile_command
 
 import os
 import codecs
+import sys
+import threading
+import time
+import weakref
 
 
 # Override this compiler options for following template loaders
@@ -38,13 +47,79 @@ _OVERRIDE_OPTIONS_AT_DEBUG = [
         ]
 
 
+class SingleFlight(object):
+    """
+    Execute a function only once for concurrent calls with the same key. The
+    first thread does the work, the other threads wait for and share its
+    result (or exception).
+    """
+    class _Call(object):
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.exc_info = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = { }
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = self._Call()
+
+        if not is_leader:
+            call.event.wait()
+            if call.exc_info:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.result
+
+        try:
+            call.result = func()
+            return call.result
+        except:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+
+# Generation of the origin caches. Bumping this number invalidates the origin
+# caches of all the template loaders at once.
+_origin_cache_generation = [0]
+
+def invalidate_origin_caches():
+    """
+    Forget which loader provides which template, in every template loader.
+    (Call this when templates are added, moved or deleted.)
+    """
+    _origin_cache_generation[0] += 1
+
+
 class _Base(BaseLoader):
     is_usable = True
 
+    # Seconds during which we remember which loader provides a template. None
+    # means: until the cache is invalidated.
+    origin_cache_ttl = None
+
+    # Seconds during which we remember that a template does not exist.
+    # (Templates can be added by a deploy, without restarting the process.)
+    origin_cache_negative_ttl = 5
+
     def __init__(self, loaders):
         self._loaders = loaders
         self._cached_loaders = []
 
+        # (name, dirs) -> (loader, origin, expires). The loader is None for
+        # templates which don't exist.
+        self._origin_cache = { }
+        self._origin_cache_generation = _origin_cache_generation[0]
+
     @property
     def loaders(self):
         # Resolve loaders on demand to avoid circular imports
@@ -54,18 +129,60 @@ class _Base(BaseLoader):
         return self._cached_loaders
 
     def find_template(self, name, dirs=None):
+        if self._origin_cache_generation != _origin_cache_generation[0]:
+            self._origin_cache = { }
+            self._origin_cache_generation = _origin_cache_generation[0]
+
+        key = (name, tuple(dirs or ()))
+
+        # Ask the loader which found this template last time.
+        entry = self._origin_cache.get(key)
+
+        if entry and (entry[2] is None or entry[2] > time.time()):
+            loader, origin, expires = entry
+
+            if loader is None:
+                raise TemplateDoesNotExist(name)
+            else:
+                try:
+                    template, display_name = loader.load_template_source(name, dirs)
+                    self._template_found(name, display_name)
+                    return (template, origin)
+                except TemplateDoesNotExist, e:
+                    pass # Template has been moved, look again.
+
+        # Ask every loader.
+        def get_expires(ttl):
+            return None if ttl is None else time.time() + ttl
+
         for loader in self.loaders:
             try:
                 template, display_name = loader.load_template_source(name, dirs)
-                return (template, make_origin(display_name, loader.load_template_source, name, dirs))
+                origin = make_origin(display_name, loader.load_template_source, name, dirs)
+                self._origin_cache[key] = (loader, origin, get_expires(self.origin_cache_ttl))
+                self._template_found(name, display_name)
+                return (template, origin)
             except TemplateDoesNotExist, e:
                 pass
             except NotImplementedError, e:
                 raise Exception('Template loader %s does not implement load_template_source. Be sure not to nest '
                             'loaders which return only Template objects into the template preprocessor. (We need '
                             'a loader which returns a template string.)' % unicode(loader))
+
+        self._origin_cache[key] = (None, None, get_expires(self.origin_cache_negative_ttl))
         raise TemplateDoesNotExist(name)
 
+    def _template_found(self, name, display_name):
+        """
+        Called for every template source which is found. (Hook for
+        subclasses.)
+        """
+        pass
+
+    def reset(self):
+        "Empty the origin cache."
+        self._origin_cache.clear()
+
 
 class PreprocessedLoader(_Base):
     """
@@ -74,42 +191,173 @@ class PreprocessedLoader(_Base):
     """
     __cache_dir = settings.TEMPLATE_CACHE_DIR
 
+    # Use the Template objects serialized by `compile_templates --serialize-templates`
+    use_serialized_templates = False
+
+    # Look at the manifest, written by compile_templates, at most every N
+    # seconds, and forget the templates which have been recompiled since. This
+    # way, template deploys don't require restarting the workers.
+    # (None disables this.)
+    manifest_check_interval = getattr(settings, 'TEMPLATE_PREPROCESSOR_MANIFEST_CHECK_INTERVAL', 5)
+
     def __init__(self, loaders):
         _Base.__init__(self, loaders)
         self.template_cache = {}
+        self._template_digests = {} # key -> (lang, template_name, digest)
+        self._packs = {} # lang -> TemplatePack or None
+
+        # Languages for which the compiled template is identical share one
+        # Template object. (template_name, digest) -> Template
+        self._shared_templates = weakref.WeakValueDictionary()
+
+        self._next_manifest_check = 0
+        self._manifest_mtime = None
+        self._manifest_generation = None
+        self._manifest = None
+
+    def _get_pack(self, lang):
+        """
+        Return the template pack for this language, if one has been created by
+        `compile_templates --pack` or `--pack-per-language`.
+        """
+        packs = self._packs
+
+        if lang not in packs:
+            packs[lang] = None
+
+            for path in (get_pack_path(self.__cache_dir, lang), get_pack_path(self.__cache_dir)):
+                if os.path.exists(path):
+                    packs[lang] = TemplatePack(path)
+                    break
+
+        return packs[lang]
+
+    def _check_manifest(self):
+        """
+        Invalidate the cached templates of which the digest in the manifest
+        has changed.
+        """
+        now = time.time()
+        if now < self._next_manifest_check:
+            return
+
+        # (The manifest is read at least once, it tells which templates are static.)
+        if self.manifest_check_interval is None:
+            self._next_manifest_check = float('inf')
+        else:
+            self._next_manifest_check = now + self.manifest_check_interval
+
+        # Cheap check first: did the manifest file change?
+        try:
+            mtime = os.stat(get_manifest_path(self.__cache_dir)).st_mtime
+        except OSError, e:
+            return
+
+        if mtime == self._manifest_mtime:
+            return
+        self._manifest_mtime = mtime
+
+        manifest = read_manifest(self.__cache_dir)
+        if not manifest or manifest['generation'] == self._manifest_generation:
+            return
+        self._manifest_generation = manifest['generation']
+        self._manifest = manifest
+
+        # Templates can have been added or removed by this deploy.
+        invalidate_origin_caches()
+
+        # The packs have been rewritten as well. (Don't close the old ones,
+        # other threads can still be reading from them.)
+        self._packs = {}
+
+        for key, (lang, template_name, digest) in self._template_digests.items():
+            if get_manifest_digest(manifest, lang, template_name) != digest:
+                self.template_cache.pop(key, None)
+                self._template_digests.pop(key, None)
 
     def load_template(self, template_name, template_dirs=None):
         lang = translation.get_language() or 'en'
         key = '%s-%s' % (lang, template_name)
 
-        if key not in self.template_cache:
+        self._check_manifest()
+
+        # (Use a local reference, the manifest check in another thread can
+        # remove this entry at any time.)
+        result = self.template_cache.get(key)
+
+        if result is None:
             # Path in the cache directory
             output_path = os.path.join(self.__cache_dir, lang, template_name)
 
+            compiled_template = None
+            pack = self._get_pack(lang)
+            template = pack.get(lang, template_name) if pack else None
+
             # Load template
-            if os.path.exists(output_path):
+            if template is not None:
+                # Precompiled version from the template pack
+                origin = StringOrigin(template)
+                digest = pack.digest(lang, template_name)
+
+                if self.use_serialized_templates:
+                    compiled_template = pack.get_serialized(lang, template_name, template)
+
+            elif os.path.exists(output_path):
                 # Prefer precompiled version
                 template = codecs.open(output_path, 'r', 'utf-8').read()
                 origin = StringOrigin(template)
+                digest = template_digest(template)
+
+                if self.use_serialized_templates:
+                    compiled_template = load_serialized_template(output_path, template)
             else:
                 template, origin = self.find_template(template_name, template_dirs)
+                digest = None
 
                 # Compile template (we shouldn't compile anything at runtime.)
                 #template, context = compile(template, loader = lambda path: self.find_template(path)[0], path=template_name)
 
-            # Turn into Template object
-            template = get_template_from_string(template, origin, template_name)
+            # Turn into Template object, unless another language has the same one.
+            shared_template = self._shared_templates.get((template_name, digest)) if digest else None
+            manifest = self._manifest
+
+            if shared_template is not None:
+                template = shared_template
+            elif digest and manifest and get_manifest_digest(manifest, lang, template_name) == digest and \
+                        is_static_in_manifest(manifest, lang, template_name):
+                # Nothing to render, don't let Django parse it.
+                template = StaticTemplate(template, origin, template_name)
+                self._shared_templates[(template_name, digest)] = template
+            else:
+                template = compiled_template or get_template_from_string(template, origin, template_name)
+                if digest:
+                    self._shared_templates[(template_name, digest)] = template
 
             # Save in cache
-            self.template_cache[key] = template
+            self.template_cache[key] = result = template
+            self._template_digests[key] = (lang, template_name, digest)
 
         # Return result
-        return self.template_cache[key], None
+        return result, None
 
 
     def reset(self):
         "Empty the template cache."
+        _Base.reset(self)
         self.template_cache.clear()
+        self._template_digests.clear()
+        self._packs = {}
+        self._shared_templates.clear()
+
+
+class SerializedPreprocessedLoader(PreprocessedLoader):
+    """
+    Use preprocessed templates, and unpickle the Template objects which were
+    serialized by `compile_templates --serialize-templates` instead of parsing
+    the templates again. Templates without (valid) serialized version are
+    parsed as usual.
+    """
+    use_serialized_templates = True
 
 
 class RuntimeProcessedLoader(_Base):
@@ -119,7 +367,32 @@ class RuntimeProcessedLoader(_Base):
     context_class = Context
     options = _OVERRIDE_OPTIONS_AT_RUNTIME_PROCESSED
 
+    # Only the output is needed, don't let the preprocessor remember
+    # gettext entries, warnings and dependencies.
+    lean = True
+
+    # Templates can be created (or overridden in another directory) while
+    # the development server is running.
+    origin_cache_ttl = 2
+    origin_cache_negative_ttl = 2
+
+    def __init__(self, loaders):
+        _Base.__init__(self, loaders)
+        self._single_flight = SingleFlight()
+
     def load_template(self, template_name, template_dirs=None):
+        # Concurrent requests for the same template share one compilation.
+        key = (translation.get_language(), template_name, tuple(template_dirs or ()))
+        return self._single_flight.do(key, lambda: self._load_template(template_name, template_dirs))
+
+    def _load_template(self, template_name, template_dirs=None):
+        template, origin, context = self._compile_template(template_name, template_dirs)
+        return template, None
+
+    def _compile_template(self, template_name, template_dirs=None):
+        """
+        Compile template, return (Template object, origin, preprocess context)
+        """
         template, origin = self.find_template(template_name, template_dirs)
 
         # Precompile command
@@ -129,15 +402,134 @@ class RuntimeProcessedLoader(_Base):
         # Compile template
         template, context = compile(template, path=template_name, loader = lambda path: self.find_template(path)[0],
                         options=get_options_for_path(origin.name) + self.options,
-                        context_class=self.context_class)
+                        context_class=self.context_class, lean=self.lean)
 
         # Turn into Template object
         template = get_template_from_string(template, origin, template_name)
 
-        # Return result
+        return template, origin, context
+
+
+class CachedRuntimeProcessedLoader(RuntimeProcessedLoader):
+    """
+    Compile at runtime, but keep the compiled templates. For every template,
+    we remember the source files it was compiled from: the template itself,
+    everything it includes or extends, and the external media. These files
+    are checked at most every `dependency_check_interval` seconds, and only
+    the templates depending on a changed file are compiled again.
+    """
+    dependency_check_interval = getattr(settings, 'TEMPLATE_PREPROCESSOR_DEPENDENCY_CHECK_INTERVAL', 1)
+
+    # We need the dependencies.
+    lean = False
+
+    def __init__(self, loaders):
+        RuntimeProcessedLoader.__init__(self, loaders)
+        self._lock = threading.Lock()
+        self._found = threading.local()
+        self._next_dependency_check = 0
+
+        self.template_cache = { } # (lang, name, dirs) -> Template
+        self._dependencies = { } # (lang, name, dirs) -> { path: mtime }
+        self._dependents = { } # path -> set of (lang, name, dirs)
+
+    def load_template(self, template_name, template_dirs=None):
+        self._check_dependencies()
+
+        key = (translation.get_language(), template_name, tuple(template_dirs or ()))
+        template = self.template_cache.get(key)
+
+        if template is None:
+            return RuntimeProcessedLoader.load_template(self, template_name, template_dirs)
+        else:
+            return template, None
+
+    def _load_template(self, template_name, template_dirs=None):
+        key = (translation.get_language(), template_name, tuple(template_dirs or ()))
+
+        # Remember the paths of all the template sources which are read
+        # during this compilation.
+        self._found.paths = { }
+        try:
+            template, origin, context = self._compile_template(template_name, template_dirs)
+            found = self._found.paths
+        finally:
+            self._found.paths = None
+
+        paths = set()
+        if template_name in found:
+            paths.add(found[template_name])
+        for t in context.template_dependencies:
+            if t in found:
+                paths.add(found[t])
+        for url in context.media_dependencies:
+            if not is_remote_url(url):
+                paths.add(get_media_source_from_url(url))
+
+        dependencies = { }
+        for path in paths:
+            mtime = self._get_mtime(path)
+            if mtime is not None:
+                dependencies[path] = mtime
+
+        with self._lock:
+            self._forget(key)
+            self.template_cache[key] = template
+            self._dependencies[key] = dependencies
+            for path in dependencies:
+                self._dependents.setdefault(path, set()).add(key)
+
         return template, None
 
-context_cache = {} # TODO
+    def _template_found(self, name, display_name):
+        paths = getattr(self._found, 'paths', None)
+        if paths is not None and display_name:
+            paths[name] = display_name
+
+    def _get_mtime(self, path):
+        try:
+            return os.path.getmtime(path)
+        except (OSError, TypeError), e:
+            return None
+
+    def _check_dependencies(self):
+        """
+        Stat all the files we depend on, and forget the templates of which a
+        source file has been changed or removed.
+        """
+        if self.dependency_check_interval is None or time.time() < self._next_dependency_check:
+            return
+
+        with self._lock:
+            if time.time() < self._next_dependency_check:
+                return
+            self._next_dependency_check = time.time() + self.dependency_check_interval
+
+            # One stat per file, not per dependent template.
+            mtimes = dict((path, self._get_mtime(path)) for path in self._dependents)
+
+            for key, dependencies in self._dependencies.items():
+                if any(mtimes.get(path) != mtime for path, mtime in dependencies.iteritems()):
+                    self._forget(key)
+
+    def _forget(self, key):
+        # (Call with self._lock acquired.)
+        self.template_cache.pop(key, None)
+
+        for path in self._dependencies.pop(key, { }):
+            dependents = self._dependents.get(path)
+            if dependents is not None:
+                dependents.discard(key)
+                if not dependents:
+                    del self._dependents[path]
+
+    def reset(self):
+        RuntimeProcessedLoader.reset(self)
+        with self._lock:
+            self.template_cache.clear()
+            self._dependencies.clear()
+            self._dependents.clear()
+
 
 class DebugLoader(RuntimeProcessedLoader):
     """
@@ -151,8 +543,11 @@ class DebugLoader(RuntimeProcessedLoader):
 
     options = _OVERRIDE_OPTIONS_AT_DEBUG
 
-    def load_template(self, *args, **kwargs):
-        template, origin = RuntimeProcessedLoader.load_template(self, *args, **kwargs)
+    # Debug symbols are not inserted in lean mode.
+    lean = False
+
+    def _load_template(self, *args, **kwargs):
+        template, origin = RuntimeProcessedLoader._load_template(self, *args, **kwargs)
 
         # Wrap Template.render by a method which stores the render context in
         # the cache. (So we can have a webpage automatically render itself
@@ -168,20 +563,11 @@ class DebugLoader(RuntimeProcessedLoader):
 
     def _store_context(self, context):
         """
-        Store this context in the case, and return it's unique id.
+        Store this context in the context store, and return it's unique id.
+        (The store is bounded, old contexts expire or are evicted.)
         """
-        #from django.core.cache import cache
-
-        # TODO: Not yet using the real cache. We need
-        # to build a proxy around context, capture every get call, and
-        # meanwhile build a similar dict/list to be used for next rendering call.
-
-        import random, string
-        alphabet = string.ascii_letters
-        key = ''.join([alphabet[random.randint(0, len(string.ascii_letters) - 1)] for __ in range(0, 32)])
-
-        #cache.set('tp-context-cache-%s' % key, context)
-        context_cache['tp-context-cache-%s' % key] = context
+        key = create_key()
+        get_context_store().set('tp-context-cache-%s' % key, context)
         return key
 
 class ValidatorLoader(_Base):
@@ -191,6 +577,13 @@ class ValidatorLoader(_Base):
     when it fails to. But it still returns a Template object of the original
     template, without any caching.
     """
+    # (See RuntimeProcessedLoader)
+    origin_cache_ttl = 2
+    origin_cache_negative_ttl = 2
+
+    # Only validate, don't remember gettext entries, warnings and dependencies.
+    lean = True
+
     def load_template(self, template_name, template_dirs=None):
         # IMPORTANT NOTE:  We load the template, using the original loaders.
         #                  call compile, but still return the original,
@@ -212,7 +605,8 @@ class ValidatorLoader(_Base):
                 execute_precompile_command()
 
                 compile(template, loader = lambda path: self.find_template(path)[0], path=template_name,
-                            options=get_options_for_path(origin.name) + _OVERRIDE_OPTIONS_FOR_VALIDATION )
+                            options=get_options_for_path(origin.name) + _OVERRIDE_OPTIONS_FOR_VALIDATION,
+                            lean=self.lean)
 
         except Exception, e:
             # Print exception on console
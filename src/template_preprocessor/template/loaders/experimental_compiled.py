@@ -15,6 +15,7 @@ from template_preprocessor.render_engine.render import compile_tree, Template
 from template_preprocessor.core import compile_to_parse_tree
 
 from template_preprocessor.core import compile
+from template_preprocessor.template.loaders import _Base, SingleFlight
 
 import os
 import codecs
@@ -27,40 +28,27 @@ Implementation is probably like 75% finished.
 """
 
 
-class Loader(BaseLoader):
-    is_usable = True
+class Loader(_Base):
     __cache_dir = settings.TEMPLATE_CACHE_DIR
 
     def __init__(self, loaders):
+        _Base.__init__(self, loaders)
         self.template_cache = {}
-        self._loaders = loaders
-        self._cached_loaders = []
-
-    @property
-    def loaders(self):
-        # Resolve loaders on demand to avoid circular imports
-        if not self._cached_loaders:
-            for loader in self._loaders:
-                self._cached_loaders.append(find_template_loader(loader))
-        return self._cached_loaders
-
-    def find_template(self, name, dirs=None):
-        for loader in self.loaders:
-            try:
-                template, display_name = loader.load_template_source(name, dirs)
-                return (template, make_origin(display_name, loader.load_template_source, name, dirs))
-            except TemplateDoesNotExist:
-                pass
-            except NotImplementedError, e:
-                raise Exception('Template loader %s does not implement load_template_source. Be sure not to nest '
-                            'loaders which return only Template objects into the template preprocessor. (We need '
-                            'a loader which returns a template string.)' % unicode(loader))
-        raise TemplateDoesNotExist(name)
+        self._single_flight = SingleFlight()
 
     def load_template(self, template_name, template_dirs=None):
         lang = translation.get_language() or 'en'
         key = '%s-%s' % (lang, template_name)
 
+        if key not in self.template_cache:
+            # Concurrent requests for the same template share one compilation.
+            self._single_flight.do(key, lambda: self._load_template(key, lang, template_name, template_dirs))
+
+        # Return result
+        return self.template_cache[key], None
+
+    def _load_template(self, key, lang, template_name, template_dirs):
+        # Another thread could have finished compiling this template in the meantime.
         if key not in self.template_cache:
             # Path in the cache directory
             output_path = os.path.join(self.__cache_dir, 'cache', lang, template_name)
@@ -86,9 +74,7 @@ class Loader(BaseLoader):
             # Save in cache
             self.template_cache[key] = template
 
-        # Return result
-        return self.template_cache[key], None
-
     def reset(self):
         "Empty the template cache."
+        _Base.reset(self)
         self.template_cache.clear()
@@ -0,0 +1,425 @@
+# Author: Jonathan Slenders, City Live
+
+"""
+Helpers for reading and writing the precompiled templates in
+settings.TEMPLATE_CACHE_DIR. Used by the compile_templates command, and by the
+PreprocessedLoader.
+"""
+
+from django.template import StringOrigin, TemplateSyntaxError
+from django.template.loader import get_template_from_string
+from django.utils.safestring import mark_safe
+
+from hashlib import md5
+import cPickle as pickle
+import json
+import mmap
+import os
+import shutil
+import struct
+import time
+
+
+SERIALIZED_SUFFIX = '-c-serialized'
+
+
+def template_digest(source):
+    """
+    Digest of the compiled template source.
+    """
+    return md5(source.encode('utf-8')).hexdigest()
+
+
+# =======[ Compiled templates ]======
+
+# Many templates compile to exactly the same output in every language. The
+# compiled templates are therefore stored by digest in TEMPLATE_CACHE_DIR/objects/,
+# and TEMPLATE_CACHE_DIR/<lang>/<template> is a hard link to this file (or a
+# copy, on file systems without hard links.)
+
+OBJECTS_DIR = 'objects'
+
+
+def get_object_path(cache_dir, digest):
+    return os.path.join(cache_dir, OBJECTS_DIR, digest[:2], digest)
+
+
+def save_compiled_template(cache_dir, output_path, source):
+    """
+    Store the compiled template, and let output_path refer to it.
+    Return the digest.
+    """
+    digest = template_digest(source)
+    object_path = get_object_path(cache_dir, digest)
+
+    if not os.path.exists(object_path):
+        if not os.path.isdir(os.path.dirname(object_path)):
+            os.makedirs(os.path.dirname(object_path))
+
+        tmp_path = '%s.%s.tmp' % (object_path, os.getpid())
+        open(tmp_path, 'wb').write(source.encode('utf-8'))
+        _replace_file(tmp_path, object_path)
+
+    # Never write to output_path itself, other languages can share this file.
+    tmp_path = '%s.%s.tmp' % (output_path, os.getpid())
+    try:
+        os.link(object_path, tmp_path)
+    except (AttributeError, OSError), e:
+        shutil.copyfile(object_path, tmp_path)
+    _replace_file(tmp_path, output_path)
+
+    # The modification time tells compile_templates whether the template
+    # is up to date.
+    os.utime(output_path, None)
+
+    return digest
+
+
+def remove_unused_objects(cache_dir, digests):
+    """
+    Remove the stored compiled templates of which the digest is not in `digests`.
+    """
+    for root, dirs, files in os.walk(os.path.join(cache_dir, OBJECTS_DIR)):
+        for f in files:
+            if f not in digests:
+                os.remove(os.path.join(root, f))
+
+
+# =======[ Static templates ]======
+
+# Templates without any template tag or variable left after compilation
+# (error pages, e-mail footers, ...) always render the same output. The
+# manifest marks them as static, and the loader returns a StaticTemplate
+# instead of letting Django parse them.
+
+
+def is_static_template(source):
+    """
+    True when Django would render this compiled template as-is.
+    """
+    return not ('{%' in source or '{{' in source or '{#' in source)
+
+
+class StaticTemplate(object):
+    """
+    Template-compatible object for a static template. `render` returns the
+    source, without nodes or context lookups.
+    """
+    def __init__(self, source, origin=None, name=None):
+        self.source = mark_safe(source)
+        self.origin = origin
+        self.name = name
+
+    def render(self, context):
+        return self.source
+
+    _render = render
+
+    @property
+    def nodelist(self):
+        # Only for code which looks at the nodes. (e.g. {% extends %})
+        from django.template import NodeList, TextNode
+        return NodeList([ TextNode(self.source) ])
+
+    def __iter__(self):
+        for node in self.nodelist:
+            for subnode in node:
+                yield subnode
+
+
+# =======[ Serialized Template objects ]======
+
+# Parsing a big template into a Django Template object is expensive, and it
+# happens in every worker after every restart. So, compile_templates can also
+# store the parsed Template (nodelist and origin) in a pickle, next to the
+# compiled template.  Node types which can't be pickled make this fail, in
+# which case we don't store anything, and the loader parses the template
+# as usual.
+#
+# NOTE: the pickles are only to be read from TEMPLATE_CACHE_DIR. Never unpickle
+#       files from untrusted sources.
+
+
+def serialize_template(source, template_name):
+    """
+    Parse the compiled template source, and return the pickled Template
+    object, or None when some node in the template can't be pickled.
+    """
+    try:
+        template = get_template_from_string(source, StringOrigin(source), template_name)
+    except TemplateSyntaxError, e:
+        # Will fail at runtime as well, but that's not our business here.
+        return None
+
+    try:
+        return pickle.dumps((template_digest(source), template), pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return None
+
+
+def save_serialized_template(output_path, source, template_name):
+    """
+    Store the serialized Template next to the compiled template. Return True
+    on success.
+    """
+    data = serialize_template(source, template_name)
+
+    if data is None:
+        remove_serialized_template(output_path)
+        return False
+    else:
+        open(output_path + SERIALIZED_SUFFIX, 'wb').write(data)
+        return True
+
+
+def remove_serialized_template(output_path):
+    if os.path.exists(output_path + SERIALIZED_SUFFIX):
+        os.remove(output_path + SERIALIZED_SUFFIX)
+
+
+def load_serialized_template(output_path, source):
+    """
+    Return the serialized Template object for this compiled template,
+    or None when there is no (valid) serialized version.
+    """
+    path = output_path + SERIALIZED_SUFFIX
+
+    if os.path.exists(path):
+        return unpickle_serialized_template(open(path, 'rb').read(), source)
+
+
+def read_serialized_template(output_path):
+    """
+    Return the pickle stored next to the compiled template, or None.
+    """
+    path = output_path + SERIALIZED_SUFFIX
+
+    if os.path.exists(path):
+        return open(path, 'rb').read()
+
+
+def unpickle_serialized_template(data, source):
+    """
+    Return the Template object of this pickle, or None when it's not valid
+    for this compiled template.
+    """
+    try:
+        digest, template = pickle.loads(data)
+    except Exception, e:
+        # Unpickling can raise about anything for outdated pickles. (e.g.
+        # when node classes have been renamed.) Parse the template instead.
+        return None
+
+    # Only use it if the pickle belongs to this version of the template.
+    if digest == template_digest(source):
+        return template
+
+
+# =======[ Template packs ]======
+
+# A pack contains all the compiled templates of one language, or of all
+# languages, in a single file. This way, a deploy only has to copy one file,
+# and the loader maps the pack into memory instead of opening one file for
+# every template.
+#
+# Layout:
+#     PACK_MAGIC
+#     length of the index (8 bytes, big endian)
+#     index (JSON): { "<lang>/<template>": [ offset, length, digest ], ... }
+#     data (utf-8), offsets are relative to the start of the data.
+#
+# Identical templates are stored only once, their index entries are the same.
+# When the pack contains the serialized Template object of a template, its
+# index entry has two more items: offset and length of the pickle, which is
+# stored in the data as well. (So the loader doesn't have to open the
+# separate -c-serialized files.)
+
+PACK_MAGIC = 'TPPACK1\n'
+PACK_NAME = 'templates.pack'
+
+
+def get_pack_path(cache_dir, lang=None):
+    """
+    Path of the pack which contains all languages, or only `lang`.
+    """
+    if lang:
+        return os.path.join(cache_dir, 'templates-%s.pack' % lang)
+    else:
+        return os.path.join(cache_dir, PACK_NAME)
+
+
+def _pack_key(lang, template_name):
+    return u'%s/%s' % (lang, template_name)
+
+
+def write_template_pack(path, templates, serialized=None):
+    """
+    Write a pack. `templates` is a list of (lang, template_name, source)
+    tuples, `serialized` an optional { (lang, template_name): pickle } dict
+    of serialized Template objects. The file is replaced atomically, so that
+    running processes never see a half written pack.
+    """
+    serialized = serialized or { }
+    index = { }
+    stored = { } # digest -> [ offset, length ]
+    data = []
+    offset = [ 0 ]
+
+    def store(encoded):
+        digest = md5(encoded).hexdigest()
+        if digest not in stored:
+            stored[digest] = [ offset[0], len(encoded) ]
+            data.append(encoded)
+            offset[0] += len(encoded)
+        return stored[digest]
+
+    for lang, template_name, source in templates:
+        encoded = source.encode('utf-8')
+        entry = store(encoded) + [ template_digest(source) ]
+
+        pickled = serialized.get((lang, template_name))
+        if pickled:
+            entry += store(pickled)
+
+        index[_pack_key(lang, template_name)] = entry
+
+    index = json.dumps(index, sort_keys=True)
+
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    f = open(tmp_path, 'wb')
+    try:
+        f.write(PACK_MAGIC)
+        f.write(struct.pack('>Q', len(index)))
+        f.write(index)
+        for d in data:
+            f.write(d)
+    finally:
+        f.close()
+
+    _replace_file(tmp_path, path)
+
+
+def _replace_file(source, destination):
+    # os.rename does not overwrite existing files on Windows.
+    if os.name == 'nt' and os.path.exists(destination):
+        os.remove(destination)
+    os.rename(source, destination)
+
+
+class TemplatePack(object):
+    """
+    Read-only, memory mapped template pack.
+    """
+    def __init__(self, path):
+        self.path = path
+
+        f = open(path, 'rb')
+        try:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        if self._mmap[:len(PACK_MAGIC)] != PACK_MAGIC:
+            raise Exception('%s is not a template pack' % path)
+
+        index_start = len(PACK_MAGIC) + 8
+        index_length, = struct.unpack('>Q', self._mmap[len(PACK_MAGIC):index_start])
+
+        self._index = json.loads(self._mmap[index_start:index_start + index_length])
+        self._data_start = index_start + index_length
+
+    def __contains__(self, key):
+        return _pack_key(*key) in self._index
+
+    def get(self, lang, template_name):
+        """
+        Return the compiled template source, or None when this template is
+        not in the pack.
+        """
+        entry = self._index.get(_pack_key(lang, template_name))
+
+        if entry:
+            start = self._data_start + entry[0]
+            return self._mmap[start:start + entry[1]].decode('utf-8')
+
+    def digest(self, lang, template_name):
+        entry = self._index.get(_pack_key(lang, template_name))
+        return entry[2] if entry else None
+
+    def get_serialized(self, lang, template_name, source):
+        """
+        Return the serialized Template object for this template, or None when
+        the pack doesn't contain a (valid) one.
+        """
+        entry = self._index.get(_pack_key(lang, template_name))
+
+        if entry and len(entry) > 3:
+            start = self._data_start + entry[3]
+            return unpickle_serialized_template(self._mmap[start:start + entry[4]], source)
+
+    def close(self):
+        self._mmap.close()
+
+
+# =======[ Manifest ]======
+
+# The manifest is written at the end of every compile_templates run. It
+# contains the digest of every compiled template, the list of static
+# templates, and a generation which is unique for every run. (A timestamp and
+# a random token, it never repeats, also not when `compile_templates --all`
+# removed the previous manifest.) Running PreprocessedLoaders look at it from
+# time to time, and only forget the templates of which the digest changed.
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def get_manifest_path(cache_dir):
+    return os.path.join(cache_dir, MANIFEST_NAME)
+
+
+def read_manifest(cache_dir):
+    """
+    Return the manifest as a dict, or None when there is no (valid) manifest.
+    """
+    try:
+        manifest = json.loads(open(get_manifest_path(cache_dir), 'rb').read())
+    except (IOError, ValueError), e:
+        return None
+
+    if isinstance(manifest, dict) and 'generation' in manifest and 'templates' in manifest:
+        manifest['static'] = set(manifest.get('static', []))
+        return manifest
+
+
+def create_manifest_generation():
+    return '%i-%s' % (time.time(), os.urandom(8).encode('hex'))
+
+
+def write_manifest(cache_dir, templates):
+    """
+    Write a new generation of the manifest, atomically.
+    `templates` is a list of (lang, template_name, source) tuples.
+    """
+    manifest = {
+        'generation': create_manifest_generation(),
+        'templates': dict((_pack_key(lang, template_name), template_digest(source))
+                                    for lang, template_name, source in templates),
+        'static': sorted(_pack_key(lang, template_name)
+                                    for lang, template_name, source in templates
+                                    if is_static_template(source)),
+    }
+
+    path = get_manifest_path(cache_dir)
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    open(tmp_path, 'wb').write(json.dumps(manifest, sort_keys=True))
+    _replace_file(tmp_path, path)
+
+    return manifest
+
+
+def get_manifest_digest(manifest, lang, template_name):
+    return manifest['templates'].get(_pack_key(lang, template_name))
+
+
+def is_static_in_manifest(manifest, lang, template_name):
+    return _pack_key(lang, template_name) in manifest['static']
@@ -0,0 +1,11 @@
+"""
+Tests for the template preprocessor.
+
+Run them from the test project:
+    cd src/test_project; ./manage.py test template_preprocessor
+"""
+
+from template_preprocessor.tests.context_store import *
+from template_preprocessor.tests.loaders import *
+from template_preprocessor.tests.precompiled import *
+from template_preprocessor.tests.compile import *
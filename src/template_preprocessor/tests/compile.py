@@ -0,0 +1,423 @@
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.template import Template, Context as TemplateContext
+from django.utils import translation
+from django.utils import unittest
+
+from template_preprocessor import core
+from template_preprocessor.core import compile, compile_many, compile_language_neutral, specialize_for_language
+from template_preprocessor.core.context import Context
+from template_preprocessor.core.django_processor import NotLanguageNeutral
+from template_preprocessor.core.lexer import CompileException
+from template_preprocessor.core.preprocessable_template_tags import preprocess_tag, NotPreprocessable, \
+            get_preprocessable_tags, get_preprocessable_tag_stats
+from template_preprocessor.core.run_cache import clear_run_caches
+
+
+__all__ = ('SharedCompilePhaseTest', 'NoHtmlFallbackTest', 'IncludeBudgetTest', 'CompileManyTest', 'ConstantFoldingTest', 'LoadPruningTest', 'PreprocessableTagTest', )
+
+
+class CompileTestCase(unittest.TestCase):
+    """
+    Compile with fake translations, and with the templates in `self.templates`
+    for {% include %} and {% extends %}.
+    """
+    translations = { }
+    templates = { }
+
+    def setUp(self):
+        self._ugettext = translation.ugettext
+        translation.ugettext = lambda message: self.translations.get(message, message)
+        translation.activate('fr')
+        clear_run_caches()
+
+    def tearDown(self):
+        translation.ugettext = self._ugettext
+        translation.deactivate()
+        clear_run_caches()
+
+    def load(self, path):
+        return self.templates[path]
+
+    def compile(self, source, options=None):
+        return compile(source, loader=self.load, options=options)[0]
+
+    def compile_shared(self, source, options=None):
+        tree, context = compile_language_neutral(source, loader=self.load, options=options)
+        return specialize_for_language(tree, context)
+
+
+class SharedCompilePhaseTest(CompileTestCase):
+    translations = {
+        'Date': u'Date',
+        'Date (with time)': u"Date (avec l'heure)",
+        'Spaces': u'a   \n  b',
+        'Entity': u'a &amp; b',
+        'Ampersand': u'a & b',
+        'Quote': u'a " b',
+        'Greater than': u'a > b',
+        'Comment': u'a --> b',
+        'HTML': u'<b>a</b>',
+    }
+
+    def assertSameOutput(self, source):
+        self.assertEqual(self.compile_shared(source), self.compile(source))
+
+    def assertNotShared(self, source):
+        # Falls back to compiling for each language, which raises the
+        # CompileException as well.
+        self.assertRaises(NotLanguageNeutral, self.compile_shared, source)
+        self.assertRaises(CompileException, self.compile, source)
+
+    def test_text(self):
+        self.assertSameOutput(u'<p>{% trans "Date" %}</p>')
+        self.assertSameOutput(u'<p>{% trans "Spaces" %}</p>')
+        self.assertSameOutput(u'<p>{% trans "Entity" %}</p>')
+        self.assertNotShared(u'<p>{% trans "Ampersand" %}</p>')
+        self.assertNotShared(u'<p>{% trans "Greater than" %}</p>')
+
+    def test_html_in_translation(self):
+        self.assertRaises(NotLanguageNeutral, self.compile_shared, u'<p>{% trans "HTML" %}</p>')
+        self.assertEqual(self.compile(u'<p>{% trans "HTML" %}</p>'), u'<p><b>a</b></p>')
+
+    def test_attributes(self):
+        self.assertSameOutput(u'<input type="text" value="{% trans "Date (with time)" %}" />')
+        self.assertSameOutput(u'<p title="{% trans "Spaces" %}">{% trans "Spaces" %}</p>')
+        self.assertSameOutput(u'<p title="{% trans "Greater than" %}"></p>')
+        self.assertNotShared(u'<input type="text" value=\'{% trans "Date (with time)" %}\' />')
+        self.assertNotShared(u'<input type="text" value="{% trans "Quote" %}" />')
+        self.assertNotShared(u'<input type="text" value="{% trans "Ampersand" %}" />')
+
+    def test_comment(self):
+        self.assertSameOutput(u'<p><!-- {% trans "Date" %} --></p>')
+        self.assertNotShared(u'<p><!-- {% trans "Comment" %} --></p>')
+
+    def test_gettext_entries(self):
+        # Remembered only once, also when specialized for several languages.
+        source = u'<p>{% trans "Date" %}</p><script type="text/javascript">alert(gettext("Spaces"));</script>'
+
+        tree, shared_context = compile_language_neutral(source, loader=self.load)
+        for lang in ('fr', 'nl'):
+            translation.activate(lang)
+            specialize_for_language(tree, shared_context)
+        output, context = compile(source, loader=self.load)
+
+        entries = lambda context: [ (e.path, e.line, e.column, e.text) for e in context.gettext_entries ]
+        self.assertEqual(len(entries(context)), 2)
+        self.assertEqual(entries(shared_context), entries(context))
+
+    def test_unquoted_attribute(self):
+        self.assertRaises(NotLanguageNeutral, self.compile_shared, u'<input type="text" value={% trans "Date" %} />')
+
+
+class NoHtmlFallbackTest(CompileTestCase):
+    """
+    compile_templates uses the output before the HTML compiler, when the HTML
+    compiler fails. It should be the same as the output with no-html.
+    """
+    class KeepingContext(Context):
+        def __init__(self, *args, **kwargs):
+            Context.__init__(self, *args, **kwargs)
+            self.keep_output_before_html = True
+
+    def assertSameAsNoHtml(self, source):
+        output, context = compile(source, options=['html'], context_class=self.KeepingContext)
+        self.assertEqual(context.output_before_html, self.compile(source, options=['no-html']))
+
+    def test_output_before_html(self):
+        self.assertSameAsNoHtml(u'<p>{{ x }}</p>')
+
+    def test_pruned_load_tags(self):
+        self.assertSameAsNoHtml(u'{% load i18n static %}<p>{% get_static_prefix %} {% trans "a" %}</p>')
+        self.assertSameAsNoHtml(u'{% load get_static_prefix from static %}{% load i18n cache %}'
+                    u'<p>{% cache 10 a %}{% trans "a" %}{% endcache %}{% get_static_prefix %}</p>')
+
+
+class IncludeBudgetTest(CompileTestCase):
+    templates = {
+        'big.html': u'<p>{{x}} %s</p>' % (u'a' * 100),
+        'small.html': u'<b>{{x}}</b>',
+        'macro.html': u'{% macro "m" %}<p>' + u'a' * 100 + u'</p>{% endmacro %}{% callmacro "m" %}',
+        'twice.html': u'{% include "small.html" %}{% include "small.html" %}',
+        'base.html': u'<div>{% include "block.html" %}</div>',
+        'block.html': u'<p>{% block b %}' + u'a' * 100 + u'{% endblock %}</p>',
+        'option.html': u'{% ! no-whitespace-compression %}<p>' + u'a' * 100 + u'</p>',
+    }
+
+    def load(self, path):
+        self.loaded.append(path)
+        return CompileTestCase.load(self, path)
+
+    def setUp(self):
+        CompileTestCase.setUp(self)
+        self.loaded = [ ]
+
+    def test_no_budget(self):
+        self.assertEqual(self.compile(u'{% include "big.html" %}'), self.templates['big.html'])
+        self.assertEqual(self.compile(u'{% include "big.html" %}', ['include-inline-budget=1000']),
+                        self.templates['big.html'])
+
+    def test_over_budget(self):
+        self.assertEqual(self.compile(u'{% include "big.html" %}{% include "small.html" %}', ['include-inline-budget=50']),
+                        u'{%include "big.html"%}<b>{{x}}</b>')
+
+    def test_with_tag_kept(self):
+        # "x" is a constant in the {% with %}, but the runtime include still uses it.
+        source = u'{% with "abc" as x %}{% include "big.html" %}{% endwith %}'
+        self.assertEqual(self.compile(source), u'<p>abc %s</p>' % (u'a' * 100))
+        self.assertEqual(self.compile(source, ['include-inline-budget=50']),
+                        u'{%with "abc" as x %}{%include "big.html"%}{%endwith %}')
+        self.assertEqual(self.compile(u'{% with "abc" as x %}{% include name %}{% endwith %}'),
+                        u'{%with "abc" as x %}{%include name%}{%endwith %}')
+
+    def test_not_parsed_over_budget(self):
+        # The budget is enforced while inlining: big.html is parsed once.
+        self.assertEqual(self.compile(u'{% include "big.html" %}{% include "big.html" %}', ['include-inline-budget=50']),
+                        u'{%include "big.html"%}{%include "big.html"%}')
+        self.assertEqual(self.loaded, [ 'big.html' ])
+
+    def test_nested_includes(self):
+        # small.html is inlined twice in twice.html, for every include of twice.html.
+        self.assertEqual(self.compile(u'{% include "twice.html" %}', ['include-inline-budget=40']),
+                        u'<b>{{x}}</b><b>{{x}}</b>')
+
+        # Four times is over budget: small.html is not even parsed twice.
+        self.loaded = [ ]
+        self.assertEqual(self.compile(u'{% include "twice.html" %}{% include "twice.html" %}', ['include-inline-budget=40']),
+                        u'{%include "twice.html"%}{%include "twice.html"%}')
+        self.assertEqual(self.loaded, [ 'twice.html', 'small.html' ])
+
+    def test_overridden_blocks_are_inlined(self):
+        # Reverting block.html would drop the block of the extending template.
+        source = u'{% extends "base.html" %}{% block b %}' + u'b' * 100 + u'{% endblock %}'
+        self.assertEqual(self.compile(source, ['include-inline-budget=50']), u'<div><p>%s</p></div>' % (u'b' * 100))
+
+    def test_options_are_inlined(self):
+        self.assertEqual(self.compile(u'{% include "option.html" %}\n\n<b> </b>', ['include-inline-budget=50']),
+                        u'<p>%s</p>\n\n<b> </b>' % (u'a' * 100))
+
+    def test_macros_are_inlined(self):
+        self.assertEqual(self.compile(u'{% include "macro.html" %}', ['include-inline-budget=50']),
+                        u'<p>%s</p>' % (u'a' * 100))
+
+
+class CompileManyTest(CompileTestCase):
+    translations = {
+        'html': u'<i>%s</i>',
+    }
+    templates = {
+        'neutral.html': u'<p title="{% trans "a" %}">{% trans "b" %}</p>{% include "included.html" %}',
+        'per_language.html': u'<p>{% trans "html" %}</p>',
+        'included.html': u'<b>{% trans "c" %}</b>',
+    }
+
+    def setUp(self):
+        CompileTestCase.setUp(self)
+        translation.ugettext = lambda message: self.translations.get(message, message + u'-%s') % translation.get_language()
+
+        self.dir = tempfile.mkdtemp()
+        for name in ('neutral.html', 'per_language.html'):
+            open(os.path.join(self.dir, name), 'w').write(self.templates[name])
+
+        # Count the templates which are compiled for each language.
+        self._compile = core.compile
+        self.compiled = [ ]
+        def counting_compile(code, path='', *args, **kwargs):
+            self.compiled.append((path, translation.get_language()))
+            return self._compile(code, path, *args, **kwargs)
+        core.compile = counting_compile
+
+    def tearDown(self):
+        core.compile = self._compile
+        shutil.rmtree(self.dir)
+        CompileTestCase.tearDown(self)
+
+    def compile_many(self, names, languages):
+        paths = [ os.path.join(self.dir, name) for name in names ]
+        return [ (os.path.basename(path), lang, output) for path, lang, output, context in
+                    compile_many(paths, languages, options=[], loader=self.load) ]
+
+    def test_same_output(self):
+        results = self.compile_many([ 'neutral.html', 'per_language.html' ], [ 'fr', 'nl' ])
+        self.assertEqual(len(results), 4)
+
+        for name, lang, output in results:
+            translation.activate(lang)
+            self.assertEqual(output, self.compile(self.templates[name], []))
+
+        self.assertEqual(results[0][2], u'<p title="a-fr">b-fr</p><b>c-fr</b>')
+        self.assertEqual(results[1][2], u'<p title="a-nl">b-nl</p><b>c-nl</b>')
+        self.assertEqual(results[3][2], u'<p><i>nl</i></p>')
+
+    def test_shared_compile_phase(self):
+        self.compile_many([ 'neutral.html', 'per_language.html' ], [ 'fr', 'nl' ])
+        self.assertEqual([ (os.path.basename(path), lang) for path, lang in self.compiled ],
+                        [ ('per_language.html', 'fr'), ('per_language.html', 'nl') ])
+
+    def test_missing_file(self):
+        results = self.compile_many([ 'missing.html', 'neutral.html' ], [ 'fr', 'nl' ])
+
+        self.assertEqual([ (name, lang) for name, lang, output in results ],
+                        [ ('missing.html', 'fr'), ('missing.html', 'nl'), ('neutral.html', 'fr'), ('neutral.html', 'nl') ])
+        self.assertTrue(isinstance(results[0][2], CompileException))
+        self.assertEqual(results[2][2], u'<p title="a-fr">b-fr</p><b>c-fr</b>')
+
+
+class ConstantFoldingTest(CompileTestCase):
+    """
+    The folded template renders the same as the template without folding.
+    """
+    context = { 'y': 'Y', 'items': [ 1, 2 ] }
+
+    def assertFolded(self, source, expected):
+        folded = self.compile(source, [ 'no-html' ])
+        self.assertEqual(folded, expected)
+        self.assertEqual(Template(folded).render(TemplateContext(self.context)),
+                    Template(self.compile(source, [ 'no-html', 'no-condition-preprocessing' ])).render(
+                            TemplateContext(self.context)))
+
+    def test_if(self):
+        self.assertFolded(u'{% if 1 %}a{% else %}b{% endif %}', u'a')
+        self.assertFolded(u'{% if "" %}a{% else %}b{% endif %}', u'b')
+        self.assertFolded(u'{% if not 0 and "x" %}a{% endif %}', u'a')
+        self.assertFolded(u'{% if 1 > 2 %}a{% endif %}', u'')
+        self.assertFolded(u'{% if y %}a{% endif %}', u'{%if y%}a{%endif%}')
+        self.assertFolded(u'{% if 1 %}{% if y %}a{% endif %}{% endif %}', u'{%if y%}a{%endif%}')
+
+    def test_ifequal(self):
+        self.assertFolded(u'{% ifequal 1 1 %}a{% else %}b{% endifequal %}', u'a')
+        self.assertFolded(u'{% ifequal "a" "b" %}a{% else %}b{% endifequal %}', u'b')
+        self.assertFolded(u'{% ifequal y "Y" %}a{% endifequal %}', u'{%ifequal y "Y"%}a{%endifequal%}')
+
+    def test_ifdebug(self):
+        debug = settings.DEBUG
+        settings.DEBUG = True
+        try:
+            # Django doesn't put DEBUG in the template context.
+            self.assertFolded(u'{% if DEBUG %}a{% else %}b{% endif %}', u'{%if DEBUG%}a{%else%}b{%endif%}')
+            self.assertEqual(self.compile(u'{% if DEBUG %}a{% else %}b{% endif %}',
+                        [ 'no-html', 'ifdebug-preprocessing' ]), u'a')
+        finally:
+            settings.DEBUG = debug
+
+    def test_with(self):
+        self.assertFolded(u'{% with "abc" as x %}{% if x == "abc" %}{{ x }}{% endif %}{% endwith %}', u'abc')
+
+        # The name is still used by a tag.
+        self.assertFolded(u'{% with "abc" as x %}{{ x|upper }}{% endwith %}',
+                    u'{%with "abc" as x %}{{x|upper}}{%endwith %}')
+
+        # {% for %} binds the name to something else.
+        self.assertFolded(u'{% with "abc" as x %}{% for x in items %}{{ x }}{% endfor %}{% endwith %}',
+                    u'{%with "abc" as x %}{%for x in items %}{{x}}{%endfor %}{%endwith %}')
+
+        # A macro is expanded after folding, and sees the name.
+        self.assertFolded(u'{% macro "m" %}{{ x }}{% endmacro %}{% with "abc" as x %}{% callmacro "m" %}{% endwith %}',
+                    u'{%with "abc" as x %}{{x}}{%endwith %}')
+
+        # A custom tag can read the name from the context.
+        self.assertEqual(self.compile(u'{% with "abc" as x %}{% custom_tag %}{% endwith %}', [ 'no-html' ]),
+                    u'{%with "abc" as x %}{%custom_tag %}{%endwith %}')
+
+        # Unknown values
+        self.assertFolded(u'{% with y as x %}{% if x %}a{% endif %}{% endwith %}',
+                    u'{%with y as x %}{%if x%}a{%endif%}{%endwith %}')
+
+    def test_load_in_other_branch(self):
+        # Django executes {% load %} at parse time, also in branches which are never rendered.
+        self.assertFolded(u'{% if 0 %}{% load static %}{% endif %}{% get_static_prefix %}',
+                    u'{% load static%}{%get_static_prefix %}')
+
+
+class LoadPruningTest(CompileTestCase):
+    def assertPruned(self, source, expected):
+        pruned = self.compile(source, [ 'no-html' ])
+        self.assertEqual(pruned, expected)
+        self.assertEqual(Template(pruned).render(TemplateContext({ 'y': 'Y' })),
+                    Template(self.compile(source, [ 'no-html', 'no-load-tag-pruning' ])).render(TemplateContext({ 'y': 'Y' })))
+
+    def test_unused_libraries(self):
+        self.assertPruned(u'{% load i18n %}{% trans "a" %}', u'a')
+        self.assertPruned(u'{% load i18n static %}{% trans "a" %}{% get_static_prefix %}',
+                    u'{% load static%}a{%get_static_prefix %}')
+
+    def test_used_libraries(self):
+        self.assertPruned(u'{% load i18n %}{% trans y %}', u'{% load i18n%}{%trans y%}')
+        self.assertPruned(u'{% load cache %}{% cache 10 a %}{{ y }}{% endcache %}',
+                    u'{% load cache%}{%cache 10 a %}{{y}}{%endcache %}')
+
+    def test_load_from(self):
+        # {% load name from library %} is kept.
+        self.assertPruned(u'{% load get_static_prefix from static %}a', u'{% load get_static_prefix from static%}a')
+
+    def test_no_html_fallback_output(self):
+        # Also in the output before the HTML compiler, see NoHtmlFallbackTest.
+        output, context = compile(u'{% load i18n %}<p>{% trans "a" %}</p>', options=[ 'html' ],
+                    context_class=NoHtmlFallbackTest.KeepingContext)
+        self.assertEqual(context.output_before_html, u'<p>a</p>')
+
+
+# Preprocessable tags for PreprocessableTagTest. (Calls are (tag, args, language) tuples.)
+_tag_calls = [ ]
+
+@preprocess_tag('test_pure_tag', pure=True)
+def _test_pure_tag(*args):
+    _tag_calls.append((args[0], args[1:], translation.get_language()))
+    if args[1:] == ('"skip"', ):
+        raise NotPreprocessable()
+    return u'pure-%s' % translation.get_language()
+
+@preprocess_tag('test_none_tag', pure=True)
+def _test_none_tag(*args):
+    _tag_calls.append((args[0], args[1:], translation.get_language()))
+    return None
+
+@preprocess_tag('test_tag')
+def _test_tag(*args):
+    _tag_calls.append((args[0], args[1:], translation.get_language()))
+    return u'tag'
+
+
+class PreprocessableTagTest(CompileTestCase):
+    def setUp(self):
+        CompileTestCase.setUp(self)
+        del _tag_calls[:]
+
+    def test_pure(self):
+        self.assertEqual(self.compile(u'{% test_pure_tag "a" %}', [ 'no-html' ]), u'pure-fr')
+        self.assertEqual(self.compile(u'{% test_pure_tag "a" %}{% test_pure_tag "a" %}', [ 'no-html' ]), u'pure-frpure-fr')
+        self.assertEqual(_tag_calls, [ ('test_pure_tag', ('"a"', ), 'fr') ])
+        self.assertTrue(('test_pure_tag', 3, 2) in [ s[:3] for s in get_preprocessable_tag_stats() ])
+
+    def test_pure_per_language(self):
+        self.compile(u'{% test_pure_tag "a" %}', [ 'no-html' ])
+        translation.activate('nl')
+        self.assertEqual(self.compile(u'{% test_pure_tag "a" %}', [ 'no-html' ]), u'pure-nl')
+        self.assertEqual(len(_tag_calls), 2)
+
+    def test_pure_for_one_run(self):
+        self.compile(u'{% test_pure_tag "a" %}', [ 'no-html' ])
+        clear_run_caches()
+        self.compile(u'{% test_pure_tag "a" %}', [ 'no-html' ])
+        self.assertEqual(len(_tag_calls), 2)
+        self.assertEqual([ s[:3] for s in get_preprocessable_tag_stats() ], [ ('test_pure_tag', 1, 0) ])
+
+    def test_not_preprocessable(self):
+        # Remembered as well, and the tag is kept.
+        self.assertEqual(self.compile(u'{% test_pure_tag "skip" %}{% test_pure_tag "skip" %}', [ 'no-html' ]),
+                    u'{%test_pure_tag "skip" %}{%test_pure_tag "skip" %}')
+        self.assertEqual(len(_tag_calls), 1)
+
+    def test_pure_none(self):
+        # None is a result as well.
+        tag = get_preprocessable_tags()['test_none_tag']
+        self.assertEqual(tag('test_none_tag'), None)
+        self.assertEqual(tag('test_none_tag'), None)
+        self.assertEqual(len(_tag_calls), 1)
+
+    def test_not_pure(self):
+        self.assertEqual(self.compile(u'{% test_tag %}{% test_tag %}', [ 'no-html' ]), u'tagtag')
+        self.assertEqual(len(_tag_calls), 2)
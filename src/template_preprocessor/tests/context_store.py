@@ -0,0 +1,110 @@
+from django.utils import unittest
+
+from template_preprocessor.template.context_store import MemoryContextStore, FileContextStore
+
+import os
+import shutil
+import tempfile
+import threading
+
+
+__all__ = ('MemoryContextStoreTest', 'FileContextStoreTest', )
+
+
+class MemoryContextStoreTest(unittest.TestCase):
+    """
+    The stores use a fake clock, which the tests move forward in steps of
+    whole seconds. (File systems can have a 1 or 2 seconds mtime resolution.)
+    """
+    def setUp(self):
+        self.now = 1000000
+
+    def create_store(self, **kwargs):
+        store = MemoryContextStore(**kwargs)
+        store._time = lambda: self.now
+        return store
+
+    def test_set_and_get(self):
+        store = self.create_store()
+        store.set('a', { 'x': 1 })
+        self.assertEqual(store.get('a'), { 'x': 1 })
+        self.assertEqual(store.get('b', 'default'), 'default')
+
+    def test_lru_eviction(self):
+        store = self.create_store(max_entries=2)
+        store.set('a', 1)
+        self.now += 10
+        store.set('b', 2)
+        self.now += 10
+        store.get('a') # 'b' is now the least recently used.
+        self.now += 10
+        store.set('c', 3)
+
+        self.assertEqual(store.get('a'), 1)
+        self.assertEqual(store.get('b'), None)
+        self.assertEqual(store.get('c'), 3)
+        self.assertEqual(store.evicted, 1)
+
+    def test_expiry(self):
+        store = self.create_store(ttl=100)
+        store.set('a', 1)
+        store.set('b', 2)
+
+        self.now += 90
+        self.assertEqual(store.get('a'), 1)
+
+        # The TTL of 'a' is counted from the last use.
+        self.now += 20
+        self.assertEqual(store.get('a'), 1)
+        self.assertEqual(store.get('b'), None)
+
+        self.now += 110
+        self.assertEqual(store.get('a'), None)
+
+    def test_expired_entries_are_removed(self):
+        store = self.create_store(ttl=100)
+        store.set('a', 1)
+        self.now += 200
+        store.set('b', 2)
+
+        self.assertEqual(len(store), 1)
+        self.assertEqual(store.evicted, 0)
+
+    def test_clear(self):
+        store = self.create_store()
+        store.set('a', 1)
+        store.clear()
+        self.assertEqual(len(store), 0)
+
+
+class FileContextStoreTest(MemoryContextStoreTest):
+    def setUp(self):
+        MemoryContextStoreTest.setUp(self)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create_store(self, **kwargs):
+        store = FileContextStore(directory=self.directory, **kwargs)
+        store._time = lambda: self.now
+        return store
+
+    def test_unpicklable_context(self):
+        store = self.create_store()
+        store.set('a', { 'lock': threading.Lock() })
+        self.assertEqual(store.get('a'), None)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_files_of_other_processes(self):
+        # Another store in the same directory is another process.
+        self.create_store().set('a', 1)
+
+        store = self.create_store()
+        self.assertEqual(store.get('a'), 1)
+
+        # Expired files are removed, even when they weren't stored by us.
+        self.now += 1000
+        self.create_store(ttl=100).set('b', 2)
+
+        self.assertEqual(sorted(os.listdir(self.directory)), ['b'])
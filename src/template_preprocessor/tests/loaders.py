@@ -0,0 +1,253 @@
+from django.template import Context, TemplateDoesNotExist
+from django.template.loader import BaseLoader
+from django.utils import translation
+from django.utils import unittest
+
+from template_preprocessor.template.loaders import _Base, invalidate_origin_caches, SingleFlight
+from template_preprocessor.template.loaders import RuntimeProcessedLoader, CachedRuntimeProcessedLoader
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+
+__all__ = ('OriginCacheTest', 'SingleFlightTest', 'DependencyTest', )
+
+
+class DictLoader(BaseLoader):
+    """
+    Loader which serves the templates from a dict.
+    """
+    is_usable = True
+
+    def __init__(self, templates):
+        self.templates = templates
+        self.calls = 0
+
+    def load_template_source(self, name, dirs=None):
+        self.calls += 1
+        if name in self.templates:
+            return self.templates[name], 'dict:%s' % name
+        raise TemplateDoesNotExist(name)
+
+
+class DirectoryLoader(BaseLoader):
+    """
+    Loader which serves the templates of one directory.
+    """
+    is_usable = True
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def load_template_source(self, name, dirs=None):
+        path = os.path.join(self.directory, name)
+        if os.path.exists(path):
+            return open(path).read().decode('utf-8'), path
+        raise TemplateDoesNotExist(name)
+
+
+class BlockingDictLoader(DictLoader):
+    """
+    DictLoader which waits for `self.release` before returning a template.
+    """
+    def __init__(self, templates):
+        DictLoader.__init__(self, templates)
+        self.release = threading.Event()
+
+    def load_template_source(self, name, dirs=None):
+        self.release.wait()
+        return DictLoader.load_template_source(self, name, dirs)
+
+
+def create_loader(loader_class, *dict_loaders):
+    loader = loader_class([])
+    loader._cached_loaders = list(dict_loaders)
+    return loader
+
+
+class OriginCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.high = DictLoader({ })
+        self.low = DictLoader({ 'a.html': u'low' })
+
+    def test_remembers_loader(self):
+        loader = create_loader(_Base, self.high, self.low)
+        self.assertEqual(loader.find_template('a.html')[0], u'low')
+        self.assertEqual(loader.find_template('a.html')[0], u'low')
+
+        # The second time, only the loader which had it is asked.
+        self.assertEqual(self.high.calls, 1)
+        self.assertEqual(self.low.calls, 2)
+
+    def test_override_after_invalidation(self):
+        loader = create_loader(_Base, self.high, self.low)
+        loader.find_template('a.html')
+
+        self.high.templates['a.html'] = u'high'
+        self.assertEqual(loader.find_template('a.html')[0], u'low')
+
+        invalidate_origin_caches()
+        self.assertEqual(loader.find_template('a.html')[0], u'high')
+
+    def test_override_after_ttl(self):
+        class Loader(_Base):
+            origin_cache_ttl = .05
+
+        loader = create_loader(Loader, self.high, self.low)
+        loader.find_template('a.html')
+        self.high.templates['a.html'] = u'high'
+
+        time.sleep(.1)
+        self.assertEqual(loader.find_template('a.html')[0], u'high')
+
+    def test_negative_entries(self):
+        class Loader(_Base):
+            origin_cache_negative_ttl = .05
+
+        loader = create_loader(Loader, self.high, self.low)
+        self.assertRaises(TemplateDoesNotExist, loader.find_template, 'b.html')
+
+        self.low.templates['b.html'] = u'new'
+        self.assertRaises(TemplateDoesNotExist, loader.find_template, 'b.html')
+
+        time.sleep(.1)
+        self.assertEqual(loader.find_template('b.html')[0], u'new')
+
+
+def run_concurrently(count, func):
+    """
+    Call func in `count` threads, and return the results (or exceptions).
+    """
+    results = [ ]
+
+    def run():
+        try:
+            results.append(func())
+        except Exception, e:
+            results.append(e)
+
+    threads = [ threading.Thread(target=run) for i in range(count) ]
+    for t in threads:
+        t.start()
+    return threads, results
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        self.single_flight = SingleFlight()
+        self.release = threading.Event()
+        self.calls = [ ]
+
+    def work(self, result):
+        def func():
+            self.calls.append(result)
+            self.release.wait()
+            if isinstance(result, Exception):
+                raise result
+            return result
+        return func
+
+    def finish(self, threads):
+        time.sleep(.1) # Let all threads arrive in SingleFlight.do
+        self.release.set()
+        for t in threads:
+            t.join()
+
+    def test_shared_result(self):
+        threads, results = run_concurrently(5, lambda: self.single_flight.do('key', self.work('result')))
+        self.finish(threads)
+
+        self.assertEqual(self.calls, [ 'result' ])
+        self.assertEqual(results, [ 'result' ] * 5)
+
+    def test_shared_exception(self):
+        error = ValueError('error')
+        threads, results = run_concurrently(5, lambda: self.single_flight.do('key', self.work(error)))
+        self.finish(threads)
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(results, [ error ] * 5)
+
+    def test_different_keys(self):
+        threads, results = run_concurrently(1, lambda: self.single_flight.do('a', self.work('a')))
+        threads2, results2 = run_concurrently(1, lambda: self.single_flight.do('b', self.work('b')))
+        self.finish(threads + threads2)
+
+        self.assertEqual(sorted(self.calls), [ 'a', 'b' ])
+
+    def test_not_cached(self):
+        self.release.set()
+        self.assertEqual(self.single_flight.do('key', self.work('first')), 'first')
+        self.assertEqual(self.single_flight.do('key', self.work('second')), 'second')
+
+    def test_runtime_processed_loader(self):
+        # Concurrent requests for the same template compile it only once.
+        templates = BlockingDictLoader({ 'a.html': u'<p>{{ x }}</p>' })
+        loader = create_loader(RuntimeProcessedLoader, templates)
+
+        threads, results = run_concurrently(5, lambda: loader.load_template('a.html')[0])
+        time.sleep(.1)
+        templates.release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(templates.calls, 1)
+        self.assertEqual(len(set(results)), 1)
+
+
+class DependencyTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.mtime = time.time() - 100
+
+        self.write('a.html', u'<p>{% include "b.html" %}</p>')
+        self.write('b.html', u'b')
+        self.write('c.html', u'c')
+
+        self.loader = create_loader(CachedRuntimeProcessedLoader, DirectoryLoader(self.dir))
+        self.loader.dependency_check_interval = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, source):
+        # Every write gets a new modification time.
+        path = os.path.join(self.dir, name)
+        open(path, 'w').write(source.encode('utf-8'))
+        self.mtime += 1
+        os.utime(path, (self.mtime, self.mtime))
+
+    def load(self, name):
+        return self.loader.load_template(name)[0]
+
+    def test_cached(self):
+        template = self.load('a.html')
+        self.assertEqual(template.render(Context()), u'<p>b</p>')
+        self.assertTrue(self.load('a.html') is template)
+
+    def test_changed_include(self):
+        self.load('a.html')
+        self.write('b.html', u'new')
+        self.assertEqual(self.load('a.html').render(Context()), u'<p>new</p>')
+
+    def test_changed_template(self):
+        self.load('a.html')
+        self.write('a.html', u'<p>new</p>')
+        self.assertEqual(self.load('a.html').render(Context()), u'<p>new</p>')
+
+    def test_unrelated_change(self):
+        template = self.load('a.html')
+        self.write('c.html', u'new')
+        self.assertTrue(self.load('a.html') is template)
+
+    def test_removed_include(self):
+        self.load('a.html')
+        self.load('c.html')
+        os.remove(os.path.join(self.dir, 'b.html'))
+
+        self.loader._check_dependencies()
+        self.assertEqual(self.loader.template_cache.keys(), [ (translation.get_language(), 'c.html', ()) ])
+        self.assertEqual(self.loader._dependents.keys(), [ os.path.join(self.dir, 'c.html') ])
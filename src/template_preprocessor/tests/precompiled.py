@@ -0,0 +1,367 @@
+from django.template import Context, TemplateDoesNotExist
+from django.utils import translation
+from django.utils import unittest
+
+from template_preprocessor.template import loaders
+from template_preprocessor.tests.loaders import DictLoader
+from template_preprocessor.template.loaders import PreprocessedLoader, SerializedPreprocessedLoader
+from template_preprocessor.template.precompiled import save_compiled_template, write_manifest, \
+            read_manifest, get_manifest_path, save_serialized_template, load_serialized_template, \
+            SERIALIZED_SUFFIX, write_template_pack, get_pack_path, TemplatePack, template_digest, \
+            get_object_path, remove_unused_objects, is_static_template, StaticTemplate, serialize_template
+
+import os
+import shutil
+import tempfile
+import time
+
+
+__all__ = ('ManifestTest', 'SerializedTemplateTest', 'TemplatePackTest', 'ObjectStoreTest', 'StaticTemplateTest', 'SerializedTemplatePackTest', )
+
+
+class PrecompiledTestCase(unittest.TestCase):
+    """
+    Every test gets its own TEMPLATE_CACHE_DIR.
+    """
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        translation.activate('en')
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        translation.deactivate()
+
+    def compile_templates(self, templates):
+        """
+        Store the compiled templates, like `compile_templates` does.
+        `templates` is a list of (lang, template_name, source) tuples.
+        """
+        for lang, template_name, source in templates:
+            path = self.get_path(lang, template_name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            save_compiled_template(self.cache_dir, path, source)
+
+        return self.write_manifest(templates)
+
+    def write_manifest(self, templates):
+        """
+        Write the manifest, every time with another modification time.
+        (Without waiting for the mtime resolution of the file system.)
+        """
+        manifest = write_manifest(self.cache_dir, templates)
+        self.manifest_mtime = getattr(self, 'manifest_mtime', time.time()) + 10
+        os.utime(get_manifest_path(self.cache_dir), (self.manifest_mtime, self.manifest_mtime))
+        return manifest
+
+    def get_path(self, lang, template_name):
+        return os.path.join(self.cache_dir, lang, template_name)
+
+    def create_loader(self, loader_class=PreprocessedLoader):
+        loader = loader_class([])
+        loader._PreprocessedLoader__cache_dir = self.cache_dir
+        loader.manifest_check_interval = 0
+        return loader
+
+    def render(self, loader, template_name):
+        return loader.load_template(template_name)[0].render(Context({ 'x': 'X' }))
+
+
+class ManifestTest(PrecompiledTestCase):
+    def test_generation_is_unique(self):
+        first = self.compile_templates([ ('en', 'a.html', u'a') ])
+
+        # compile_templates --all removes the manifest.
+        os.remove(get_manifest_path(self.cache_dir))
+        second = self.compile_templates([ ('en', 'a.html', u'a') ])
+
+        self.assertNotEqual(first['generation'], second['generation'])
+        self.assertEqual(read_manifest(self.cache_dir)['generation'], second['generation'])
+
+    def test_hot_reload(self):
+        self.compile_templates([ ('en', 'a.html', u'one {{ x }}') ])
+        loader = self.create_loader()
+        self.assertEqual(self.render(loader, 'a.html'), u'one X')
+
+        self.compile_templates([ ('en', 'a.html', u'two {{ x }}') ])
+        self.assertEqual(self.render(loader, 'a.html'), u'two X')
+
+    def test_new_template_after_reload(self):
+        # A template which didn't exist before the deploy is found after the
+        # manifest has been reloaded.
+        self.compile_templates([ ('en', 'a.html', u'a') ])
+        source_loader = DictLoader({ })
+        loader = self.create_loader()
+        loader._cached_loaders = [ source_loader ]
+        loader.origin_cache_negative_ttl = None
+
+        self.assertRaises(TemplateDoesNotExist, loader.load_template, 'b.html')
+
+        source_loader.templates['b.html'] = u'b {{ x }}'
+        self.compile_templates([ ('en', 'a.html', u'a') ])
+        self.assertEqual(self.render(loader, 'b.html'), u'b X')
+
+    def test_hot_reload_after_removing_the_manifest(self):
+        self.compile_templates([ ('en', 'a.html', u'one {{ x }}') ])
+        loader = self.create_loader()
+        self.assertEqual(self.render(loader, 'a.html'), u'one X')
+
+        os.remove(get_manifest_path(self.cache_dir))
+        self.compile_templates([ ('en', 'a.html', u'two {{ x }}') ])
+        self.assertEqual(self.render(loader, 'a.html'), u'two X')
+
+
+class SerializedTemplateTest(PrecompiledTestCase):
+    source = u'{% if x %}<p>{{ x|lower }}</p>{% endif %}'
+
+    def setUp(self):
+        PrecompiledTestCase.setUp(self)
+        self.compile_templates([ ('en', 'a.html', self.source) ])
+        self.path = self.get_path('en', 'a.html')
+
+    def test_serialize(self):
+        self.assertTrue(save_serialized_template(self.path, self.source, 'a.html'))
+
+        template = load_serialized_template(self.path, self.source)
+        self.assertEqual(template.render(Context({ 'x': 'X' })), u'<p>x</p>')
+
+    def test_outdated(self):
+        save_serialized_template(self.path, self.source, 'a.html')
+        self.assertEqual(load_serialized_template(self.path, self.source + u'.'), None)
+
+    def test_invalid(self):
+        open(self.path + SERIALIZED_SUFFIX, 'wb').write('invalid')
+        self.assertEqual(load_serialized_template(self.path, self.source), None)
+
+    def test_loader(self):
+        # The serialized template renders the same as the parsed one.
+        save_serialized_template(self.path, self.source, 'a.html')
+        parsed = self.render(self.create_loader(PreprocessedLoader), 'a.html')
+
+        def get_template_from_string(*args):
+            raise AssertionError('The template should not be parsed')
+
+        original = loaders.get_template_from_string
+        loaders.get_template_from_string = get_template_from_string
+        try:
+            self.assertEqual(self.render(self.create_loader(SerializedPreprocessedLoader), 'a.html'), parsed)
+        finally:
+            loaders.get_template_from_string = original
+
+    def test_loader_without_serialized_template(self):
+        self.assertEqual(self.render(self.create_loader(SerializedPreprocessedLoader), 'a.html'), u'<p>x</p>')
+
+        # Outdated pickle
+        save_serialized_template(self.path, u'{{ x }}', 'a.html')
+        self.assertEqual(self.render(self.create_loader(SerializedPreprocessedLoader), 'a.html'), u'<p>x</p>')
+
+
+class TemplatePackTest(PrecompiledTestCase):
+    templates = [
+        ('en', 'a.html', u'<p>{{ x }} \u263a</p>'),
+        ('nl', 'a.html', u'<p>{{ x }} \u263a</p>'),
+        ('en', 'b.html', u'<b>Hello</b>'),
+        ('nl', 'b.html', u'<b>Hallo</b>'),
+    ]
+
+    def test_pack(self):
+        path = get_pack_path(self.cache_dir)
+        write_template_pack(path, self.templates)
+        pack = TemplatePack(path)
+
+        for lang, template_name, source in self.templates:
+            self.assertTrue((lang, template_name) in pack)
+            self.assertEqual(pack.get(lang, template_name), source)
+            self.assertEqual(pack.digest(lang, template_name), template_digest(source))
+
+        self.assertFalse(('fr', 'a.html') in pack)
+        self.assertEqual(pack.get('fr', 'a.html'), None)
+        pack.close()
+
+    def test_identical_templates_stored_once(self):
+        path = get_pack_path(self.cache_dir)
+        source = u'a' * 1000
+        write_template_pack(path, [ ('en', 'a.html', source) ])
+        size = os.path.getsize(path)
+
+        # Only the index grows.
+        write_template_pack(path, [ ('en', 'a.html', source), ('nl', 'a.html', source) ])
+        self.assertTrue(os.path.getsize(path) - size < len(source))
+        self.assertEqual(TemplatePack(path).get('nl', 'a.html'), source)
+
+    def test_invalid_pack(self):
+        path = get_pack_path(self.cache_dir)
+        open(path, 'wb').write('invalid')
+        self.assertRaises(Exception, TemplatePack, path)
+
+    def render_all(self, loader):
+        result = [ ]
+        for lang, template_name, source in self.templates:
+            translation.activate(lang)
+            result.append(self.render(loader, template_name))
+        return result
+
+    def test_same_output_as_files(self):
+        self.compile_templates(self.templates)
+        from_files = self.render_all(self.create_loader())
+
+        # Pack, without the separate files.
+        shutil.rmtree(self.cache_dir)
+        os.mkdir(self.cache_dir)
+        write_template_pack(get_pack_path(self.cache_dir), self.templates)
+        self.assertEqual(self.render_all(self.create_loader()), from_files)
+
+        # Pack for each language
+        os.remove(get_pack_path(self.cache_dir))
+        for l in ('en', 'nl'):
+            write_template_pack(get_pack_path(self.cache_dir, l), [ t for t in self.templates if t[0] == l ])
+        self.assertEqual(self.render_all(self.create_loader()), from_files)
+
+    def test_pack_per_language_first(self):
+        write_template_pack(get_pack_path(self.cache_dir), [ ('en', 'a.html', u'all') ])
+        write_template_pack(get_pack_path(self.cache_dir, 'en'), [ ('en', 'a.html', u'en') ])
+        self.assertEqual(self.render(self.create_loader(), 'a.html'), u'en')
+
+    def test_hot_reload(self):
+        write_template_pack(get_pack_path(self.cache_dir), [ ('en', 'a.html', u'one') ])
+        self.write_manifest([ ('en', 'a.html', u'one') ])
+        loader = self.create_loader()
+        self.assertEqual(self.render(loader, 'a.html'), u'one')
+
+        write_template_pack(get_pack_path(self.cache_dir), [ ('en', 'a.html', u'two') ])
+        self.write_manifest([ ('en', 'a.html', u'two') ])
+        self.assertEqual(self.render(loader, 'a.html'), u'two')
+
+
+class ObjectStoreTest(PrecompiledTestCase):
+    def read(self, lang, template_name):
+        return open(self.get_path(lang, template_name), 'rb').read().decode('utf-8')
+
+    def list_objects(self):
+        return sorted(f for root, dirs, files in os.walk(os.path.join(self.cache_dir, 'objects')) for f in files)
+
+    def test_identical_templates_stored_once(self):
+        self.compile_templates([ ('en', 'a.html', u'same'), ('nl', 'a.html', u'same'), ('nl', 'b.html', u'other') ])
+
+        self.assertEqual(self.list_objects(), sorted([ template_digest(u'same'), template_digest(u'other') ]))
+        self.assertEqual(self.read('en', 'a.html'), u'same')
+        self.assertEqual(self.read('nl', 'a.html'), u'same')
+
+    def test_overwrite_shared_template(self):
+        # Recompiling one language doesn't change the other languages.
+        self.compile_templates([ ('en', 'a.html', u'same'), ('nl', 'a.html', u'same') ])
+        self.compile_templates([ ('en', 'a.html', u'new') ])
+
+        self.assertEqual(self.read('en', 'a.html'), u'new')
+        self.assertEqual(self.read('nl', 'a.html'), u'same')
+        self.assertEqual(open(get_object_path(self.cache_dir, template_digest(u'same')), 'rb').read(), 'same')
+
+    def test_remove_unused_objects(self):
+        self.compile_templates([ ('en', 'a.html', u'one'), ('en', 'b.html', u'b') ])
+        manifest = self.compile_templates([ ('en', 'a.html', u'two'), ('en', 'b.html', u'b') ])
+
+        remove_unused_objects(self.cache_dir, set(manifest['templates'].values()))
+        self.assertEqual(self.list_objects(), sorted([ template_digest(u'two'), template_digest(u'b') ]))
+
+        # The compiled templates are still there.
+        self.assertEqual(self.read('en', 'a.html'), u'two')
+        self.assertEqual(self.render(self.create_loader(), 'b.html'), u'b')
+
+    def test_shared_template_objects(self):
+        self.compile_templates([ ('en', 'a.html', u'{{ x }}'), ('nl', 'a.html', u'{{ x }}'), ('fr', 'a.html', u'x') ])
+        loader = self.create_loader()
+
+        templates = { }
+        for lang in ('en', 'nl', 'fr'):
+            translation.activate(lang)
+            templates[lang] = loader.load_template('a.html')[0]
+
+        self.assertTrue(templates['en'] is templates['nl'])
+        self.assertFalse(templates['en'] is templates['fr'])
+
+
+class StaticTemplateTest(PrecompiledTestCase):
+    def test_is_static(self):
+        self.assertTrue(is_static_template(u'<p>a &amp; b</p>'))
+        self.assertTrue(is_static_template(u'{ } %}'))
+        self.assertFalse(is_static_template(u'<p>{{ x }}</p>'))
+        self.assertFalse(is_static_template(u'<p>{% now "Y" %}</p>'))
+        self.assertFalse(is_static_template(u'<p>{# comment #}</p>'))
+
+    def test_loader(self):
+        self.compile_templates([ ('en', 'static.html', u'<p>a & b</p>'), ('en', 'dynamic.html', u'<p>{{ x }}</p>') ])
+        loader = self.create_loader()
+
+        template = loader.load_template('static.html')[0]
+        self.assertTrue(isinstance(template, StaticTemplate))
+        self.assertEqual(template.render(Context({ 'x': 'X' })), u'<p>a & b</p>')
+        self.assertEqual(template.nodelist.render(Context()), u'<p>a & b</p>')
+
+        self.assertFalse(isinstance(loader.load_template('dynamic.html')[0], StaticTemplate))
+        self.assertEqual(self.render(loader, 'dynamic.html'), u'<p>X</p>')
+
+    def test_without_manifest(self):
+        # Without manifest, Django parses every template.
+        self.compile_templates([ ('en', 'static.html', u'<p>a</p>') ])
+        os.remove(get_manifest_path(self.cache_dir))
+        loader = self.create_loader()
+
+        self.assertFalse(isinstance(loader.load_template('static.html')[0], StaticTemplate))
+        self.assertEqual(self.render(loader, 'static.html'), u'<p>a</p>')
+
+    def test_outdated_manifest(self):
+        # The compiled template has changed since the manifest was written.
+        self.compile_templates([ ('en', 'a.html', u'<p>a</p>') ])
+        save_compiled_template(self.cache_dir, self.get_path('en', 'a.html'), u'<p>{{ x }}</p>')
+
+        self.assertEqual(self.render(self.create_loader(), 'a.html'), u'<p>X</p>')
+
+
+class SerializedTemplatePackTest(PrecompiledTestCase):
+    templates = [
+        ('en', 'a.html', u'{% if x %}<p>{{ x|lower }}</p>{% endif %}'),
+        ('nl', 'a.html', u'{% if x %}<p>{{ x|lower }}</p>{% endif %}'),
+        ('en', 'b.html', u'<b>{{ x }}</b>'),
+    ]
+
+    def setUp(self):
+        PrecompiledTestCase.setUp(self)
+        self.path = get_pack_path(self.cache_dir)
+        self.serialized = dict(((lang, t), serialize_template(source, t)) for lang, t, source in self.templates[:2])
+        write_template_pack(self.path, self.templates, self.serialized)
+
+    def test_pack(self):
+        pack = TemplatePack(self.path)
+        source = self.templates[0][2]
+
+        self.assertEqual(pack.get_serialized('en', 'a.html', source).render(Context({ 'x': 'X' })), u'<p>x</p>')
+        self.assertEqual(pack.get_serialized('en', 'a.html', source + u'.'), None)
+        self.assertEqual(pack.get_serialized('en', 'b.html', self.templates[2][2]), None)
+        self.assertEqual(pack.get('nl', 'a.html'), source)
+        pack.close()
+
+    def test_stored_once(self):
+        size = os.path.getsize(self.path)
+        write_template_pack(self.path, self.templates, dict(self.serialized.items()[:1]))
+
+        # Only the index changes.
+        self.assertTrue(size - os.path.getsize(self.path) < 100)
+
+    def test_loader(self):
+        # The loader takes the Template objects from the pack, without
+        # parsing, and without the separate files.
+        def get_template_from_string(source, *args):
+            if source == self.templates[0][2]:
+                raise AssertionError('The template should not be parsed')
+            return original(source, *args)
+
+        original = loaders.get_template_from_string
+        loaders.get_template_from_string = get_template_from_string
+        try:
+            loader = self.create_loader(SerializedPreprocessedLoader)
+            self.assertEqual(self.render(loader, 'a.html'), u'<p>x</p>')
+            self.assertEqual(self.render(loader, 'b.html'), u'<b>X</b>')
+        finally:
+            loaders.get_template_from_string = original
+
+        self.assertEqual(os.listdir(self.cache_dir), [ 'templates.pack' ])
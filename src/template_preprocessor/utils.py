@@ -2,8 +2,11 @@ from django.utils import translation
 from django.conf import settings
 from django.template import TemplateDoesNotExist
 
+from template_preprocessor.core.run_cache import RunCache
+
 import os
 import codecs
+import threading
 
 EXCLUDED_APPS = [ 'debug_toolbar', 'django_extensions' ]
 
@@ -36,39 +39,212 @@ def _get_path_form_app(app):
     return m.__path__[0]
 
 
+class _AppIndex(object):
+    """
+    The template directories of all installed applications, and the
+    preprocessor options for each of them.
+    """
+    def __init__(self):
+        self.template_dirs = [] # (app, directory), in the order of INSTALLED_APPS
+        self.apps_by_dir = { } # normalized directory -> app
+        self._options = { }
+
+        for app in settings.INSTALLED_APPS:
+            dir = os.path.join(_get_path_form_app(app), 'templates')
+            self.template_dirs.append((app, dir))
+
+            # NOTE: somehow, we get lowercase paths from the template origin in
+            # Windows, so convert all paths to lowercase before comparing.
+            self.apps_by_dir[os.path.normpath(dir).lower()] = app
+
+    def get_app_for_path(self, path):
+        """
+        Return the application of which the template directory contains this
+        path, or None.
+        """
+        path = os.path.normpath(path).lower()
+
+        # Longest prefix first.
+        while True:
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+            if path in self.apps_by_dir:
+                return self.apps_by_dir[path]
+
+    def get_options(self, app):
+        if app not in self._options:
+            self._options[app] = get_options_for_app(app)
+        return self._options[app]
+
+
+_app_index = RunCache()
+
+def _get_app_index():
+    index = _app_index.get('index')
+
+    if index is None:
+        index = _app_index['index'] = _AppIndex()
+
+    return index
+
+
+class TemplateIndex(object):
+    """
+    Index of all the files in TEMPLATE_DIRS and in the template directories of
+    the installed apps: template name -> (path, mtime, template directory).
+    When a template appears in several directories, the first one wins, like
+    in Django's template loaders.
+    """
+    def __init__(self):
+        self.templates = { }
+        self._directories = { } # path -> (mtime, { filename: mtime }, [ subdirectories ])
+        self.refresh()
+
+    def _get_template_dirs(self):
+        return list(settings.TEMPLATE_DIRS) + [ dir for app, dir in _get_app_index().template_dirs ]
+
+    def _scan(self, directory):
+        """
+        List this directory, and the subdirectories we don't know yet.
+        """
+        try:
+            mtime = os.stat(directory).st_mtime
+            names = os.listdir(directory)
+        except OSError, e:
+            self._forget(directory)
+            return
+
+        files = { }
+        subdirectories = []
+
+        for name in names:
+            path = os.path.join(directory, name)
+
+            if os.path.isdir(path):
+                # Don't follow symlinks (like os.walk), and skip the compiled templates.
+                if not os.path.islink(path) and not os.path.normpath(path).startswith(settings.TEMPLATE_CACHE_DIR):
+                    subdirectories.append(path)
+            else:
+                try:
+                    files[name] = os.path.getmtime(path)
+                except OSError, e:
+                    pass
+
+        # Forget subdirectories which have been removed.
+        if directory in self._directories:
+            for d in self._directories[directory][2]:
+                if d not in subdirectories:
+                    self._forget(d)
+
+        self._directories[directory] = (mtime, files, subdirectories)
+
+        for d in subdirectories:
+            if d not in self._directories:
+                self._scan(d)
+
+    def _forget(self, directory):
+        if directory in self._directories:
+            for d in self._directories.pop(directory)[2]:
+                self._forget(d)
+
+    def refresh(self):
+        """
+        Bring the index up to date. Only the directories of which the
+        modification time has changed are listed again.
+        """
+        for directory in self._get_template_dirs():
+            if directory not in self._directories:
+                self._scan(directory)
+
+        for directory in self._directories.keys():
+            if directory in self._directories: # (Can be forgotten in the meantime.)
+                mtime, files, subdirectories = self._directories[directory]
+                try:
+                    changed = os.stat(directory).st_mtime != mtime
+                except OSError, e:
+                    changed = True
+
+                if changed:
+                    self._scan(directory)
+                else:
+                    for name in files:
+                        try:
+                            files[name] = os.path.getmtime(os.path.join(directory, name))
+                        except OSError, e:
+                            pass
+
+        # Rebuild template name -> path mapping.
+        templates = { }
+
+        def add(template_dir, directory):
+            if directory in self._directories:
+                mtime, files, subdirectories = self._directories[directory]
+                for name, file_mtime in files.iteritems():
+                    path = os.path.join(directory, name)
+                    template = os.path.relpath(path, template_dir)
+                    if template not in templates:
+                        templates[template] = (path, file_mtime, template_dir)
+
+                for d in subdirectories:
+                    add(template_dir, d)
+
+        for template_dir in self._get_template_dirs():
+            add(template_dir, template_dir)
+
+        self.templates = templates
+
+    def get(self, template):
+        """
+        Return (path, mtime, template directory), or None.
+        """
+        return self.templates.get(template)
+
+
+_template_index = RunCache()
+
+def get_template_index():
+    """
+    Return the template index. It's built once per compile run.
+    """
+    index = _template_index.get('index')
+
+    if index is None:
+        index = _template_index['index'] = TemplateIndex()
+
+    return index
+
+
 def template_iterator():
     """
     Iterate through all templates of all installed apps.
     (Except EXCLUDED_APPS)
     """
-    def walk(directory):
-        for root, dirs, files in os.walk(directory):
-            for f in files:
-                if not os.path.normpath(os.path.join(root, f)).startswith(settings.TEMPLATE_CACHE_DIR):
-                    if f.endswith('.html'):
-                        yield os.path.relpath(os.path.join(root, f), directory)
+    index = get_template_index()
+    excluded_dirs = [ dir for app, dir in _get_app_index().template_dirs if app in EXCLUDED_APPS ]
 
-    for dir in settings.TEMPLATE_DIRS:
-        for f in walk(dir):
-            yield dir, f
-
-    for app in settings.INSTALLED_APPS:
-        if app not in EXCLUDED_APPS:
-            dir = os.path.join(_get_path_form_app(app), 'templates')
-            for f in walk(dir):
-                yield dir, f
+    for template, (path, mtime, dir) in sorted(index.templates.items()):
+        if template.endswith('.html') and dir not in excluded_dirs:
+            yield dir, template
 
 def get_template_path(template):
     """
     Turn template path into absolute path
     """
+    entry = get_template_index().get(template)
+    if entry:
+        return entry[0]
+
+    # Not in the index, maybe it has been created since.
     for dir in settings.TEMPLATE_DIRS:
         p = os.path.join(dir, template)
         if os.path.exists(p):
             return p
 
-    for app in settings.INSTALLED_APPS:
-        p = os.path.join(_get_path_form_app(app), 'templates', template)
+    for app, dir in _get_app_index().template_dirs:
+        p = os.path.join(dir, template)
         if os.path.exists(p):
             return p
 
@@ -88,14 +264,9 @@ def get_options_for_path(path):
     return a list of default settings for this template.
     (find app, and return settings for the matching app.)
     """
-    result = []
-    for app in settings.INSTALLED_APPS:
-        dir = os.path.normpath(os.path.join(_get_path_form_app(app), 'templates')).lower()
-        if os.path.normpath(path).lower().startswith(dir):
-            result = get_options_for_app(app)
-
-        # NOTE: somehow, we get lowercase paths from the template origin in
-        # Windows, so convert both paths to lowercase before comparing.
+    index = _get_app_index()
+    app = index.get_app_for_path(path) if path else None
+    result = list(index.get_options(app)) if app else []
 
     # Disable all HTML extensions if the template name does not end with .html
     # (Can still be overriden in the templates.)
@@ -148,5 +319,9 @@ def execute_precompile_command():
     command = getattr(settings, 'TEMPLATE_PREPROCESSOR_PRECOMPILE_COMMAND', None)
 
     if command:
-        import os
-        os.system(command)
+        # Don't run the command in parallel when templates are compiled in
+        # several threads.
+        with _precompile_command_lock:
+            os.system(command)
+
+_precompile_command_lock = threading.Lock()
@@ -8,6 +8,14 @@ TEMPLATE_DEBUG = DEBUG
 ADMINS = ()
 MANAGERS = ADMINS
 
+# Only for running the tests.
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+}
+
 TIME_ZONE = 'America/Chicago'
 
 PROJECT_DIR = os.path.dirname(__file__) + '/'